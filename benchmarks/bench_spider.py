@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+# Offline parse benchmark for the CharitySpider callbacks.
+#
+# Runs parse, parse_directory_page and parse_charity_page over the saved pages in benchmarks/fixtures (no network)
+# and reports pages/sec, per-field extraction time and allocations per page. With --record the results are appended
+# to benchmarks/results.jsonl tagged with the current git commit, and compared against the last recorded run so a
+# parser regression shows up before a production crawl.
+#
+# usage (from the repository root):
+#     python benchmarks/bench_spider.py [--iterations 500] [--record] [--threshold 0.10]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrapy.http import HtmlResponse, Request
+
+from charity_scraper import extractors as ex
+from charity_scraper.spiders.charity_spider import CharitySpider
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'fixtures')
+RESULTS_FILE = os.path.join(BENCH_DIR, 'results.jsonl')
+BASE_URL = 'https://www.charitynavigator.org/'
+
+# (fixture file, callback name) - the charity page variants cover rated, unrated, missing location and missing comp
+FIXTURES = [
+    ('search_alpha.html', 'parse'),
+    ('directory_a.html', 'parse_directory_page'),
+    ('charity_rated.html', 'parse_charity_page'),
+    ('charity_unrated.html', 'parse_charity_page'),
+    ('charity_missing_location.html', 'parse_charity_page'),
+    ('charity_missing_comp.html', 'parse_charity_page'),
+]
+
+
+# the field groups of parse_charity_page, timed one at a time against the parsed page
+def _rating_container(root):
+    return ex.first(ex.RATING_WRAPPER, root)
+
+
+def _tables(root):
+    container = _rating_container(root)
+    return ex.CharityTables(container) if container is not None else None
+
+
+FIELD_PROBES = [
+    ('name', lambda root: ex.first(ex.NAME, root)),
+    ('tagline', lambda root: ex.first(ex.TAGLINE, root)),
+    ('category', lambda root: ex.first(ex.CRUMBS, root)),
+    ('location', lambda root: ex.LOCATION_LINES(root)),
+    ('rating_wrapper', _rating_container),
+    ('tables', _tables),
+    ('mission', lambda root: ex.first(ex.MISSION, _rating_container(root)) if _rating_container(root) is not None else None),
+    ('leader_comp', lambda root: ex.first(ex.LEADER_COMP, _rating_container(root)) if _rating_container(root) is not None else None),
+]
+
+
+def load_response(file_name):
+    with open(os.path.join(FIXTURE_DIR, file_name), 'rb') as f:
+        body = f.read()
+    url = BASE_URL + file_name
+    return HtmlResponse(url=url, body=body, encoding='utf-8', request=Request(url))
+
+
+# a fresh response per run, so the cost of building the lxml tree is included like it is in a real crawl
+def run_callback(spider, file_name, body_responses, callback_name):
+    source = body_responses[file_name]
+    response = HtmlResponse(url=source.url, body=source.body, encoding='utf-8', request=source.request)
+    return list(getattr(spider, callback_name)(response))
+
+
+def bench_callbacks(spider, responses, iterations):
+    results = {}
+    for file_name, callback_name in FIXTURES:
+        run_callback(spider, file_name, responses, callback_name)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            run_callback(spider, file_name, responses, callback_name)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        run_callback(spider, file_name, responses, callback_name)
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+
+        results[file_name] = {'callback': callback_name, 'pages_per_sec': iterations / elapsed,
+                              'ms_per_page': elapsed / iterations * 1000, 'peak_kib': peak / 1024.0, 'live_blocks': blocks}
+    return results
+
+
+def bench_fields(responses, iterations):
+    results = {}
+    for file_name, callback_name in FIXTURES:
+        if callback_name != 'parse_charity_page':
+            continue
+        root = ex.response_root(responses[file_name])
+        timings = {}
+        for field, probe in FIELD_PROBES:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                probe(root)
+            timings[field] = (time.perf_counter() - start) / iterations * 1e6
+        results[file_name] = timings
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def last_recorded():
+    if not os.path.exists(RESULTS_FILE):
+        return None
+    last = None
+    with open(RESULTS_FILE) as f:
+        for line in f:
+            if line.strip():
+                last = json.loads(line)
+    return last
+
+
+def print_report(callbacks, fields, previous, threshold):
+    print('%-32s %-22s %12s %12s %10s %12s' % ('fixture', 'callback', 'pages/sec', 'ms/page', 'peak KiB', 'live blocks'))
+    regressions = []
+    for file_name, r in callbacks.items():
+        change = ''
+        if previous is not None and file_name in previous['callbacks']:
+            before = previous['callbacks'][file_name]['pages_per_sec']
+            delta = (r['pages_per_sec'] - before) / before
+            change = '  (%+.1f%% vs %s)' % (delta * 100, previous.get('commit'))
+            if delta < -threshold:
+                regressions.append(file_name)
+        print('%-32s %-22s %12.1f %12.3f %10.1f %12d%s' % (file_name, r['callback'], r['pages_per_sec'], r['ms_per_page'],
+                                                         r['peak_kib'], r['live_blocks'], change))
+    print()
+    print('per-field extraction time (microseconds)')
+    print('%-32s ' % 'fixture' + ' '.join('%14s' % field for field, _ in FIELD_PROBES))
+    for file_name, timings in fields.items():
+        print('%-32s ' % file_name + ' '.join('%14.1f' % timings[field] for field, _ in FIELD_PROBES))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of the charity spider callbacks')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--record', action='store_true', help='append the results to benchmarks/results.jsonl')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='fractional drop in pages/sec vs the last recorded run that counts as a regression')
+    args = parser.parse_args(argv)
+
+    spider = CharitySpider()
+    responses = {file_name: load_response(file_name) for file_name, _ in FIXTURES}
+    callbacks = bench_callbacks(spider, responses, args.iterations)
+    fields = bench_fields(responses, args.iterations)
+    previous = last_recorded()
+    regressions = print_report(callbacks, fields, previous, args.threshold)
+
+    if args.record:
+        with open(RESULTS_FILE, 'a') as f:
+            f.write(json.dumps({'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                'iterations': args.iterations, 'callbacks': callbacks, 'fields': fields}) + '\n')
+    if regressions:
+        print('\nregression (> %.0f%% slower than the last recorded run): %s' % (args.threshold * 100, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+# End-to-end crawl checks against the stand-in site (benchmarks/standin_server.py).
+#
+# Each check serves the fixtures from a stand-in server on a free local port, runs real crawls of it (one directory
+# letter, 240 charities, unless the check says otherwise) with their output in a temporary directory, and asserts on
+# the crawl stats and the exported files. Every crawl runs in its own process, since the twisted reactor can only be
+# started once.
+#
+#     delta_lost_page - a charity page that 429s out of every retry is not reported as removed by the delta export
+#     adaptive_rate_limit - with adaptive concurrency, a crawl of a rate limited site (three letters) gets throttled
+#         but gives up on no page
+#
+# usage (from the repository root):
+#     python benchmarks/crawl_checks.py [check ...]
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from standin_server import StandInState, make_handler
+
+# the first directory letter of the stand-in site
+ONE_LETTER = {'shards': 27, 'shard': 0}
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(condition, message, *args):
+    if not condition:
+        raise CheckFailed(message % args)
+
+
+class StandIn(object):
+    # the stand-in site served from a background thread; its state can be changed between crawls
+
+    def __init__(self, latency=0.01, rate_limit=0, retry_after=1):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), None)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.state = StandInState(self.url, latency, 0.0, rate_limit, 0, retry_after)
+        self.server.RequestHandlerClass = make_handler(self.state)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def start_url(self):
+        return self.url + '/index.cfm?bay=search.alpha'
+
+
+def _crawl(settings, spider_args, results):
+    os.chdir(REPO_DIR)
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from charity_scraper.spiders.charity_spider import CharitySpider
+
+    project_settings = get_project_settings()
+    project_settings.setdict(settings, priority='cmdline')
+    process = CrawlerProcess(project_settings)
+    crawler = process.create_crawler(CharitySpider)
+    process.crawl(crawler, **spider_args)
+    process.start()
+    results.put(dict((key, value) for key, value in crawler.stats.get_stats().items()
+                     if isinstance(value, (int, float, str))))
+
+
+# run one crawl of the stand-in site in a child process and return its stats
+def crawl(site, workdir, settings=None, **spider_args):
+    crawl_settings = {
+        'ROBOTSTXT_OBEY': False,
+        'LOG_LEVEL': 'WARNING',
+        'CSV_EXPORT_PATH': os.path.join(workdir, 'charities.csv'),
+        'METRICS_FILE': os.path.join(workdir, 'crawl_metrics.prom'),
+    }
+    crawl_settings.update(settings or {})
+    spider_args = dict(ONE_LETTER, **spider_args)
+    spider_args['start_url'] = site.start_url()
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_crawl, args=(crawl_settings, spider_args, results))
+    process.start()
+    stats = results.get()
+    process.join()
+    return stats
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check_delta_lost_page(workdir):
+    deltas = os.path.join(workdir, 'deltas')
+    snapshot = os.path.join(workdir, 'charities.snapshot.db')
+    settings = {
+        'ITEM_PIPELINES': {'charity_scraper.pipelines.WriteItemPipeline': 200,
+                           'charity_scraper.pipelines.DeltaExportPipeline': 400},
+        'DELTA_DIR': deltas,
+        'DELTA_SNAPSHOT': snapshot,
+    }
+
+    seen = set()
+
+    # the delta export the last crawl wrote
+    def manifest():
+        new = [d for d in os.listdir(deltas) if not d.endswith('.partial') and d not in seen]
+        expect(len(new) == 1, 'expected one new delta export, found %s', new)
+        seen.update(new)
+        path = os.path.join(deltas, new[0])
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return path, json.load(f)
+
+    with StandIn() as site:
+        crawl(site, workdir, settings)
+        path, first = manifest()
+        expect(first['removed_checked'] and first['counts']['added'] == 240,
+               'first crawl: expected 240 added charities with removals checked, got %s', first)
+
+        conn = sqlite3.connect(snapshot)
+        key = conn.execute("SELECT charity_key FROM snapshot WHERE charity_key LIKE 'orgid:%' LIMIT 1").fetchone()[0]
+        conn.close()
+        site.state.throttled_orgids = {key.split(':', 1)[1]}
+        stats = crawl(site, workdir, settings)
+        path, second = manifest()
+        expect(stats.get('retry/max_reached', 0) >= 1, 'second crawl: the page of %s was not given up on', key)
+        expect(not second['removed_checked'] and 'retry/max_reached' in second['lost_requests'],
+               'second crawl lost requests but removals were checked: %s', second)
+        removed = [record['key'] for record in read_jsonl(os.path.join(path, 'removed.jsonl'))]
+        expect(key not in removed, 'second crawl: %s was reported removed although its page 429d out', key)
+        expect(second['counts']['unchanged'] == 239, 'second crawl: expected 239 unchanged charities, got %s', second)
+
+        site.state.throttled_orgids = set()
+        crawl(site, workdir, settings)
+        path, third = manifest()
+        expect(third['removed_checked'] and third['counts']['added'] == 0 and third['counts']['removed'] == 0,
+               'third crawl: %s should be unchanged after the lost page, got %s', key, third)
+
+
+def check_adaptive_rate_limit(workdir):
+    with StandIn(rate_limit=20) as site:
+        stats = crawl(site, workdir, {'ADAPTIVE_CONCURRENCY_ENABLED': True}, shards=9)
+    expect(stats.get('downloader/response_status_count/429', 0) > 0, 'the crawl was never throttled: %s', stats)
+    expect(stats.get('retry/max_reached', 0) == 0, 'the crawl gave up on %s pages', stats.get('retry/max_reached'))
+    expect(stats.get('item_scraped_count') == 720, 'expected 720 charities, got %s', stats.get('item_scraped_count'))
+
+
+CHECKS = {
+    'delta_lost_page': check_delta_lost_page,
+    'adaptive_rate_limit': check_adaptive_rate_limit,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end crawl checks against the stand-in site')
+    parser.add_argument('checks', nargs='*', help='checks to run (default: all): %s' % ', '.join(sorted(CHECKS)))
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error('unknown checks: %s' % ', '.join(unknown))
+
+    failed = []
+    for name in args.checks or sorted(CHECKS):
+        workdir = tempfile.mkdtemp(prefix='crawl_check_')
+        try:
+            CHECKS[name](workdir)
+            print('%-24s ok' % name)
+        except CheckFailed as e:
+            print('%-24s FAILED: %s' % (name, e))
+            failed.append(name)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the charity site, serving the pages in benchmarks/fixtures with injected latency and throttling.
+#
+# Links in the fixtures are rewritten to point back at this server, so a full crawl runs against it:
+#
+#     python benchmarks/standin_server.py --port 8000 --latency 0.2 --jitter 0.1 --rate-limit 20
+#     scrapy crawl charity_spider -a start_url=http://127.0.0.1:8000/index.cfm?bay=search.alpha \
+#         -s ADAPTIVE_CONCURRENCY_ENABLED=1 -s ROBOTSTXT_OBEY=0
+#
+# --rate-limit answers 429 (with Retry-After) once more than that many requests arrive within one second,
+# --max-inflight answers 429 once more than that many requests are being served at the same time, and
+# --throttle-orgid always answers 429 for the charity page of that orgid (a page that fails after every retry).
+
+import argparse
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SITE_URL = 'https://www.charitynavigator.org'
+CHARITY_FIXTURES = ['charity_rated.html', 'charity_unrated.html', 'charity_missing_location.html', 'charity_missing_comp.html']
+
+
+class StandInState(object):
+
+    def __init__(self, base_url, latency, jitter, rate_limit, max_inflight, retry_after, throttled_orgids=()):
+        self.base_url = base_url
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.max_inflight = max_inflight
+        self.retry_after = retry_after
+        self.throttled_orgids = set(throttled_orgids)
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.window_count = 0
+        self.inflight = 0
+        self.served = 0
+        self.throttled = 0
+        self.pages = {}
+        for file_name in os.listdir(FIXTURE_DIR):
+            with open(os.path.join(FIXTURE_DIR, file_name)) as f:
+                self.pages[file_name] = f.read().replace(SITE_URL, base_url)
+
+    # returns False if the request should be answered with a 429
+    def admit(self, query):
+        with self.lock:
+            if query.get('bay', [''])[0] == 'search.summary' and query.get('orgid', [''])[0] in self.throttled_orgids:
+                self.throttled += 1
+                return False
+            now = time.time()
+            if now - self.window_start >= 1.0:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            if (self.rate_limit and self.window_count > self.rate_limit) or \
+                    (self.max_inflight and self.inflight >= self.max_inflight):
+                self.throttled += 1
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.inflight -= 1
+            self.served += 1
+
+    def page_for(self, query):
+        bay = query.get('bay', [''])[0]
+        if bay == 'search.alpha':
+            letter = query.get('ltr', [None])[0]
+            if letter is None:
+                return self.pages['search_alpha.html']
+            # give every letter its own charity urls so the directories don't all dedupe to the same pages
+            offset = (ord(letter[0].upper()) - ord('A') + 1) * 1000
+            return re.sub(r'orgid=(\d+)', lambda m: 'orgid=%d' % (int(m.group(1)) + offset), self.pages['directory_a.html'])
+        if bay == 'search.summary':
+            orgid = int(query.get('orgid', ['0'])[0])
+            return self.pages[CHARITY_FIXTURES[orgid % len(CHARITY_FIXTURES)]]
+        return None
+
+
+def make_handler(state):
+
+    class StandInHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            if not state.admit(query):
+                self.send_response(429)
+                self.send_header('Retry-After', str(state.retry_after))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            try:
+                time.sleep(max(0.0, state.latency + random.uniform(-state.jitter, state.jitter)))
+                page = state.page_for(query)
+                if page is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = page.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            finally:
+                state.release()
+
+        def log_message(self, format, *args):
+            pass
+
+    return StandInHandler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for the charity site with latency and throttling')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='uniform +/- seconds around the latency')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests per second before answering 429 (0 = off)')
+    parser.add_argument('--max-inflight', type=int, default=0, help='concurrent requests before answering 429 (0 = off)')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429')
+    parser.add_argument('--throttle-orgid', action='append', default=[],
+                        help='always answer 429 for the charity page of this orgid (repeatable)')
+    args = parser.parse_args(argv)
+
+    state = StandInState('http://%s:%d' % (args.host, args.port), args.latency, args.jitter, args.rate_limit,
+                         args.max_inflight, args.retry_after, args.throttle_orgid)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print('serving fixtures on http://%s:%d (latency %.2fs, rate limit %s/s, max in-flight %s)' % (
+        args.host, args.port, args.latency, args.rate_limit or '-', args.max_inflight or '-'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('served %d pages, throttled %d requests' % (state.served, state.throttled))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,17 @@
+import os
+import re
+import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 import plotly.graph_objects as go
-import chart_studio.plotly as py
-from plotly.offline import plot
 import plotly.express as px
-from scipy import stats
+import charity_cube
+import charity_stats
 
 
 # key operations in this file:
 #     distribution of charities by location (maybe show a map visual) (done - maybe can zoom into counties)
-#     distribution by location by category (11 categories - maybe can show a map with most frequent category by state) (need to figure this out)
+#     distribution by location by category (11 categories - maybe can show a map with most frequent category by state) (done - see create_category_map)
 #     distribution of categories and within it distribution by rating (done)
 #     average score by state on a map (done) - maybe change this to rating?
 #     distribution of revenue, cost, net assets, etc. (done - need to remove outliers)
@@ -17,34 +19,139 @@ from scipy import stats
 #     relationship between score and number of items on 990 / website
 #     relationship between compensation of executives and overall financial standing (need to re-scrape to get comp info)
 #     typical distribution of the expenses and revenue into categories
-#     statistical significance of different states or categories that have higher average ratings
+#     statistical significance of different states or categories that have higher average ratings (done - see charity_stats.group_tests)
+#
+# charts are rendered offline into chart_dir, one file per chart and format (html, or png / svg / pdf with kaleido)
+# histograms are binned and large scatters aggregated into a grid with numpy first, so a figure holds one value per
+# bin instead of every charity and the files stay small whatever the size of the dataset
 
-def create_state_map(df, field_name, title, statistic, color_scheme, by_pop=False):
-    state_pop = {'CA': 39.6, 'TX': 29.7, 'FL': 21.2, 'NY': 19.5, 'PA': 12.8, 'IL': 12.7, 'OH': 11.7, 'GA': 10.5, 'NC': 10.3, 'MI': 10.0,
-                 'NJ': 8.9, 'VA': 8.5, 'WA': 7.5, 'AZ': 7.2, 'MA': 6.9, 'TN': 6.8, 'IN': 6.7, 'MO': 6.1, 'MD': 6.0, 'WI': 5.8,
-                 'CO': 5.7, 'MN': 5.6, 'SC': 5.1, 'AL': 4.9, 'LA': 4.7, 'KY': 4.5, 'OR': 4.2, 'OK': 3.9, 'CT': 3.6, 'PR': 3.2,
-                 'UT': 3.2, 'IA': 3.2, 'NV': 3.0, 'AR': 3.0, 'MS': 3.0, 'KS': 2.9, 'NM': 2.1, 'NE': 1.9, 'WV': 1.8, 'ID': 1.8,
-                 'HI': 1.4, 'NH': 1.4, 'ME': 1.3, 'MT': 1.1, 'RI': 1.1, 'DE': 1.0, 'SD': 0.9, 'ND': 0.8, 'AK': 0.7, 'DC': 0.7,
-                 'VT': 0.6, 'WY': 0.6, 'VI': 0.1}
+chart_dir = 'charts'
+chart_formats = ['html']
+# scatters with more points than this are drawn as a density grid of scatter_bins x scatter_bins cells
+scatter_max_points = 5000
+scatter_bins = 100
+# upper bound on the number of histogram bins picked automatically
+max_bins = 200
 
-    py.sign_in('kobzajj', 'pBtRNtdf8xHNSz5l9KmB')
 
-    # the territories are not on the mape so take them out (DC is also an outlier with 600+ charities per million)
-    df = df[(df.location_state != 'PR') & (df.location_state != 'VI') & (df.location_state != 'DC')]
+def chart_name(title):
+    return re.sub('[^a-z0-9]+', '_', title.lower()).strip('_')
 
-    df_group = df[df['location_state'].isnull() == False]
-    group_functions = {field_name: [statistic]}
-    df_group = df_group.groupby('location_state')
-    analysis = df_group.agg(group_functions)
+
+# write a figure to chart_dir in every chart_formats, returns the paths written
+# the html files share one plotly.min.js in chart_dir instead of embedding it, and need no network access
+def render(fig, title):
+    if not os.path.exists(chart_dir):
+        os.makedirs(chart_dir)
+    paths = []
+    for fmt in chart_formats:
+        path = os.path.join(chart_dir, chart_name(title) + '.' + fmt)
+        if fmt == 'html':
+            fig.write_html(path, include_plotlyjs='directory')
+        else:
+            # static images need the kaleido package
+            fig.write_image(path)
+        paths.append(path)
+    return paths
+
+
+def bin_edges(values, nbins=None, log=False):
+    if log:
+        values = np.log10(values)
+    edges = np.histogram_bin_edges(values, bins=nbins if nbins else 'auto')
+    if not nbins and len(edges) > max_bins + 1:
+        edges = np.histogram_bin_edges(values, bins=max_bins)
+    return 10 ** edges if log else edges
+
+
+# counts per bin (numeric fields) or per value (anything else), one column per stack value
+# returns the bin centers / values, the counts frame and, for numeric fields, the bin widths
+def binned_counts(df, field_name, stack_field=None, log_x=False, nbins=None):
+    values = df[field_name]
+    stacks = df[stack_field] if stack_field is not None else pd.Series('', index=df.index)
+    if not pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+        counts = pd.crosstab(values.astype(object), stacks)
+        # bars in order of first appearance, like px.histogram
+        counts = counts.reindex(pd.unique(values.astype(object)))
+        return list(counts.index), counts, None
+    numbers = values.to_numpy(dtype='float64', na_value=np.nan)
+    if log_x:
+        keep = numbers > 0
+        numbers = numbers[keep]
+        stacks = stacks[keep]
+    edges = bin_edges(numbers, nbins, log_x)
+    bins = np.clip(np.searchsorted(edges, numbers, side='right') - 1, 0, len(edges) - 2)
+    counts = pd.crosstab(bins, stacks.to_numpy()).reindex(range(len(edges) - 1), fill_value=0)
+    centers = np.sqrt(edges[:-1] * edges[1:]) if log_x else (edges[:-1] + edges[1:]) / 2
+    return centers, counts, np.diff(edges)
+
+
+# aggregate the (x, y) points of a frame into a grid, returns the cell centers and the number of points per cell for
+# the occupied cells only
+def density_grid(x_values, y_values, log_x=False, log_y=False, bins=None):
+    bins = bins or scatter_bins
+    x_values = np.log10(x_values) if log_x else x_values
+    y_values = np.log10(y_values) if log_y else y_values
+    counts, x_edges, y_edges = np.histogram2d(x_values, y_values, bins=bins)
+    ix, iy = np.nonzero(counts)
+    x_centers = ((x_edges[:-1] + x_edges[1:]) / 2)[ix]
+    y_centers = ((y_edges[:-1] + y_edges[1:]) / 2)[iy]
+    if log_x:
+        x_centers = 10 ** x_centers
+    if log_y:
+        y_centers = 10 ** y_centers
+    # single precision is plenty for the position of a cell on screen, and halves the figure
+    return x_centers.astype(np.float32), y_centers.astype(np.float32), counts[ix, iy].astype(np.int32)
+
+
+# scatter traces of df[x] against df[y], one per stack value, with the raw points for small frames and density
+# cells (marker size by the number of charities in the cell) beyond scatter_max_points
+def scatter_traces(df, x, y, log_x=False, log_y=False, stack_field=None, color=None):
+    if log_x:
+        df = df[df[x] > 0]
+    if log_y:
+        df = df[df[y] > 0]
+    if stack_field is not None:
+        groups = [(str(value), group) for value, group in df.groupby(stack_field, observed=True, sort=True)]
+    else:
+        groups = [(None, df)]
+    aggregate = len(df) > scatter_max_points
+    traces = []
+    for name, group in groups:
+        x_values = group[x].to_numpy(dtype='float64')
+        y_values = group[y].to_numpy(dtype='float64')
+        marker = dict(color=color) if color is not None else {}
+        if aggregate:
+            x_values, y_values, counts = density_grid(x_values, y_values, log_x, log_y)
+            marker.update(size=np.clip(np.sqrt(counts) * 2, 3, 30).astype(np.float32), sizemode='diameter')
+            traces.append(go.Scattergl(x=x_values, y=y_values, mode='markers', name=name, marker=marker,
+                                       customdata=counts, hovertemplate='%{x}, %{y}: %{customdata} charities'))
+        else:
+            traces.append(go.Scattergl(x=x_values, y=y_values, mode='markers', name=name, marker=marker))
+    return traces
+
+# the territories are not on the map so take them out (DC is also an outlier with 600+ charities per million)
+MAP_EXCLUDED_STATES = ['PR', 'VI', 'DC']
+
+
+# cube: a charity_cube.AggregateCube of the dataset, so several maps share one aggregation (built from df if not given)
+def create_state_map(df, field_name, title, statistic, color_scheme, by_pop=False, cube=None, **filters):
+    if cube is None:
+        if statistic in ('count', 'size'):
+            cube = charity_cube.build_cube(df, fields=[], count_fields=[field_name])
+        else:
+            cube = charity_cube.build_cube(df, fields=[field_name], count_fields=[])
+    analysis = cube.aggregate(field_name, statistic, **filters)
+    analysis = analysis[[state is not None and state not in MAP_EXCLUDED_STATES for state in analysis.index]]
     if by_pop:
-        statistic_pop_ratio = analysis[field_name][statistic] / list(map(lambda x: state_pop[x], df_group.groups.keys()))
+        statistic_pop_ratio = charity_cube.per_million(analysis)
         print(statistic_pop_ratio)
         trc = dict(
             type = 'choropleth',
-            locations = list(df_group.groups.keys()),
+            locations = list(statistic_pop_ratio.index),
             locationmode = 'USA-states',
             colorscale = color_scheme,
-            z = list(statistic_pop_ratio)
+            z = statistic_pop_ratio.to_numpy()
 
         )
         lyt = dict(geo=dict(scope='usa'), title_text='Map of ' + title + ' per Million People by State', paper_bgcolor='rgba(0,0,0,0)',
@@ -52,87 +159,142 @@ def create_state_map(df, field_name, title, statistic, color_scheme, by_pop=Fals
     else:
         trc = dict(
             type='choropleth',
-            locations=list(df_group.groups.keys()),
+            locations=list(analysis.index),
             locationmode='USA-states',
             colorscale=color_scheme,
-            z=list(analysis[field_name][statistic])
+            z=analysis.to_numpy()
         )
         lyt = dict(geo=dict(scope='usa'), title_text='Map of ' + title + ' by State', paper_bgcolor='rgba(0,0,0,0)',
                    plot_bgcolor='rgba(0,0,0,0)')
     map_ = go.Figure(data=[trc], layout=lyt)
-    plot_url = py.plot(map_)
-    # plot(map_)
+    return render(map_, lyt['title_text'])
 
-def plot_distribution(df, field_name, title, stack_field=None, stack_title='', log_x=False, nbins=None):
-    py.sign_in('kobzajj', 'pBtRNtdf8xHNSz5l9KmB')
+def create_category_map(df, cube=None, **filters):
+    # most frequent category in each state, one color per category
+    if cube is None:
+        cube = charity_cube.build_cube(df, fields=[], count_fields=[])
+    top = cube.top_category(**filters)
+    top = top[[state is not None and state not in MAP_EXCLUDED_STATES for state in top.index]]
+    categories = sorted(set(top))
+    colors = px.colors.qualitative.Plotly
+    colorscale = []
+    for i, category in enumerate(categories):
+        colorscale += [[i / len(categories), colors[i % len(colors)]], [(i + 1) / len(categories), colors[i % len(colors)]]]
+    trc = dict(
+        type='choropleth',
+        locations=list(top.index),
+        locationmode='USA-states',
+        z=[categories.index(category) + 0.5 for category in top],
+        zmin=0,
+        zmax=len(categories),
+        colorscale=colorscale or None,
+        text=list(top),
+        hovertemplate='%{location}: %{text}<extra></extra>',
+        colorbar=dict(tickvals=[i + 0.5 for i in range(len(categories))], ticktext=categories)
+    )
+    lyt = dict(geo=dict(scope='usa'), title_text='Map of Most Frequent Charity Category by State',
+               paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)')
+    return render(go.Figure(data=[trc], layout=lyt), lyt['title_text'])
 
+def plot_distribution(df, field_name, title, stack_field=None, stack_title='', log_x=False, nbins=None):
     df_not_missing = df[df[field_name].isnull() == False]
     if stack_field is not None:
         df_not_missing = df_not_missing[df_not_missing[stack_field].isnull() == False]
-        fig = px.histogram(df_not_missing, x=field_name, color=stack_field,
-                           title='Histogram of ' + title + ' Broken Down by ' + stack_title,
-                           labels={field_name: title, stack_field: stack_title}, nbins=nbins)
+        chart_title = 'Histogram of ' + title + ' Broken Down by ' + stack_title
     else:
-        fig = px.histogram(df_not_missing, x=field_name, title='Histogram of ' + title,
-                           labels={field_name: title}, log_x=log_x, nbins=nbins)
-    plot_url = py.plot(fig)
-    # plot(fig)
+        chart_title = 'Histogram of ' + title
+    x_values, counts, widths = binned_counts(df_not_missing, field_name, stack_field, log_x, nbins)
+    fig = go.Figure()
+    colors = px.colors.qualitative.Plotly
+    for i, stack in enumerate(counts.columns):
+        fig.add_trace(go.Bar(x=x_values, y=counts[stack].to_numpy(),
+                             name=str(stack) if stack_field is not None else None,
+                             marker=dict(color=colors[i % len(colors)]),
+                             hovertemplate='%{x}: %{y}<extra></extra>'))
+    fig.update_layout(barmode='stack', bargap=0 if widths is not None else None, title=chart_title,
+                      xaxis_title=title, yaxis_title='count', legend_title_text=stack_title,
+                      showlegend=stack_field is not None)
+    if log_x:
+        fig.update_xaxes(type='log')
+    return render(fig, chart_title)
+
+def fit_text(fit):
+    text = 'R^2 = %.4f, Y = %.3gX + %.4g (n = %d, p = %.2g)' % (fit['r2'], fit['slope'], fit['intercept'], fit['n'],
+                                                               fit['p_value'])
+    if not np.isnan(fit['slope_low']):
+        text += '<br>slope CI [%.3g, %.3g], r CI [%.3f, %.3f]' % (fit['slope_low'], fit['slope_high'], fit['r_low'],
+                                                                fit['r_high'])
+    return text
 
-def plot_relationship(df, x, y, x_title, y_title, log_x=False, log_y=False, stack_field=None, stack_title=''):
-    py.sign_in('kobzajj', 'pBtRNtdf8xHNSz5l9KmB')
 
+def fit_annotation(fit):
+    return dict(xref='paper', yref='paper', x=0.05, y=0.95, xanchor='left', text=fit_text(fit), showarrow=False,
+                font=dict(size=14))
+
+
+# fit: a row of a charity_stats.fit_pairs table for (x, y), shown on the chart
+def plot_relationship(df, x, y, x_title, y_title, log_x=False, log_y=False, stack_field=None, stack_title='', fit=None):
     df_not_missing = df[df[x].isnull() == False]
     df_not_missing = df_not_missing[df_not_missing[y].isnull() == False]
-    fig = px.scatter(df_not_missing, x=x, y=y, title='Relationship Between ' + x_title + ' and ' + y_title,
-                     labels={x: x_title, y: y_title, stack_field: stack_title}, log_x=log_x, log_y=log_y, color=stack_field)
-    plot_url = py.plot(fig)
-    # plot(fig)
+    chart_title = 'Relationship Between ' + x_title + ' and ' + y_title
+    fig = go.Figure(data=scatter_traces(df_not_missing, x, y, log_x, log_y, stack_field))
+    fig.update_layout(title=chart_title, xaxis_title=x_title, yaxis_title=y_title, legend_title_text=stack_title,
+                      showlegend=stack_field is not None)
+    if fit is not None:
+        fig.add_annotation(**fit_annotation(fit))
+    if log_x:
+        fig.update_xaxes(type='log')
+    if log_y:
+        fig.update_yaxes(type='log')
+    return render(fig, chart_title)
 
-def plot_relationship_with_fit(df, x, y, x_title, y_title, log_x=False, log_y=False, stack_field=None, stack_title=''):
-    # Generated linear fit
-    slope, intercept, r_value, p_value, std_err = stats.linregress(df[x], df[y])
-    line = slope * df[x] + intercept
+# fit: the row of a charity_stats.fit_pairs table for (x, y) - fitted here, with bootstrap intervals, if not given
+def plot_relationship_with_fit(df, x, y, x_title, y_title, log_x=False, log_y=False, stack_field=None, stack_title='',
+                               fit=None):
+    df = df[(df[x].isnull() == False) & (df[y].isnull() == False)]
+    x_values = df[x].to_numpy(dtype='float64')
 
     # Creating the dataset, and generating the plot
-    trace1 = go.Scatter(
-        x=df[x],
-        y=df[y],
-        mode='markers',
-        marker=go.Marker(color='rgb(255, 127, 14)'),
-        name='Data'
-    )
+    trace1 = scatter_traces(df, x, y, color='rgb(255, 127, 14)')[0]
+    trace1.name = 'Data'
+    data = [trace1]
+    annotations = []
 
-    trace2 = go.Scatter(
-        x=df[x],
-        y=line,
-        mode='lines',
-        marker=go.Marker(color='rgb(31, 119, 180)'),
-        name='Fit'
-    )
+    # a line needs at least two points - with fewer, only the data is plotted
+    if len(x_values) >= 2:
+        # Generated linear fit
+        if fit is None:
+            fit = charity_stats.lookup_fit(charity_stats.fit_pairs(df, [x], [y]), x, y)
+        # the fit is a straight line, its end points are enough
+        line_x = np.array([x_values.min(), x_values.max()])
+        line = fit['slope'] * line_x + fit['intercept']
+        trace2 = go.Scatter(
+            x=line_x,
+            y=line,
+            mode='lines',
+            marker=dict(color='rgb(31, 119, 180)'),
+            name='Fit'
+        )
+        data.append(trace2)
+        annotations.append(fit_annotation(fit))
 
-    annotation = go.Annotation(
-        x=3.5,
-        y=23.5,
-        text='$R^2 = 0.9551,\\Y = 0.716X + 19.18$',
-        showarrow=False,
-        font=go.Font(size=16)
-    )
     layout = go.Layout(
-        title='Linear Fit in Python',
+        title='Linear Fit of ' + y_title + ' against ' + x_title,
         plot_bgcolor='rgb(229, 229, 229)',
-        xaxis=go.XAxis(zerolinecolor='rgb(255,255,255)', gridcolor='rgb(255,255,255)'),
-        yaxis=go.YAxis(zerolinecolor='rgb(255,255,255)', gridcolor='rgb(255,255,255)'),
-        annotations=[annotation]
+        xaxis=dict(title=x_title, zerolinecolor='rgb(255,255,255)', gridcolor='rgb(255,255,255)'),
+        yaxis=dict(title=y_title, zerolinecolor='rgb(255,255,255)', gridcolor='rgb(255,255,255)'),
+        annotations=annotations
     )
 
-    data = [trace1, trace2]
     fig = go.Figure(data=data, layout=layout)
-    plot_url = py.plot(fig)
-    # plot(fig)
+    return render(fig, layout.title.text)
 
 def plot_bar(df, x, y, x_title, y_title):
-    py.sign_in('kobzajj', 'pBtRNtdf8xHNSz5l9KmB')
     df_not_missing = df[df[x].isnull() == False]
     df_not_missing = df_not_missing[df_not_missing[y].isnull() == False]
-    fig = px.bar(df, x=x, y=y, labels={x: x_title, y: y_title}, title='Bar Chart of ' + x_title + ' against ' + y_title)
-    plot_url = py.plot(fig)
+    # one bar per x value with the total of y, rather than one stacked segment per charity
+    totals = df_not_missing.groupby(x, observed=True, sort=False)[y].sum()
+    chart_title = 'Bar Chart of ' + x_title + ' against ' + y_title
+    fig = px.bar(x=totals.index.astype(str), y=totals.to_numpy(dtype='float64'), labels={'x': x_title, 'y': y_title},
+                 title=chart_title)
+    return render(fig, chart_title)
@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+import charity_metrics
+
+
+# key operations in this file:
+#     aggregate the charities once into a state x category x rating cube of counts, sums, means and variances
+#     answer the state maps (counts, per million people, averages) and the most frequent category by state from it
+#
+# cube = build_cube(charity_df)
+# cube.aggregate('score_overall', 'mean')                          -> average score by state
+# cube.aggregate('name', 'count', category_l1='Animals')           -> animal charities by state
+# per_million(cube.aggregate('name', 'count'))                     -> charities per million people by state
+# cube.top_category()                                              -> most frequent category by state
+
+DIMENSIONS = ['location_state', 'category_l1', 'rating_overall']
+# numeric fields with sums / means / variances in the cube; any other field only gets non-missing counts
+CUBE_FIELDS = ['score_overall', 'score_financial', 'score_acc_trans', 'revenue_total', 'contributions_tot',
+               'expenses_total', 'excess', 'net_assets', 'leader_comp', 'prog_expense_ratio', 'fund_efficiency',
+               'working_capital_ratio']
+COUNT_FIELDS = ['name']
+STATISTICS = ['size', 'count', 'sum', 'mean', 'var', 'std']
+
+# population in millions by state
+STATE_POPULATION = {'CA': 39.6, 'TX': 29.7, 'FL': 21.2, 'NY': 19.5, 'PA': 12.8, 'IL': 12.7, 'OH': 11.7, 'GA': 10.5, 'NC': 10.3, 'MI': 10.0,
+                    'NJ': 8.9, 'VA': 8.5, 'WA': 7.5, 'AZ': 7.2, 'MA': 6.9, 'TN': 6.8, 'IN': 6.7, 'MO': 6.1, 'MD': 6.0, 'WI': 5.8,
+                    'CO': 5.7, 'MN': 5.6, 'SC': 5.1, 'AL': 4.9, 'LA': 4.7, 'KY': 4.5, 'OR': 4.2, 'OK': 3.9, 'CT': 3.6, 'PR': 3.2,
+                    'UT': 3.2, 'IA': 3.2, 'NV': 3.0, 'AR': 3.0, 'MS': 3.0, 'KS': 2.9, 'NM': 2.1, 'NE': 1.9, 'WV': 1.8, 'ID': 1.8,
+                    'HI': 1.4, 'NH': 1.4, 'ME': 1.3, 'MT': 1.1, 'RI': 1.1, 'DE': 1.0, 'SD': 0.9, 'ND': 0.8, 'AK': 0.7, 'DC': 0.7,
+                    'VT': 0.6, 'WY': 0.6, 'VI': 0.1}
+
+
+class AggregateCube(object):
+    # dense arrays over (state, category, rating) - missing values of a dimension are a label of their own (None)
+    # every cell keeps the number of charities, and per field the non-missing count, the sum, the mean and the sum of
+    # squared deviations from the mean; cells are combined with the parallel variance update, so means and variances
+    # of any roll-up are exact
+
+    def __init__(self, labels, size, counts, sums, means, m2):
+        self.labels = labels
+        self.size = size
+        self.counts = counts
+        self.sums = sums
+        self.means = means
+        self.m2 = m2
+        self.results = {}
+
+    def _select(self, filters):
+        index = []
+        for dim in DIMENSIONS:
+            if dim not in filters:
+                index.append(slice(None))
+                continue
+            values = filters[dim]
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            index.append([self.labels[dim].index(value) for value in values if value in self.labels[dim]])
+        return np.ix_(*[range(len(self.labels[dim])) if isinstance(i, slice) else i
+                        for dim, i in zip(DIMENSIONS, index)])
+
+    # statistic of field by one dimension, over the charities matching the filters (dimension=value or a list of
+    # values), as a Series indexed by the labels of the dimension
+    # statistics: size (charities), count (non-missing values), sum, mean, var and std (sample, like pandas)
+    # results are memoized, so asking for the same map again is a dict lookup
+    def aggregate(self, field, statistic, by='location_state', **filters):
+        key = (field, statistic, by, tuple(sorted((dim, tuple(value) if isinstance(value, (list, tuple, set)) else value)
+                                                  for dim, value in filters.items())))
+        result = self.results.get(key)
+        if result is None:
+            result = self.results[key] = self._aggregate(field, statistic, by, filters)
+        return result.copy()
+
+    def _aggregate(self, field, statistic, by, filters):
+        if statistic not in STATISTICS:
+            raise ValueError('unknown statistic %s, expected one of %s' % (statistic, ', '.join(STATISTICS)))
+        unknown = [dim for dim in filters if dim not in DIMENSIONS]
+        if unknown:
+            raise ValueError('unknown dimensions: %s' % ', '.join(unknown))
+        select = self._select(filters)
+        axis = DIMENSIONS.index(by)
+        other = tuple(i for i in range(len(DIMENSIONS)) if i != axis)
+        labels = self.labels[by] if by not in filters else [self.labels[by][i] for i in select[axis].ravel()]
+
+        if statistic == 'size':
+            values = self.size[select].sum(axis=other)
+        elif statistic == 'count':
+            values = self.counts[field][select].sum(axis=other)
+        else:
+            if field not in self.sums:
+                raise ValueError('%s has no sums in the cube (see CUBE_FIELDS)' % field)
+            n = self.counts[field][select]
+            total = n.sum(axis=other)
+            if statistic == 'sum':
+                values = self.sums[field][select].sum(axis=other)
+            else:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    mean = self.sums[field][select].sum(axis=other) / total
+                    if statistic == 'mean':
+                        values = mean
+                    else:
+                        deviation = self.means[field][select] - np.expand_dims(mean, other)
+                        m2 = (self.m2[field][select] + n * np.nan_to_num(deviation) ** 2).sum(axis=other)
+                        values = np.where(total > 1, m2 / (total - 1), np.nan)
+                        if statistic == 'std':
+                            values = np.sqrt(values)
+        return pd.Series(values, index=pd.Index(labels, dtype=object, name=by), name=field)
+
+    # the category with the most charities in each state (ties go to the first category in sorted order)
+    # charities without a category are left out, a state with only those has no top category
+    def top_category(self, **filters):
+        select = self._select(filters)
+        categories = [self.labels['category_l1'][i] for i in select[1].ravel()]
+        known = [i for i, category in enumerate(categories) if category is not None]
+        by_category = self.size[select].sum(axis=2)[:, known]
+        categories = [categories[i] for i in known]
+        states = [self.labels['location_state'][i] for i in select[0].ravel()]
+        winners = by_category.argmax(axis=1) if categories else np.zeros(len(states), dtype=np.intp)
+        top = pd.Series([categories[i] if categories else None for i in winners],
+                        index=pd.Index(states, dtype=object, name='location_state'), name='category_l1')
+        return top[by_category.sum(axis=1) > 0]
+
+
+def per_million(series):
+    # divide a statistic by state by the population of the state (states without a population are dropped)
+    population = series.index.map(STATE_POPULATION)
+    return (series / np.asarray(population, dtype='float64'))[population.notna()]
+
+
+def _labels(values):
+    return [None if pd.isnull(value) else value.item() if hasattr(value, 'item') else value for value in values]
+
+
+def build_cube(df, fields=CUBE_FIELDS, count_fields=COUNT_FIELDS):
+    labels = {}
+    codes = []
+    for dim in DIMENSIONS:
+        code, uniques = pd.factorize(df[dim], sort=True, use_na_sentinel=False)
+        labels[dim] = _labels(uniques)
+        codes.append(code)
+    shape = tuple(len(labels[dim]) for dim in DIMENSIONS)
+    cell = np.ravel_multi_index(codes, shape) if len(df) else np.zeros(0, dtype=np.intp)
+    n_cells = int(np.prod(shape))
+
+    size = np.bincount(cell, minlength=n_cells).reshape(shape)
+    counts = {}
+    sums = {}
+    means = {}
+    m2 = {}
+    # the fields can be columns of the frame or derived metrics (charity_metrics)
+    metrics = charity_metrics.metrics_for(df)
+    for field in list(count_fields) + [f for f in fields if f in metrics]:
+        if field in count_fields:
+            present = df[field].notna().to_numpy()
+            counts[field] = np.bincount(cell[present], minlength=n_cells).reshape(shape)
+            continue
+        values = metrics.values(field)
+        present = ~np.isnan(values)
+        counts[field] = np.bincount(cell[present], minlength=n_cells).reshape(shape)
+        values = values[present]
+        sums[field] = np.bincount(cell[present], weights=values, minlength=n_cells).reshape(shape)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[field] = sums[field] / counts[field]
+        deviation = values - means[field].ravel()[cell[present]]
+        m2[field] = np.bincount(cell[present], weights=deviation * deviation, minlength=n_cells).reshape(shape)
+    return AggregateCube(labels, size, counts, sums, means, m2)
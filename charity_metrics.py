@@ -0,0 +1,189 @@
+import weakref
+import numpy as np
+import pandas as pd
+
+
+# key operations in this file:
+#     registry of named metrics derived from the scraped fields (financial ratios, log scales, ...), with the fields or
+#     other metrics each one is computed from
+#     compute a metric only when it is first used, and keep it until one of its inputs changes
+#
+# metrics = metrics_for(charity_df)
+# metrics['prog_expense_ratio']                           -> Series aligned to charity_df, computed on first access
+# column(charity_df, 'fund_efficiency')                   -> a column of the frame, or the metric of that name
+# metrics.extend(['log_revenue'])                         -> the frame with the metrics added as columns (a new frame)
+# metrics.invalidate('revenue_total')                     -> after changing a column in place
+
+METRICS = {}
+
+
+class Metric(object):
+
+    def __init__(self, name, inputs, compute, description=''):
+        self.name = name
+        self.inputs = inputs
+        self.compute = compute
+        self.description = description
+
+
+# register compute(*inputs) as a metric: it gets its inputs as float64 arrays (missing values as NaN) and returns
+# an array of the same length
+def metric(name, inputs, description=''):
+    def register(compute):
+        METRICS[name] = Metric(name, list(inputs), compute, description)
+        return compute
+    return register
+
+
+# numerator / denominator, NaN where either is missing or the denominator is zero (instead of inf)
+def safe_divide(numerator, denominator):
+    result = np.full(np.shape(numerator), np.nan)
+    np.divide(numerator, denominator, out=result, where=(denominator != 0) & ~np.isnan(denominator))
+    return result
+
+
+@metric('prog_expense_ratio', ['expenses_program', 'expenses_total'],
+        'program expense ratio - percent of total expenses spent on services delivered')
+def prog_expense_ratio(expenses_program, expenses_total):
+    return safe_divide(expenses_program, expenses_total)
+
+
+@metric('fund_efficiency', ['expenses_fundraising', 'contributions_tot'],
+        'fundraising efficiency - fundraising expenses divided by total contributions')
+def fund_efficiency(expenses_fundraising, contributions_tot):
+    return safe_divide(expenses_fundraising, contributions_tot)
+
+
+@metric('working_capital_ratio', ['net_assets', 'expenses_total'],
+        'working capital ratio (years) - number of years the charity can sustain itself from its net assets')
+def working_capital_ratio(net_assets, expenses_total):
+    return safe_divide(net_assets, expenses_total)
+
+
+@metric('admin_expense_ratio', ['expenses_admin', 'expenses_total'],
+        'administrative expenses as a share of total expenses')
+def admin_expense_ratio(expenses_admin, expenses_total):
+    return safe_divide(expenses_admin, expenses_total)
+
+
+@metric('fundraising_expense_ratio', ['expenses_fundraising', 'expenses_total'],
+        'fundraising expenses as a share of total expenses')
+def fundraising_expense_ratio(expenses_fundraising, expenses_total):
+    return safe_divide(expenses_fundraising, expenses_total)
+
+
+@metric('log_revenue', ['revenue_total'], 'log base 10 of total revenue (missing for zero or negative revenue)')
+def log_revenue(revenue_total):
+    result = np.full(np.shape(revenue_total), np.nan)
+    np.log10(revenue_total, out=result, where=revenue_total > 0)
+    return result
+
+
+class _Same(object):
+    # equal to another _Same of the same object while that object exists, without keeping it alive
+    __slots__ = ('ref',)
+
+    def __init__(self, obj):
+        self.ref = weakref.ref(obj)
+
+    def __eq__(self, other):
+        return isinstance(other, _Same) and self.ref() is not None and self.ref() is other.ref()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+
+# identifies the data behind a column, so a column that was replaced (df[name] = ...) isn't mistaken for the old one:
+# an extension column (Int64, ...) keeps the same array object until it is replaced, and a numpy column is a view of
+# the array holding the frame's block (changing values in place keeps both, hence invalidate())
+def _data_token(series):
+    if not isinstance(series.dtype, np.dtype):
+        return _Same(series.array)
+    data = series.to_numpy(copy=False)
+    base = data
+    while isinstance(base.base, np.ndarray):
+        base = base.base
+    return _Same(base), data.__array_interface__['data'][0], data.shape, data.dtype.str
+
+
+class DerivedMetrics(object):
+    # lazily computed metrics of one frame
+    # every computed metric is kept with the versions of the columns it was computed from; a column's version changes
+    # when the column is replaced or invalidate() is called for it (needed after changing values in place), and the
+    # metrics depending on it are then recomputed on their next access
+
+    def __init__(self, df):
+        self.df = weakref.ref(df)
+        self.versions = {}
+        self.memo = {}
+
+    def frame(self):
+        df = self.df()
+        if df is None:
+            raise ReferenceError('the frame of these metrics no longer exists')
+        return df
+
+    def _token(self, name, df):
+        if name in METRICS and name not in df.columns:
+            return tuple(self._token(input_name, df) for input_name in METRICS[name].inputs)
+        if name not in df.columns:
+            raise KeyError('%s is neither a column nor a registered metric' % name)
+        return self.versions.get(name, 0), _data_token(df[name])
+
+    def values(self, name):
+        # the metric (or column) as a float64 array
+        df = self.frame()
+        if name not in METRICS or name in df.columns:
+            if name not in df.columns:
+                raise KeyError('%s is neither a column nor a registered metric' % name)
+            return df[name].to_numpy(dtype='float64', na_value=np.nan)
+        token = self._token(name, df)
+        memo = self.memo.get(name)
+        if memo is not None and memo[0] == token:
+            return memo[1]
+        values = METRICS[name].compute(*[self.values(input_name) for input_name in METRICS[name].inputs])
+        values.setflags(write=False)
+        self.memo[name] = (token, values)
+        return values
+
+    def __getitem__(self, name):
+        return pd.Series(self.values(name), index=self.frame().index, name=name)
+
+    def __contains__(self, name):
+        return name in METRICS or name in self.frame().columns
+
+    def invalidate(self, *columns):
+        for name in columns:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+    # a new frame with the given metrics added as columns (the frame itself is not changed)
+    def extend(self, names):
+        df = self.frame()
+        names = [name for name in names if name not in df.columns]
+        if not names:
+            return df
+        return pd.concat([df, pd.DataFrame(dict((name, self.values(name).copy()) for name in names), index=df.index)],
+                         axis=1)
+
+
+# one DerivedMetrics per frame, dropped with the frame
+_frames = {}
+
+
+def metrics_for(df):
+    key = id(df)
+    entry = _frames.get(key)
+    if entry is not None and entry.df() is df:
+        return entry
+    entry = _frames[key] = DerivedMetrics(df)
+    weakref.finalize(df, _frames.pop, key, None)
+    return entry
+
+
+# a column of the frame, or the registered metric of that name
+def column(df, name):
+    if name in df.columns:
+        return df[name]
+    return metrics_for(df)[name]
@@ -1,13 +1,20 @@
+import array
+import functools
+import hashlib
+import multiprocessing
 import pandas as pd
 import re
+import sqlite3
+import time
 from nltk.corpus import stopwords
 from nltk import WordNetLemmatizer
 from nltk.stem import PorterStemmer
 from textblob import TextBlob
-from wordcloud import WordCloud
+from wordcloud import WordCloud, STOPWORDS
 import matplotlib.pyplot as plt
 from PIL import Image
 import numpy as np
+from scipy import sparse
 
 
 # key operations in this file:
@@ -15,64 +22,271 @@ import numpy as np
 #     create wordcloud for the charities' mission text
 #     compare mission text using comparison wordcloud across different charity categories
 #     show relationship between charity mission polarity / subjectivity and rating
+#
+# normalized text and sentiment can be kept in an NlpCache between runs, so a refreshed dataset only pays for the
+# missions that are new or changed
 
 
-def preprocess_text(df, field_name):
+# stem the text to normalize verb tenses, etc. - these words get a fixed stem instead of the porter stem
+# (custom_words is matched position by position against custom_stems, which is longer because of the joined entries)
+custom_words = ['families', 'family', 'community', 'communities', 'volunteers', 'volunteer', 'provider', 'provides' 'provided', 'provide',
+                'providing', 'providers', 'education', 'educated', 'educating', 'educates' 'educate', 'educational', 'foundational',
+                'foundations', 'foundation', 'includes', 'include', 'including', 'inclusive', 'inclusion',
+                'institution', 'institutional', 'institute' 'institutes', 'instituted', 'animal', 'animals', 'unity',
+                'unite', 'unites', 'united']
+custom_stems = ['family', 'family', 'community', 'community', 'volunteer', 'volunteer', 'provide', 'provide', 'provide', 'provide',
+                'provides', 'provides', 'educate', 'educate', 'educate', 'educate', 'educate', 'educate', 'foundation',
+                'foundation', 'foundation', 'include', 'include', 'include', 'include', 'include',
+                'institute', 'institute', 'institute', 'institute', 'institute', 'animal', 'animals', 'unite',
+                'unite', 'unite', 'unite']
+
+punctuation_re = re.compile(r'[^\w\s]')
+# the tokens of WordCloud.process_text (with its default min_word_length)
+wordcloud_token_re = re.compile(r"\w[\w']*")
+
+
+class TextNormalizer(object):
+    # remove punctuation -> tokenize -> drop stop words -> lemmatize -> custom stem or porter stem, in one pass per
+    # (already lower cased) text. Every distinct token is normalized once and memoized, so the lemmatizer and stemmer only ever see
+    # the vocabulary, not every occurrence.
+
+    def __init__(self):
+        self.stop = set(stopwords.words('english'))
+        self.custom = {}
+        for word, stem in zip(custom_words, custom_stems):
+            self.custom.setdefault(word, stem)
+        self.lemtzr = WordNetLemmatizer()
+        self.stemmer = PorterStemmer()
+        self.cache = {}
+
+    def normalize_word(self, word):
+        normalized = self.cache.get(word)
+        if normalized is None:
+            if word in self.stop:
+                normalized = ''
+            else:
+                normalized = ' '.join(self.custom[lemma] if lemma in self.custom else self.stemmer.stem(lemma)
+                                      for lemma in self.lemtzr.lemmatize(word).split())
+            self.cache[word] = normalized
+        return normalized
+
+    def normalize(self, text):
+        words = punctuation_re.sub('', str(text)).split()
+        return ' '.join(w for w in map(self.normalize_word, words) if w)
+
+    def normalize_all(self, texts):
+        return [self.normalize(text) for text in texts]
+
+
+# bump when the normalization or the sentiment scoring changes, so an existing NlpCache is cleared
+NLP_CACHE_VERSION = 1
+
+
+# cache key of a raw mission text (None for missing values, which are cheap and not cached)
+def text_key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest() if isinstance(text, str) else None
+
+
+class NlpCache(object):
+    # SQLite cache of the NLP results per raw mission text: the normalized text (preprocess_text) and the TextBlob
+    # polarity / subjectivity of it (sentiment_analysis), keyed by text_key. Every lookup marks the entries it hits as
+    # used, and evict() drops the least recently used entries beyond max_entries.
+
+    def __init__(self, path, max_entries=500000):
+        self.path = path
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] != NLP_CACHE_VERSION:
+            self.conn.execute('DROP TABLE IF EXISTS missions')
+            self.conn.execute('PRAGMA user_version = %d' % NLP_CACHE_VERSION)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS missions ('
+                          'key TEXT PRIMARY KEY, nlp TEXT, polarity REAL, subjectivity REAL, used REAL) WITHOUT ROWID')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS missions_used ON missions (used)')
+        self.conn.commit()
+
+    def _lookup(self, columns, keys, batch_size=500):
+        found = {}
+        keys = list(set(keys))
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            query = 'SELECT key, %s FROM missions WHERE key IN (%s) AND %s IS NOT NULL' % (
+                ', '.join(columns), ','.join('?' * len(batch)), columns[0])
+            for row in self.conn.execute(query, batch):
+                found[row[0]] = row[1] if len(columns) == 1 else row[1:]
+        now = time.time()
+        self.conn.executemany('UPDATE missions SET used = ? WHERE key = ?', [(now, key) for key in found])
+        return found
+
+    # {key: normalized text} for the keys in the cache
+    def get_nlp(self, keys):
+        return self._lookup(['nlp'], keys)
+
+    # {key: (polarity, subjectivity)} for the keys in the cache
+    def get_sentiment(self, keys):
+        return self._lookup(['polarity', 'subjectivity'], keys)
+
+    def put_nlp(self, entries):
+        now = time.time()
+        self.conn.executemany('INSERT INTO missions (key, nlp, used) VALUES (?, ?, ?) '
+                              'ON CONFLICT (key) DO UPDATE SET nlp = excluded.nlp, used = excluded.used',
+                              [(key, nlp, now) for key, nlp in entries])
+
+    def put_sentiment(self, entries):
+        now = time.time()
+        self.conn.executemany('INSERT INTO missions (key, polarity, subjectivity, used) VALUES (?, ?, ?, ?) '
+                              'ON CONFLICT (key) DO UPDATE SET polarity = excluded.polarity, '
+                              'subjectivity = excluded.subjectivity, used = excluded.used',
+                              [(key, polarity, subjectivity, now) for key, (polarity, subjectivity) in entries])
+
+    # drop the least recently used entries beyond max_entries, returns how many were dropped
+    def evict(self):
+        excess = self.conn.execute('SELECT COUNT(*) FROM missions').fetchone()[0] - self.max_entries
+        if excess <= 0:
+            return 0
+        self.conn.execute('DELETE FROM missions WHERE key IN (SELECT key FROM missions ORDER BY used LIMIT ?)', (excess,))
+        return excess
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.evict()
+        self.conn.commit()
+        self.conn.close()
+
+
+# look up values in the cache by the raw texts, compute the misses with compute(positions) and store them
+# returns the values in the order of raw_texts
+def _cached(raw_texts, cache, get, put, compute):
+    keys = [text_key(text) for text in raw_texts]
+    found = get(key for key in keys if key is not None)
+    misses = [i for i, key in enumerate(keys) if key not in found]
+    computed = compute(misses)
+    values = [found.get(key) for key in keys]
+    for i, value in zip(misses, computed):
+        values[i] = value
+    put(dict((keys[i], value) for i, value in zip(misses, computed) if keys[i] is not None).items())
+    cache.evict()
+    cache.commit()
+    return values
+
+
+# per worker process normalizer, so each worker builds its cache once for all the chunks it handles
+_normalizer = None
+
+
+def _normalize_chunk(texts):
+    global _normalizer
+    if _normalizer is None:
+        _normalizer = TextNormalizer()
+    return _normalizer.normalize_all(texts)
+
+
+def _normalize_texts(texts, processes, chunk_size):
+    if processes == 1 or len(texts) <= chunk_size:
+        return TextNormalizer().normalize_all(texts)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    with multiprocessing.Pool(processes) as pool:
+        return [text for chunk in pool.map(_normalize_chunk, chunks) for text in chunk]
+
+
+# normalize the text in field_name into field_name + '_nlp'
+# large frames are split into chunks of chunk_size texts and normalized on all cores (processes=None) - pass
+# processes=1 to stay in this process. With a cache (NlpCache) only the texts it doesn't have yet are normalized.
+def preprocess_text(df, field_name, processes=None, chunk_size=5000, cache=None):
     new_field = field_name + "_nlp"
-    # make all lower case
-    df[new_field] = df[field_name].str.lower()
-    # remove white space
-    df[new_field] = df[new_field].apply(lambda x: re.sub('\s+', ' ', str(x)))
-    # remove punctuation
-    df[new_field] = df[new_field].apply(lambda x: re.sub('[^\w\s]', '', str(x)))
-    # remove stop words
-    stop = stopwords.words('english')
-    df[new_field] = df[new_field].apply(lambda text: " ".join(word for word in text.split() if word not in stop))
-    # lemmatize the text so different suffixes of the same root can be compared
-    lemtzr = WordNetLemmatizer()
-    df[new_field] = df[new_field].apply(lambda text: " ".join(lemtzr.lemmatize(word) for word in text.split()))
-    # stem the text to normalize verb tenses, etc.
-    custom_words = ['families', 'family', 'community', 'communities', 'volunteers', 'volunteer', 'provider', 'provides' 'provided', 'provide',
-                    'providing', 'providers', 'education', 'educated', 'educating', 'educates' 'educate', 'educational', 'foundational',
-                    'foundations', 'foundation', 'includes', 'include', 'including', 'inclusive', 'inclusion',
-                    'institution', 'institutional', 'institute' 'institutes', 'instituted', 'animal', 'animals', 'unity',
-                    'unite', 'unites', 'united']
-    custom_stems = ['family', 'family', 'community', 'community', 'volunteer', 'volunteer', 'provide', 'provide', 'provide', 'provide',
-                    'provides', 'provides', 'educate', 'educate', 'educate', 'educate', 'educate', 'educate', 'foundation',
-                    'foundation', 'foundation', 'include', 'include', 'include', 'include', 'include',
-                    'institute', 'institute', 'institute', 'institute', 'institute', 'animal', 'animals', 'unite',
-                    'unite', 'unite', 'unite']
-    stemmer = PorterStemmer()
-    df[new_field] = df[new_field].apply(lambda text: " ".join(
-        custom_stems[custom_words.index(word)] if word in custom_words else stemmer.stem(word) for word in text.split()))
+    # lower case the whole column at once; missing values come through as the strings 'nan' / 'None'
+    texts = df[field_name].str.lower().tolist()
+    if cache is None:
+        normalized = _normalize_texts(texts, processes, chunk_size)
+    else:
+        normalized = _cached(df[field_name].tolist(), cache, cache.get_nlp, cache.put_nlp,
+                             lambda misses: _normalize_texts([texts[i] for i in misses], processes, chunk_size))
+    df[new_field] = pd.Series(normalized, index=df.index, dtype=object)
     return df
 
+# white (255) background for the mask: palette index 0 becomes 255
 def transform_mask(mask):
-    def transform_format(val):
-        if val == 0:
-            return 255
-        else:
-            return val
-    transformed_mask = np.zeros((mask.shape[0], mask.shape[1]), dtype=np.int32)
-    for i in range(len(mask)):
-        transformed_mask[i] = list(map(transform_format, mask[i]))
-    return transformed_mask
-
-def create_wordcloud(df, field_name, data_subset, mask_image=None):
+    return np.where(mask == 0, 255, mask).astype(np.int32)
+
+
+# category masks are loaded and transformed once per process; the cached arrays are read-only
+@functools.lru_cache(maxsize=None)
+def load_mask(mask_image):
     transform_exceptions = ['Environment']
+    mask = np.array(Image.open("images/" + mask_image + ".png").convert('P'))
+    if mask_image not in transform_exceptions:
+        mask = transform_mask(mask)
+    mask.setflags(write=False)
+    return mask
+
+
+class TermMatrix(object):
+    # sparse group x term counts of a text field, built in one pass over the corpus
+    # the text is tokenized like WordCloud.process_text does it (the same regex, a trailing 's stripped, digit-only
+    # tokens and, case-insensitively, its stop words dropped), so the clouds can be drawn with generate_from_frequencies
+    # instead of re-tokenizing the text for every cloud - but unlike process_text it adds no bigram collocations and
+    # doesn't merge plurals or case variants of a word, so those are drawn as separate single-word terms
+
+    def __init__(self, counts, groups, terms):
+        self.counts = counts
+        self.groups = groups
+        self.terms = terms
+
+    def frequencies(self, group=None):
+        # {term: count} of one group, or of the whole corpus
+        if group is None:
+            row = np.asarray(self.counts.sum(axis=0)).ravel()
+            return dict((self.terms[i], int(row[i])) for i in np.flatnonzero(row))
+        row = self.counts.getrow(self.groups.index(group))
+        return dict((self.terms[i], int(n)) for i, n in zip(row.indices, row.data))
+
+
+# group_field=None counts the whole corpus as one ungrouped row
+def term_matrix(df, field_name='mission_nlp', group_field='category_l1'):
+    if group_field is None:
+        codes, groups = np.full(len(df), -1), []
+    else:
+        codes, groups = pd.factorize(df[group_field], sort=True)
+    stop = set(word.lower() for word in STOPWORDS)
+    vocabulary = {}
+    rows = array.array('l')
+    cols = array.array('l')
+    for code, text in zip(codes, df[field_name].tolist()):
+        # rows without a group (code -1) still count towards the whole corpus, in an extra last row
+        row = code if code >= 0 else len(groups)
+        for token in wordcloud_token_re.findall(text):
+            if token.lower().endswith("'s"):
+                token = token[:-2]
+            if token.isdigit() or token.lower() in stop:
+                continue
+            col = vocabulary.get(token)
+            if col is None:
+                col = vocabulary[token] = len(vocabulary)
+            rows.append(row)
+            cols.append(col)
+    counts = sparse.coo_matrix((np.ones(len(rows), dtype=np.int64),
+                                (np.frombuffer(rows, dtype='l'), np.frombuffer(cols, dtype='l'))),
+                               shape=(len(groups) + 1, len(vocabulary))).tocsr()
+    terms = [None] * len(vocabulary)
+    for term, col in vocabulary.items():
+        terms[col] = term
+    return TermMatrix(counts, list(groups), terms)
+
+
+# frequencies: {term: count} to draw (see TermMatrix), by default counted from df[field_name]
+def create_wordcloud(df, field_name, data_subset, mask_image=None, frequencies=None):
     mask = None
     contour_width = 0
     max_words = 2000
     if mask_image is not None:
-        raw_mask = np.array(Image.open("images/" + mask_image + ".png").convert('P'))
-        if mask_image in transform_exceptions:
-            mask = raw_mask
-        else:
-            mask = transform_mask(raw_mask)
+        mask = load_mask(mask_image)
         contour_width = 3
         max_words = 500
+    if frequencies is None:
+        frequencies = term_matrix(df, field_name, group_field=None).frequencies()
     wc = WordCloud(background_color="white", max_words=max_words, width=800, height=400, mask=mask, contour_width=contour_width)
-    wc.generate(' '.join(df[field_name]))
+    wc.generate_from_frequencies(frequencies)
     plt.figure(figsize=(12, 6))
     plt.imshow(wc, interpolation='bilinear')
     plt.axis("off")
@@ -84,26 +298,69 @@ def create_wordcloud(df, field_name, data_subset, mask_image=None):
     plt.title('Mission Text Wordcloud for ' + data_subset + ' Charities', fontdict=font)
     plt.show()
 
-def compare_wordclouds(df):
+def compare_wordclouds(df, terms=None):
     # generate multiple word clouds to compare the language used by different categories of charities
-    for category_tuple in df.groupby('category_l1'):
-        create_wordcloud(category_tuple[1], 'mission_nlp', category_tuple[0], mask_image=category_tuple[0])
-
-def sentiment_analysis(df, field_name):
-    def sentiment_func(x):
-        sentiment = TextBlob(x['mission_nlp'])
-        x['polarity'] = sentiment.polarity
-        x['subjectivity'] = sentiment.subjectivity
-        return x
-    sa_df = df[df[field_name].isnull() == False]
-    sa_df = sa_df.apply(sentiment_func, axis=1)
-    sa_df.plot.scatter('polarity', field_name, s=1)
+    # all the category clouds are drawn from one term matrix (pass terms to reuse one that is already built)
+    if terms is None:
+        terms = term_matrix(df, 'mission_nlp', 'category_l1')
+    for category in terms.groups:
+        create_wordcloud(None, 'mission_nlp', category, mask_image=category, frequencies=terms.frequencies(category))
+
+def _score_chunk(texts):
+    polarity = np.empty(len(texts), dtype=np.float64)
+    subjectivity = np.empty(len(texts), dtype=np.float64)
+    for i, text in enumerate(texts):
+        sentiment = TextBlob(text).sentiment
+        polarity[i] = sentiment.polarity
+        subjectivity[i] = sentiment.subjectivity
+    return polarity, subjectivity
+
+
+# TextBlob polarity and subjectivity of each text, as two float arrays
+# like preprocess_text, more than chunk_size texts are scored in chunks on all cores (processes=None)
+def score_sentiment(texts, processes=None, chunk_size=5000):
+    if processes == 1 or len(texts) <= chunk_size:
+        return _score_chunk(texts)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    with multiprocessing.Pool(processes) as pool:
+        scores = pool.map(_score_chunk, chunks)
+    return np.concatenate([p for p, _ in scores]), np.concatenate([s for _, s in scores])
+
+
+# polarity and subjectivity of the normalized mission text (mission_nlp, see preprocess_text) of every row of df,
+# as float arrays in the order of the rows
+# with a cache (NlpCache) the scores are looked up by the raw mission text and only the misses are scored
+def sentiment_scores(df, processes=None, chunk_size=5000, cache=None):
+    texts = df['mission_nlp'].tolist()
+    if cache is None:
+        return score_sentiment(texts, processes, chunk_size)
+
+    def score_misses(misses):
+        polarity, subjectivity = score_sentiment([texts[i] for i in misses], processes, chunk_size)
+        return list(zip(polarity.tolist(), subjectivity.tolist()))
+    scores = _cached(df['mission'].tolist(), cache, cache.get_sentiment, cache.put_sentiment, score_misses)
+    return (np.array([p for p, _ in scores], dtype=np.float64),
+            np.array([s for _, s in scores], dtype=np.float64))
+
+
+def plot_sentiment(df, field_name, polarity, subjectivity):
+    plt.figure()
+    plt.scatter(polarity, df[field_name], s=1)
     plt.title('Relationship Between Mission Polarity and Overall Score')
     plt.xlabel('Mission Polarity')
     plt.ylabel('Overall Score')
     plt.show()
-    sa_df.plot.scatter('subjectivity', field_name, s=1)
+    plt.figure()
+    plt.scatter(subjectivity, df[field_name], s=1)
     plt.title('Relationship Between Mission Subjectivity and Overall Score')
     plt.xlabel('Mission Subjectivity')
     plt.ylabel('Overall Score')
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+
+# relationship between mission polarity / subjectivity and field_name, for the rows that have field_name
+def sentiment_analysis(df, field_name, cache=None, processes=None):
+    sa_df = df[df[field_name].isnull() == False]
+    polarity, subjectivity = sentiment_scores(sa_df, processes=processes, cache=cache)
+    plot_sentiment(sa_df, field_name, polarity, subjectivity)
+    return polarity, subjectivity
@@ -1,33 +1,212 @@
+import hashlib
+import json
+import os
+import argparse
+import locale
+import sqlite3
+import sys
+import time
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
-import seaborn as sns
-import charity_nlp as cnlp
-import charity_charts as cc
-import locale
+import charity_metrics
 
 file_name = 'charities.csv'
+# normalized mission text and sentiment of earlier runs (see charity_nlp.NlpCache)
+nlp_cache_file = 'charities.nlp.db'
+# indexed store of the crawl (see charity_scraper.store), queried by read_sqlite
+sqlite_file = 'charities.db'
+sqlite_table = 'charities'
+# delta exports of the crawls (see charity_scraper.delta), read by read_delta
+delta_dir = 'deltas'
 
 # key operations in this file:
-#     read csv file into pandas dataframe
+#     read csv file into pandas dataframe, or query the rows and columns needed from the sqlite store
+#     read the charities added, changed and removed since the previous crawl, for jobs that only process the delta
 #     process the missing values in the dataframe
 #     unpack the attributes from 990 form and website to create booleans for each attribute
-#     calculate key ratios from financial numbers and add to dataframe
+#     calculate key ratios from financial numbers (derived metrics, computed when first used - see charity_metrics)
+#
+# importing this module only defines the loaders and transforms; the reports run from the command line:
+#     python charity_reader.py [--file charities.csv] [--reports summary,missing,charts,nlp]
+# seaborn, charity_charts (plotly, scipy) and charity_nlp (nltk, textblob, wordcloud) are only imported by the
+# reports that use them, so data-only jobs don't pay for them at startup
+
+# explicit schema for the exported csv, so nothing has to be inferred on load:
+#     state and category are categoricals, the financial fields and ratings are nullable ints (unrated charities
+#     leave them empty), and leader_comp is converted to a number after loading (see parse_leader_comp)
+CATEGORY_COLUMNS = ['category_l1', 'category_l2', 'location_state']
+STRING_COLUMNS = ['name', 'tagline', 'location_city', 'location_zip', 'mission', 'leader_comp', 'url']
+FLOAT_COLUMNS = ['score_overall', 'score_financial', 'score_acc_trans']
+INT_COLUMNS = ['rating_overall', 'rating_financial', 'rating_acc_trans', 'attributes_990', 'attributes_website',
+               'contributions_tot', 'contributions_gifts_grants', 'contributions_federated_campaigns',
+               'contributions_membership_dues', 'contributions_fundraising_events', 'contributions_related_organizations',
+               'contributions_government_grants', 'revenue_program_service', 'primary_revenue_total', 'revenue_other',
+               'revenue_total', 'expenses_program', 'expenses_admin', 'expenses_fundraising', 'expenses_total',
+               'affiliate_payments', 'excess', 'net_assets']
+CSV_DTYPES = dict([(c, 'category') for c in CATEGORY_COLUMNS] + [(c, str) for c in STRING_COLUMNS] +
+                  [(c, 'float64') for c in FLOAT_COLUMNS] + [(c, 'Int64') for c in INT_COLUMNS])
+# bump when the schema or parsing above changes, so old cache files are rebuilt
+CACHE_VERSION = 1
+
+
+# leader compensation is scraped as text: a dollar amount, 'Not compensated' (0) or 'None reported' (missing)
+def parse_leader_comp(series):
+    series = series.replace({'Not compensated': '0', 'None reported': None})
+    return pd.to_numeric(series, errors='coerce').astype('Int64')
+
+
+def read_csv_typed(f):
+    df = pd.read_csv(f, header=0, dtype={k: v for k, v in CSV_DTYPES.items()})
+    if 'leader_comp' in df:
+        df['leader_comp'] = parse_leader_comp(df['leader_comp'])
+    return df
+
+
+def file_sha1(f):
+    sha1 = hashlib.sha1()
+    with open(f, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+# read the exported csv with the explicit schema above
+# the typed frame is cached next to the csv (<file>.cache.feather, needs pyarrow) and reused as long as the csv is
+# unchanged: same size and mtime, or - if only the mtime changed - the same sha1
+def read_csv(f, use_cache=True):
+    if not use_cache or not isinstance(f, str):
+        return read_csv_typed(f)
+    cache_path = f + '.cache.feather'
+    meta_path = f + '.cache.json'
+    stat = os.stat(f)
+    meta = None
+    if os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+        if meta.get('version') != CACHE_VERSION or meta.get('size') != stat.st_size:
+            meta = None
+    if meta is not None:
+        if meta.get('mtime_ns') == stat.st_mtime_ns:
+            return pd.read_feather(cache_path)
+        sha1 = file_sha1(f)
+        if meta.get('sha1') == sha1:
+            meta['mtime_ns'] = stat.st_mtime_ns
+            with open(meta_path, 'w') as fh:
+                json.dump(meta, fh)
+            return pd.read_feather(cache_path)
+
+    df = read_csv_typed(f)
+    try:
+        df.to_feather(cache_path)
+    except ImportError:
+        return df
+    with open(meta_path, 'w') as fh:
+        json.dump({'version': CACHE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': file_sha1(f)}, fh)
+    return df
+
+
+# read only the rows and columns an analysis needs from the SQLite store of the crawl (written by
+# charity_scraper.pipelines.SqliteItemPipeline), typed like read_csv
+# filters are column=value (a list or tuple matches any of its values, None matches missing values) and are combined
+# with AND; anything else (ranges, OR) goes in where, with ? placeholders filled from params:
+#     read_sqlite(columns=['name', 'revenue_total'], rating_overall=4, location_state='TX', category_l1='Animals')
+#     read_sqlite(where='revenue_total >= ?', params=[10 ** 7], location_state=['NY', 'NJ'])
+def read_sqlite(f=sqlite_file, columns=None, where=None, params=(), order_by=None, limit=None, **filters):
+    conn = sqlite3.connect('file:%s?mode=ro' % f, uri=True)
+    try:
+        available = [row[1] for row in conn.execute('PRAGMA table_info(%s)' % sqlite_table)]
+        unknown = [c for c in list(columns or []) + list(filters) + ([order_by] if order_by else []) if c not in available]
+        if unknown:
+            raise KeyError('not columns of %s: %s' % (f, ', '.join(unknown)))
+        clauses = []
+        values = []
+        for c, value in filters.items():
+            if value is None:
+                clauses.append('%s IS NULL' % c)
+            elif isinstance(value, (list, tuple, set)):
+                value = list(value)
+                clauses.append('%s IN (%s)' % (c, ', '.join('?' * len(value))))
+                values.extend(value)
+            else:
+                clauses.append('%s = ?' % c)
+                values.append(value)
+        if where:
+            clauses.append('(%s)' % where)
+            values.extend(params)
+        sql = 'SELECT %s FROM %s' % (', '.join(columns) if columns else '*', sqlite_table)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        if order_by:
+            sql += ' ORDER BY %s' % order_by
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        df = pd.read_sql_query(sql, conn, params=values)
+    finally:
+        conn.close()
+    return apply_dtypes(df)
+
+
+# the read_csv schema applied to a frame built from the items themselves (sqlite rows, delta records)
+def apply_dtypes(df):
+    for c in df.columns:
+        if c == 'leader_comp':
+            df[c] = parse_leader_comp(df[c])
+        elif CSV_DTYPES.get(c) is str:
+            df[c] = df[c].astype(object)
+        elif c in CSV_DTYPES:
+            df[c] = df[c].astype(CSV_DTYPES[c])
+    return df
+
 
-def read_csv(f):
-    return pd.read_csv(f, header=0)
+# the newest complete delta export under root (see charity_scraper.delta), or None if there is none yet
+def latest_delta(root=delta_dir):
+    if not os.path.isdir(root):
+        return None
+    crawls = [d for d in os.listdir(root)
+              if not d.endswith('.partial') and os.path.exists(os.path.join(root, d, 'manifest.json'))]
+    if not crawls:
+        return None
+    # crawl ids are start times, with a -<n> suffix for later crawls started in the same second
+    def order(crawl_id):
+        base, _, n = crawl_id.partition('-')
+        return base, int(n) if n.isdigit() else 0
+    return os.path.join(root, max(crawls, key=order))
+
+
+# the charities added, changed and removed by one crawl (the latest one by default), as frames typed like read_csv
+# with a charity_key column; changed charities have their new values and a changed_fields column listing what changed,
+# removed charities their last known values
+def read_delta(path=None):
+    path = path or latest_delta()
+    if path is None:
+        raise IOError('no delta exports in %s' % delta_dir)
+    frames = {}
+    for name in ['added', 'changed', 'removed']:
+        with open(os.path.join(path, name + '.jsonl')) as fh:
+            records = [json.loads(line) for line in fh]
+        df = pd.DataFrame([r['item'] for r in records], columns=None if records else list(CSV_DTYPES))
+        df.insert(0, 'charity_key', [r['key'] for r in records])
+        if name == 'changed':
+            df['changed_fields'] = [sorted(r['changes']) for r in records]
+        frames[name] = apply_dtypes(df)
+    return frames
 
 
 # a subset of the charities scraped are missing most data, except for the name, category, and location
 # add a boolean column to the dataframe to capture if a row has incomplete data so these can be filtered out as needed
 # also produce some summary statistics of the incomplete rows (category, location, etc.) to ensure data is not biased based on the missing values
 def process_missingvals(df):
-    df['missing'] = df.isnull().any(axis=1)
+    # leader_comp is already numeric from read_csv, with 'None reported' as missing - that alone doesn't make a row
+    # incomplete, so it is left out of the check
+    df['missing'] = df.drop(columns=['leader_comp']).isnull().any(axis=1)
     df_missing = df[df['missing'] == True]
     print('Rows with missing values: ' + str(df_missing.missing.count()) + " / " + str(df.shape[0]) + " total charities (" + str(round(df_missing.missing.count()/df.shape[0], 2)*100) + "%)")
+    return df
 
-    df['leader_comp'] = df['leader_comp'].replace('Not compensated', 0)
-    df['leader_comp'] = df['leader_comp'].replace('None reported', np.nan)
+
+# distribution of missing vs. non-missing rows by state and by category (needs the missing column, see above)
+def plot_missingvals(df):
+    import seaborn as sns
 
     sns.set(font_scale=0.6)
 
@@ -48,138 +227,346 @@ def process_missingvals(df):
     category_grid.fig.suptitle('Distribution of Missing vs. Non-Missing Values by Category')
     # plt.show()
 
-    return df
+
+# attributes encoded in attributes_990 / attributes_website, in bit order (bit 0 first) - see the legend in the spider
+ATTRIBUTES_990 = ['ind_board', 'no_asset_diversion', 'ind_accountant', 'no_related_loans', 'board_minutes', 'advance_990',
+                  'conf_int_policy', 'whistleblower_policy', 'records_policy', 'ceo_listed', 'ceo_comp_process', 'board_listed']
+ATTRIBUTES_WEBSITE = ['donor_priv_policy', 'board_members', 'audited_financials', 'form_990', 'key_staff']
+
+
+# expand a bitmask column into a (rows x n_bits) uint8 matrix of its bits, lowest bit first, in one vectorized pass:
+# the masks are narrowed to the smallest unsigned int that holds n_bits and unpacked byte-wise with np.unpackbits
+# missing masks decode to all zeros
+def decode_bits(series, n_bits):
+    width = 1 if n_bits <= 8 else 2 if n_bits <= 16 else 4 if n_bits <= 32 else 8
+    values = series.to_numpy(dtype='int64', na_value=0).astype('<u%d' % width)
+    bits = np.unpackbits(values.view(np.uint8).reshape(-1, width), axis=1, bitorder='little')
+    return bits[:, :n_bits]
+
+
+# decode both attribute bitmasks without touching the source columns
+# returns a boolean frame with one column per attribute, and the number of attributes each charity has
+# (missing where the bitmask is missing)
+def decode_attributes(df):
+    bits_990 = decode_bits(df['attributes_990'], len(ATTRIBUTES_990))
+    bits_website = decode_bits(df['attributes_website'], len(ATTRIBUTES_WEBSITE))
+    matrix = pd.DataFrame(np.hstack([bits_990, bits_website]).view(bool), index=df.index,
+                          columns=ATTRIBUTES_990 + ATTRIBUTES_WEBSITE)
+    counts = pd.DataFrame({
+        'num_990_attributes': pd.arrays.IntegerArray(bits_990.sum(axis=1, dtype='int64'),
+                                                     df['attributes_990'].isnull().to_numpy()),
+        'num_website_attributes': pd.arrays.IntegerArray(bits_website.sum(axis=1, dtype='int64'),
+                                                         df['attributes_website'].isnull().to_numpy())}, index=df.index)
+    return matrix, counts
 
 
 # unpack the attributes fields (attributes_990 and attributes_website) to see which attributes apply to which charities
 # add columns to the dataframe for each attribute, and additional columns to sum up the attributes each charity has
 def unpack_attributes(df):
-    atts_990 = ['ind_board', 'no_asset_diversion', 'ind_accountant', 'no_related_loans', 'board_minutes', 'advance_990',
-                'conf_int_policy', 'whistleblower_policy', 'records_policy', 'ceo_listed', 'ceo_comp_process', 'board_listed']
-    atts_website = ['donor_priv_policy', 'board_members', 'audited_financials', 'form_990', 'key_staff']
-    df['num_990_attributes'] = np.zeros(df.shape[0], dtype=int)
-    df['num_website_attributes'] = np.zeros(df.shape[0], dtype=int)
-    atts_990_mask = df['attributes_990']
-    for att_ in atts_990:
-        df[att_] = atts_990_mask % 2 == 1
-        df['num_990_attributes'] += atts_990_mask % 2
-        atts_990_mask //= 2
-    atts_website_mask = df['attributes_website']
-    for att_ in atts_website:
-        df[att_] = atts_website_mask % 2 == 1
-        df['num_website_attributes'] += atts_website_mask % 2
-        atts_website_mask //= 2
-    return df
+    matrix, counts = decode_attributes(df)
+    df = df.drop(columns=list(matrix.columns) + list(counts.columns), errors='ignore')
+    return pd.concat([df, matrix, counts], axis=1)
 
 
-# add fields to the dataframe for key financial ratios:
+# key financial ratios, defined in charity_metrics:
 # program expense ratio - percent of total expenses spent on services delivered
 # fundraising efficiency - fundraising expenses divided by total contributions
 # working capital ratio (years) - number of years the charity can sustain itself from its net assets (net assets divided by total expenses)
-def calculate_ratios(df):
-    df['prog_expense_ratio'] = df['expenses_program'] / df['expenses_total']
-    df['fund_efficiency'] = df['expenses_fundraising'] / df['contributions_tot']
-    df['working_capital_ratio'] = df['net_assets'] / df['expenses_total']
-    return df
-
-locale.setlocale(locale.LC_ALL, '')
-
-charity_df = read_csv(file_name)
-charity_df = process_missingvals(charity_df)
-charity_df = unpack_attributes(charity_df)
-charity_df = calculate_ratios(charity_df)
-# charity_df = cnlp.preprocess_text(charity_df, 'mission')
-# cnlp.create_wordcloud(charity_df, 'mission_nlp', 'All')
-# cnlp.compare_wordclouds(charity_df)
-# cnlp.sentiment_analysis(charity_df, 'score_overall')
-
-print('Number of Charities: %d' %(charity_df['name'].count()))
-print('Mean of overall score: %.2f' %(charity_df['score_overall'].mean()))
-print('Standard Deviation of overall score: %.2f' %(charity_df['score_overall'].std()))
-print('Total Revenue of Scraped Charitable Organizations: %s' %(locale.currency(charity_df['revenue_total'].sum(), grouping=True)))
-print('Total Contributions of Scraped Charitable Organizations: %s' %(locale.currency(charity_df['contributions_tot'].sum(), grouping=True)))
-print('Total Expenses of Scraped Charitable Organizations: %s' %(locale.currency(charity_df['expenses_total'].sum(), grouping=True)))
+RATIO_METRICS = ['prog_expense_ratio', 'fund_efficiency', 'working_capital_ratio']
 
-print('Average Revenue of Scraped Charitable Organizations: %s' %(locale.currency(charity_df['revenue_total'].mean(), grouping=True)))
-print('Average Contributions of Scraped Charitable Organizations: %s' %(locale.currency(charity_df['contributions_tot'].mean(), grouping=True)))
-print('Average Expenses of Scraped Charitable Organizations: %s' %(locale.currency(charity_df['expenses_total'].mean(), grouping=True)))
-print('Average Excess of Scraped Charitable Organizations: %s' %(locale.currency(charity_df['excess'].mean(), grouping=True)))
-print('Maximum Excess of Scraped Charitable Organizations: %s' %(locale.currency(charity_df['excess'].max(), grouping=True)))
-print('Minmum Excess of Scraped Charitable Organizations: %s' %(locale.currency(charity_df['excess'].min(), grouping=True)))
 
-print('Maximum Contributions of Scraped Charitable Organizations: %s - %s' %(charity_df.loc[charity_df['contributions_tot'] == charity_df['contributions_tot'].max()]['name'], locale.currency(charity_df['contributions_tot'].max(), grouping=True)))
-print('Minmum Contributions of Scraped Charitable Organizations: %s - %s' %(charity_df.loc[charity_df['contributions_tot'] == charity_df['contributions_tot'].min()]['name'], locale.currency(charity_df['contributions_tot'].min(), grouping=True)))
-
-print(charity_df['rating_overall'].mean())
-print('4 Stars: %d (%.0f%%)' %(charity_df[charity_df['rating_overall']==4]['name'].count(), charity_df[charity_df['rating_overall']==4]['name'].count() / charity_df.shape[0] * 100))
-print('3 Stars: %d (%.0f%%)' %(charity_df[charity_df['rating_overall']==3]['name'].count(), charity_df[charity_df['rating_overall']==3]['name'].count() / charity_df.shape[0] * 100))
-print('2 Stars: %d (%.0f%%)' %(charity_df[charity_df['rating_overall']==2]['name'].count(), charity_df[charity_df['rating_overall']==2]['name'].count() / charity_df.shape[0] * 100))
-print('1 Stars: %d (%.0f%%)' %(charity_df[charity_df['rating_overall']==1]['name'].count(), charity_df[charity_df['rating_overall']==1]['name'].count() / charity_df.shape[0] * 100))
-print('0 Stars: %d (%.0f%%)' %(charity_df[charity_df['rating_overall']==0]['name'].count(), charity_df[charity_df['rating_overall']==0]['name'].count() / charity_df.shape[0] * 100))
-print('Missing: %d (%.0f%%)' %(charity_df[charity_df['rating_overall'].isnull()]['name'].count(), charity_df[charity_df['rating_overall'].isnull()]['name'].count() / charity_df.shape[0] * 100))
-
-# # map of charity counts by state
-# cc.create_state_map(charity_df, 'name', 'Number of Charities', 'count', 'magma')
-
-# # map of charity counts per million people by state
-# cc.create_state_map(charity_df, 'name', 'Number of Charities', 'count', 'magma', by_pop=True)
-
-# # map of average overall score by state
-# cc.create_state_map(charity_df, 'score_overall', 'Average Score', 'mean', 'magma')
-
-# # distribution of charities by category, with breakdown by rating (4 to 1) layered on top
-cc.plot_distribution(charity_df.sort_values(by=['category_l1', 'rating_overall']), 'category_l1', 'Charity Category', stack_field='rating_overall', stack_title='Overall Rating')
-
-# cc.plot_bar(charity_df.sort_values(by=['category_l1']), 'category_l1', 'contributions_tot', 'Category', 'Total Contributions')
-
-# # distribution of overall score across all charities
-# cc.plot_distribution(charity_df.sort_values(by=['rating_overall']), 'score_overall', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating', nbins=80)
-
-charity_df['log_revenue'] = np.log10(charity_df['revenue_total'])
-
-# # distribution of revenue across all charities
-# cc.plot_distribution(charity_df.sort_values(by=['rating_overall']), 'log_revenue', 'Log Base 10 of Total Revenue', stack_field='rating_overall', stack_title='Overall Rating', nbins=80)
-#
-# # distribution of expenses across all charities
-# cc.plot_distribution(charity_df, 'expenses_total', 'Total Expenses')
-#
-# # distribution of excess (revenue minus cost) across all charities
-# cc.plot_distribution(charity_df, 'excess', '2018 Excess (Revenue-Cost)')
-#
-# # distribution of net assets across all charities
-# cc.plot_distribution(charity_df, 'net_assets', 'Net Assets')
-#
-# # relationship between net assets and overall score
-# cc.plot_relationship(charity_df, 'net_assets', 'score_overall', 'Net Assets', 'Overall Score', log_x=True)
-#
-# # relationship between excess (revenue minus cost) and overall score
-# cc.plot_relationship(charity_df, 'excess', 'score_overall', 'Excess (Revenue-Cost)', 'Overall Score', log_x=True)
-#
-# # relationship between total revenue and overall score
-# cc.plot_relationship(charity_df, 'revenue_total', 'score_overall', 'Total Revenue', 'Overall Score', log_x=True)
-#
-# # relationship between program / expense ratio and overall score
-# cc.plot_distribution(charity_df.sort_values(by=['rating_overall']), 'prog_expense_ratio', 'Program Expense Ratio', nbins=40, stack_field='rating_overall', stack_title='Overall Rating')
-# cc.plot_relationship(charity_df, 'prog_expense_ratio', 'score_overall', 'Program Expense Ratio', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating')
-
-# cc.plot_relationship_with_fit(charity_df, 'prog_expense_ratio', 'score_overall', 'Program Expense Ratio', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating')
-
-# # relationship between funding efficiency and overall score
-# cc.plot_relationship(charity_df, 'fund_efficiency', 'score_overall', 'Funding Efficiency', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating')
-
-# charity_df_no_wc_outliers = charity_df[['working_capital_ratio', 'score_overall']]
-# charity_df_no_wc_outliers = charity_df_no_wc_outliers.loc[charity_df_no_wc_outliers['working_capital_ratio'].apply(lambda x: np.abs(x - charity_df_no_wc_outliers['working_capital_ratio'].mean()) / charity_df_no_wc_outliers['working_capital_ratio'].std() < 3)]
-
-# relationship between working capital ratio and overall score
-# cc.plot_relationship(charity_df, 'working_capital_ratio', 'score_overall', 'Working Capital Ratio', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating')
-# cc.plot_relationship(charity_df_no_wc_outliers, 'working_capital_ratio', 'score_overall', 'Working Capital Ratio', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating')
-
-charity_df.dropna(axis=0, subset=['leader_comp'])
-
-# # analysis of leader compensation
-# cc.plot_distribution(charity_df, 'leader_comp', 'Leader Compensation', nbins=50)
-#
-# cc.plot_relationship(charity_df, 'leader_comp', 'excess', 'Leader Compensation', 'Excess (Revenue-Cost)', stack_field='rating_overall', stack_title='Overall Rating')
+# add the key financial ratios to the dataframe as columns (missing where the denominator is zero)
+# the ratios don't have to be added to be used: charity_metrics.metrics_for(df) computes any metric on first access
+def calculate_ratios(df, names=RATIO_METRICS):
+    metrics = charity_metrics.metrics_for(df)
+    for name in names:
+        df[name] = metrics.values(name).copy()
+    return df
 
-# cc.plot_relationship(charity_df, 'num_990_attributes', 'score_overall', 'Number of 990 Attributes', 'Overall Score')
-# cc.plot_relationship(charity_df, 'num_website_attributes', 'score_overall', 'Number of Website Attributes', 'Overall Score')
\ No newline at end of file
+# single-pass summary statistics of the export, read in chunks so the report works for files that don't fit in memory
+# mean / std are combined across chunks with the parallel (Chan et al.) update, min / max keep the owning charity name
+SUMMARY_COLUMNS = ['score_overall', 'revenue_total', 'contributions_tot', 'expenses_total', 'excess', 'rating_overall']
+
+
+class ColumnSummary(object):
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.min_name = None
+        self.max = None
+        self.max_name = None
+
+    def update(self, values, names):
+        values = values[values.notna()]
+        n = len(values)
+        if n == 0:
+            return
+        as_float = values.astype('float64')
+        chunk_mean = float(as_float.mean())
+        chunk_m2 = float(((as_float - chunk_mean) ** 2).sum())
+        total = self.count + n
+        delta = chunk_mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += chunk_m2 + delta * delta * self.count * n / total
+        self.count = total
+        self.sum += values.sum()
+        i_min, i_max = values.idxmin(), values.idxmax()
+        if self.min is None or values[i_min] < self.min:
+            self.min, self.min_name = values[i_min], names[i_min]
+        if self.max is None or values[i_max] > self.max:
+            self.max, self.max_name = values[i_max], names[i_max]
+
+    def std(self):
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else float('nan')
+
+
+class DatasetSummary(object):
+
+    def __init__(self, columns=SUMMARY_COLUMNS):
+        self.rows = 0
+        self.names = 0
+        self.columns = dict((c, ColumnSummary()) for c in columns)
+        # charities (with a name) by overall rating, None for a missing rating
+        self.ratings = {}
+
+    def update(self, chunk):
+        self.rows += chunk.shape[0]
+        names = chunk['name']
+        self.names += int(names.count())
+        for c, summary in self.columns.items():
+            summary.update(chunk[c], names)
+        named = chunk.loc[names.notna(), 'rating_overall']
+        for rating, n in named.value_counts().items():
+            self.ratings[int(rating)] = self.ratings.get(int(rating), 0) + int(n)
+        self.ratings[None] = self.ratings.get(None, 0) + int(named.isnull().sum())
+        return self
+
+
+def summarize_csv(f, chunksize=100000):
+    usecols = ['name'] + SUMMARY_COLUMNS
+    summary = DatasetSummary()
+    for chunk in pd.read_csv(f, header=0, usecols=usecols, dtype=dict((c, CSV_DTYPES[c]) for c in usecols),
+                             chunksize=chunksize):
+        summary.update(chunk)
+    return summary
+
+
+def summarize_frame(df):
+    return DatasetSummary().update(df)
+
+
+def print_summary(summary):
+    def currency(value):
+        return locale.currency(value, grouping=True)
+    cols = summary.columns
+    print('Number of Charities: %d' %(summary.names))
+    print('Mean of overall score: %.2f' %(cols['score_overall'].mean))
+    print('Standard Deviation of overall score: %.2f' %(cols['score_overall'].std()))
+    print('Total Revenue of Scraped Charitable Organizations: %s' %(currency(cols['revenue_total'].sum)))
+    print('Total Contributions of Scraped Charitable Organizations: %s' %(currency(cols['contributions_tot'].sum)))
+    print('Total Expenses of Scraped Charitable Organizations: %s' %(currency(cols['expenses_total'].sum)))
+
+    print('Average Revenue of Scraped Charitable Organizations: %s' %(currency(cols['revenue_total'].mean)))
+    print('Average Contributions of Scraped Charitable Organizations: %s' %(currency(cols['contributions_tot'].mean)))
+    print('Average Expenses of Scraped Charitable Organizations: %s' %(currency(cols['expenses_total'].mean)))
+    print('Average Excess of Scraped Charitable Organizations: %s' %(currency(cols['excess'].mean)))
+    print('Maximum Excess of Scraped Charitable Organizations: %s' %(currency(cols['excess'].max)))
+    print('Minmum Excess of Scraped Charitable Organizations: %s' %(currency(cols['excess'].min)))
+
+    print('Maximum Contributions of Scraped Charitable Organizations: %s - %s' %(cols['contributions_tot'].max_name, currency(cols['contributions_tot'].max)))
+    print('Minmum Contributions of Scraped Charitable Organizations: %s - %s' %(cols['contributions_tot'].min_name, currency(cols['contributions_tot'].min)))
+
+    print(cols['rating_overall'].mean)
+    for rating in [4, 3, 2, 1, 0]:
+        n = summary.ratings.get(rating, 0)
+        print('%d Stars: %d (%.0f%%)' %(rating, n, n / summary.rows * 100))
+    n = summary.ratings.get(None, 0)
+    print('Missing: %d (%.0f%%)' %(n, n / summary.rows * 100))
+
+
+# load the full export and apply the transforms above
+# the ratios and other derived metrics are not added, the reports that use them ask charity_metrics for them
+def load_charities(f=file_name, use_cache=True):
+    charity_df = read_csv(f, use_cache=use_cache)
+    charity_df = process_missingvals(charity_df)
+    charity_df = unpack_attributes(charity_df)
+    return charity_df
+
+
+def report_missing(charity_df):
+    plot_missingvals(charity_df)
+
+
+def report_nlp(charity_df):
+    import charity_nlp as cnlp
+
+    cache = cnlp.NlpCache(nlp_cache_file)
+    try:
+        charity_df = cnlp.preprocess_text(charity_df, 'mission', cache=cache)
+        terms = cnlp.term_matrix(charity_df, 'mission_nlp', 'category_l1')
+        cnlp.create_wordcloud(charity_df, 'mission_nlp', 'All', frequencies=terms.frequencies())
+        cnlp.compare_wordclouds(charity_df, terms=terms)
+        cnlp.sentiment_analysis(charity_df, 'score_overall', cache=cache)
+    finally:
+        cache.close()
+
+
+def report_charts(charity_df):
+    import charity_charts as cc
+    import charity_cube
+    import charity_stats
+
+    # the charts below plot the ratios and the log of revenue
+    charity_df = charity_metrics.metrics_for(charity_df).extend(RATIO_METRICS + ['log_revenue'])
+
+    # # the state maps are all answered from one aggregate cube of the dataset
+    # cube = charity_cube.build_cube(charity_df)
+
+    # # map of charity counts by state
+    # cc.create_state_map(charity_df, 'name', 'Number of Charities', 'count', 'magma', cube=cube)
+
+    # # map of charity counts per million people by state
+    # cc.create_state_map(charity_df, 'name', 'Number of Charities', 'count', 'magma', by_pop=True, cube=cube)
+
+    # # map of average overall score by state
+    # cc.create_state_map(charity_df, 'score_overall', 'Average Score', 'mean', 'magma', cube=cube)
+
+    # # map of the most frequent category by state
+    # cc.create_category_map(charity_df, cube=cube)
+
+    # # distribution of charities by category, with breakdown by rating (4 to 1) layered on top
+    cc.plot_distribution(charity_df.sort_values(by=['category_l1', 'rating_overall']), 'category_l1', 'Charity Category', stack_field='rating_overall', stack_title='Overall Rating')
+
+    # cc.plot_bar(charity_df.sort_values(by=['category_l1']), 'category_l1', 'contributions_tot', 'Category', 'Total Contributions')
+
+    # # distribution of overall score across all charities
+    # cc.plot_distribution(charity_df.sort_values(by=['rating_overall']), 'score_overall', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating', nbins=80)
+
+    # # fits of every relationship below against the overall score, computed together - pass fit=... to annotate a chart
+    # fits = charity_stats.fit_pairs(charity_df, charity_stats.RELATIONSHIP_FIELDS, ['score_overall'])
+
+    # # distribution of revenue across all charities
+    # cc.plot_distribution(charity_df.sort_values(by=['rating_overall']), 'log_revenue', 'Log Base 10 of Total Revenue', stack_field='rating_overall', stack_title='Overall Rating', nbins=80)
+    #
+    # # distribution of expenses across all charities
+    # cc.plot_distribution(charity_df, 'expenses_total', 'Total Expenses')
+    #
+    # # distribution of excess (revenue minus cost) across all charities
+    # cc.plot_distribution(charity_df, 'excess', '2018 Excess (Revenue-Cost)')
+    #
+    # # distribution of net assets across all charities
+    # cc.plot_distribution(charity_df, 'net_assets', 'Net Assets')
+    #
+    # # relationship between net assets and overall score
+    # cc.plot_relationship(charity_df, 'net_assets', 'score_overall', 'Net Assets', 'Overall Score', log_x=True,
+    #                      fit=charity_stats.lookup_fit(fits, 'net_assets', 'score_overall'))
+    #
+    # # relationship between excess (revenue minus cost) and overall score
+    # cc.plot_relationship(charity_df, 'excess', 'score_overall', 'Excess (Revenue-Cost)', 'Overall Score', log_x=True)
+    #
+    # # relationship between total revenue and overall score
+    # cc.plot_relationship(charity_df, 'revenue_total', 'score_overall', 'Total Revenue', 'Overall Score', log_x=True)
+    #
+    # # relationship between program / expense ratio and overall score
+    # cc.plot_distribution(charity_df.sort_values(by=['rating_overall']), 'prog_expense_ratio', 'Program Expense Ratio', nbins=40, stack_field='rating_overall', stack_title='Overall Rating')
+    # cc.plot_relationship(charity_df, 'prog_expense_ratio', 'score_overall', 'Program Expense Ratio', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating')
+
+    # cc.plot_relationship_with_fit(charity_df, 'prog_expense_ratio', 'score_overall', 'Program Expense Ratio', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating',
+    #                               fit=charity_stats.lookup_fit(fits, 'prog_expense_ratio', 'score_overall'))
+
+    # # relationship between funding efficiency and overall score
+    # cc.plot_relationship(charity_df, 'fund_efficiency', 'score_overall', 'Funding Efficiency', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating')
+
+    # charity_df_no_wc_outliers = charity_df[['working_capital_ratio', 'score_overall']]
+    # charity_df_no_wc_outliers = charity_df_no_wc_outliers.loc[charity_df_no_wc_outliers['working_capital_ratio'].apply(lambda x: np.abs(x - charity_df_no_wc_outliers['working_capital_ratio'].mean()) / charity_df_no_wc_outliers['working_capital_ratio'].std() < 3)]
+
+    # relationship between working capital ratio and overall score
+    # cc.plot_relationship(charity_df, 'working_capital_ratio', 'score_overall', 'Working Capital Ratio', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating')
+    # cc.plot_relationship(charity_df_no_wc_outliers, 'working_capital_ratio', 'score_overall', 'Working Capital Ratio', 'Overall Score', stack_field='rating_overall', stack_title='Overall Rating')
+
+    charity_df.dropna(axis=0, subset=['leader_comp'])
+
+    # # analysis of leader compensation
+    # cc.plot_distribution(charity_df, 'leader_comp', 'Leader Compensation', nbins=50)
+    #
+    # cc.plot_relationship(charity_df, 'leader_comp', 'excess', 'Leader Compensation', 'Excess (Revenue-Cost)', stack_field='rating_overall', stack_title='Overall Rating')
+
+    # cc.plot_relationship(charity_df, 'num_990_attributes', 'score_overall', 'Number of 990 Attributes', 'Overall Score')
+    # cc.plot_relationship(charity_df, 'num_website_attributes', 'score_overall', 'Number of Website Attributes', 'Overall Score')
+
+
+# correlation and linear fits of the relationship fields against the overall score, overall and by rating
+def report_fits(charity_df):
+    import charity_stats
+
+    fields = [f for f in charity_stats.RELATIONSHIP_FIELDS if f in charity_metrics.metrics_for(charity_df)]
+    print(charity_stats.correlation_matrix(charity_df, fields + ['score_overall']).round(3).to_string())
+    fits = charity_stats.fit_pairs(charity_df, fields, ['score_overall'], group_field='rating_overall')
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(fits.to_string(index=False))
+    return fits
+
+
+# do some states / categories have significantly higher average ratings (permutation tests, FDR controlled)
+def report_significance(charity_df):
+    import charity_stats
+
+    group_table, anova_table = charity_stats.group_tests(charity_df, 'rating_overall')
+    print(anova_table.to_string(index=False))
+    significant = group_table[group_table['significant']].sort_values(by=['factor', 'difference'], ascending=False)
+    print('Groups with a significantly different average rating (q <= 0.05): %d / %d' %(significant.shape[0], group_table.shape[0]))
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(significant.to_string(index=False))
+    return group_table, anova_table
+
+
+# reports that need the loaded dataframe, in the order they run
+# (the summary report streams the csv itself, see summarize_csv)
+FRAME_REPORTS = {'missing': report_missing, 'nlp': report_nlp, 'fits': report_fits, 'significance': report_significance,
+                 'charts': report_charts}
+REPORTS = ['missing', 'nlp', 'summary', 'fits', 'significance', 'charts']
+DEFAULT_REPORTS = ['missing', 'summary', 'charts']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summary statistics and charts for the scraped charities')
+    parser.add_argument('--file', default=file_name, help='csv export of the crawl')
+    parser.add_argument('--reports', default=','.join(DEFAULT_REPORTS),
+                        help='comma separated reports to run, out of: %s' % ', '.join(REPORTS))
+    parser.add_argument('--chunksize', type=int, default=100000, help='rows per chunk for the summary report')
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the typed cache of the csv")
+    parser.add_argument('--timing', action='store_true', help='print how long loading and each report took')
+    args = parser.parse_args(argv)
+
+    reports = [r.strip() for r in args.reports.split(',') if r.strip()]
+    unknown = [r for r in reports if r not in REPORTS]
+    if unknown:
+        parser.error('unknown reports: %s' % ', '.join(unknown))
+
+    locale.setlocale(locale.LC_ALL, '')
+
+    charity_df = None
+    for report in REPORTS:
+        if report not in reports:
+            continue
+        start = time.time()
+        if report == 'summary':
+            print_summary(summarize_csv(args.file, chunksize=args.chunksize))
+        else:
+            if charity_df is None:
+                charity_df = load_charities(args.file, use_cache=not args.no_cache)
+                if args.timing:
+                    print('load: %.2fs' % (time.time() - start))
+                start = time.time()
+            FRAME_REPORTS[report](charity_df)
+        if args.timing:
+            print('%s: %.2fs' % (report, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# Compressed, content-addressed archive of raw responses.
+#
+# Bodies are stored gzip-compressed under their sha1 (objects/ab/abcdef....gz), so identical pages are only stored once,
+# and an SQLite index maps every archived url to its body, status, content type and the spider callback that handled
+# it. charity_scraper.reparse replays the archive through the spider callbacks without touching the network.
+
+import gzip
+import hashlib
+import os
+import sqlite3
+import time
+
+
+class ResponseArchive(object):
+
+    def __init__(self, root, readonly=False):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        if not readonly and not os.path.exists(self.objects):
+            os.makedirs(self.objects)
+        if readonly:
+            self.conn = sqlite3.connect('file:%s?mode=ro' % os.path.join(root, 'index.db'), uri=True)
+        else:
+            self.conn = sqlite3.connect(os.path.join(root, 'index.db'))
+            self.conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                              'url TEXT PRIMARY KEY, digest TEXT, status INTEGER, content_type TEXT, callback TEXT, '
+                              'fetched_at REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_callback ON responses (callback)')
+            self.conn.commit()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest + '.gz')
+
+    # store a body (if it isn't already there) and point the url at it, returns the body's digest
+    def put(self, url, body, status=200, content_type=None, callback=None):
+        digest = hashlib.sha1(body).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            directory = os.path.dirname(path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            # write to a temporary name first so a crash never leaves a truncated object behind
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        self.conn.execute('INSERT OR REPLACE INTO responses (url, digest, status, content_type, callback, fetched_at) '
+                          'VALUES (?, ?, ?, ?, ?, ?)', (url, digest, status, content_type, callback, time.time()))
+        return digest
+
+    def load(self, digest):
+        with gzip.open(self.object_path(digest), 'rb') as f:
+            return f.read()
+
+    # (url, digest, status, content_type) of every archived response handled by the given callback
+    def entries(self, callback=None):
+        if callback is None:
+            query = self.conn.execute('SELECT url, digest, status, content_type FROM responses ORDER BY url')
+        else:
+            query = self.conn.execute('SELECT url, digest, status, content_type FROM responses WHERE callback = ? '
+                                      'ORDER BY url', (callback,))
+        return query.fetchall()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Change detection between crawls, used by DeltaExportPipeline.
+#
+# The snapshot keeps, for every charity of the last finished crawl, a hash of its item and the item itself. A new crawl
+# hashes each item and looks it up by charity key: unknown keys are added charities, a different hash is a changed
+# charity (diffed field by field against the stored item), and keys of the snapshot that the crawl never produced are
+# removed charities. The delta is written as json lines under DELTA_DIR/<crawl id>/, and the snapshot is only updated
+# once the delta is complete.
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from charity_scraper.items import FIELD_ORDER
+from charity_scraper.store import charity_key
+
+# the url only locates the page, a charity moving to a different url with the same content is not a change
+HASHED_FIELDS = [field for field in FIELD_ORDER if field != 'url']
+
+
+def item_hash(item):
+    return hashlib.sha1(json.dumps([item.get(field) for field in HASHED_FIELDS],
+                                   separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+# field -> [previous value, new value] for every field that differs (unset fields are None)
+def changed_fields(previous, item):
+    return dict((field, [previous.get(field), item.get(field)]) for field in HASHED_FIELDS
+                if previous.get(field) != item.get(field))
+
+
+class Snapshot(object):
+    # The crawl in progress is streamed into the staging table (every charity it produced, with the item only where it
+    # was added or changed), and apply() swaps it into the snapshot in one transaction, so nothing of the crawl has to
+    # be held in memory.
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS snapshot ('
+                          'charity_key TEXT PRIMARY KEY, content_hash TEXT, item TEXT) WITHOUT ROWID')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS staging ('
+                          'charity_key TEXT PRIMARY KEY, content_hash TEXT, item TEXT) WITHOUT ROWID')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS crawls (crawl_id TEXT PRIMARY KEY, finished_at REAL)')
+        self.conn.commit()
+
+    # content hash of the charity in the last crawl, or None
+    def content_hash(self, key):
+        row = self.conn.execute('SELECT content_hash FROM snapshot WHERE charity_key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def item(self, key):
+        row = self.conn.execute('SELECT item FROM snapshot WHERE charity_key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def last_crawl(self):
+        row = self.conn.execute('SELECT crawl_id FROM crawls ORDER BY finished_at DESC LIMIT 1').fetchone()
+        return row[0] if row is not None else None
+
+    # drop what a crawl that never finished left in the staging table
+    def begin(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM staging')
+
+    # record a charity of the crawl in progress (item None if it is unchanged), returns False if it was already there
+    def stage(self, key, digest, item=None):
+        return self.conn.execute('INSERT OR IGNORE INTO staging (charity_key, content_hash, item) VALUES (?, ?, ?)',
+                                 (key, digest, json.dumps(dict(item)) if item is not None else None)).rowcount == 1
+
+    # (key, previous item) of the charities in the snapshot that the crawl in progress didn't produce
+    def removed(self):
+        cursor = self.conn.execute('SELECT charity_key, item FROM snapshot '
+                                   'WHERE charity_key NOT IN (SELECT charity_key FROM staging)')
+        for key, item in cursor:
+            yield key, json.loads(item)
+
+    # swap the staged crawl into the snapshot in one transaction (and drop the removed charities if check_removed)
+    def apply(self, crawl_id, check_removed=True):
+        with self.conn:
+            if check_removed:
+                self.conn.execute('DELETE FROM snapshot WHERE charity_key NOT IN (SELECT charity_key FROM staging)')
+            self.conn.execute('INSERT OR REPLACE INTO snapshot (charity_key, content_hash, item) '
+                              'SELECT charity_key, content_hash, item FROM staging WHERE item IS NOT NULL')
+            self.conn.execute('DELETE FROM staging')
+            self.conn.execute('INSERT OR REPLACE INTO crawls (crawl_id, finished_at) VALUES (?, ?)',
+                              (crawl_id, time.time()))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class DeltaWriter(object):
+    # Compares the items of one crawl against a Snapshot and streams the delta into DELTA_DIR/<crawl id>.partial/,
+    # which is renamed to DELTA_DIR/<crawl id>/ by finish():
+    #     added.jsonl - {"key", "item"} for charities that weren't in the previous crawl
+    #     changed.jsonl - {"key", "item", "changes": {field: [previous, new]}} for charities whose content changed
+    #     removed.jsonl - {"key", "item"} (the previous item) for charities the crawl didn't produce
+    #     manifest.json - crawl ids, counts, and whether removals were checked
+    # Removals are only reported (and dropped from the snapshot) when the crawl finished normally and lost no requests,
+    # so a crawl that was stopped half way or throttled doesn't look like the charities it missed disappeared. The crawl id is the start time, with a -<n>
+    # suffix if a delta of that second already exists; an existing delta is never overwritten.
+
+    ARTIFACTS = ['added', 'changed', 'removed']
+
+    def __init__(self, snapshot, root, crawl_id=None, commit_every=1000):
+        self.snapshot = snapshot
+        self.root = root
+        self.commit_every = commit_every
+        self.crawl_id = self.reserve(crawl_id)
+        self.path = os.path.join(root, self.crawl_id)
+        self.partial = self.path + '.partial'
+        self.files = dict((name, open(os.path.join(self.partial, name + '.jsonl'), 'w')) for name in self.ARTIFACTS)
+        self.counts = dict((name, 0) for name in self.ARTIFACTS + ['unchanged', 'duplicate'])
+        self.previous_crawl = snapshot.last_crawl()
+        self.pending_commits = 0
+        snapshot.begin()
+
+    # create the .partial directory of a crawl id nobody else has used, and return the id
+    def reserve(self, crawl_id):
+        os.makedirs(self.root, exist_ok=True)
+        base = crawl_id or time.strftime('%Y%m%dT%H%M%S')
+        n = 0
+        while True:
+            candidate = base if n == 0 else '%s-%d' % (base, n)
+            path = os.path.join(self.root, candidate)
+            if not os.path.exists(path):
+                try:
+                    os.mkdir(path + '.partial')
+                    return candidate
+                except FileExistsError:
+                    pass
+            if crawl_id is not None:
+                raise FileExistsError('a delta export of crawl %s already exists in %s' % (crawl_id, self.root))
+            n += 1
+
+    # returns 'added', 'changed', 'unchanged' or 'duplicate' (the charity was already seen in this crawl)
+    def add(self, item):
+        key = charity_key(item['url'])
+        digest = item_hash(item)
+        previous_digest = self.snapshot.content_hash(key)
+        status = 'unchanged' if previous_digest == digest else 'added' if previous_digest is None else 'changed'
+        if not self.snapshot.stage(key, digest, item if status != 'unchanged' else None):
+            self.counts['duplicate'] += 1
+            return 'duplicate'
+        if status == 'added':
+            self.write(status, {'key': key, 'item': dict(item)})
+        elif status == 'changed':
+            self.write(status, {'key': key, 'item': dict(item),
+                                'changes': changed_fields(self.snapshot.item(key) or {}, item)})
+        self.counts[status] += 1
+        self.pending_commits += 1
+        if self.pending_commits >= self.commit_every:
+            self.snapshot.commit()
+            self.pending_commits = 0
+        return status
+
+    def write(self, name, record):
+        self.files[name].write(json.dumps(record) + '\n')
+
+    # finalize the delta and the snapshot; check_removed is False for crawls that didn't finish normally or lost
+    # requests (lost: counts of the lost requests, recorded in the manifest)
+    def finish(self, check_removed=True, reason=None, lost=None):
+        self.snapshot.commit()
+        if check_removed:
+            for key, item in self.snapshot.removed():
+                self.write('removed', {'key': key, 'item': item})
+                self.counts['removed'] += 1
+        for f in self.files.values():
+            f.close()
+        with open(os.path.join(self.partial, 'manifest.json'), 'w') as fh:
+            json.dump({'crawl_id': self.crawl_id, 'previous_crawl_id': self.previous_crawl, 'finish_reason': reason,
+                       'removed_checked': check_removed, 'lost_requests': lost or {}, 'counts': self.counts}, fh,
+                      indent=2)
+        os.rename(self.partial, self.path)
+        self.snapshot.apply(self.crawl_id, check_removed)
+        return self.path
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+# Define here the extensions for the charity crawler
+#
+# See documentation in:
+# https://doc.scrapy.org/en/latest/topics/extensions.html
+
+import logging
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+from charity_scraper.instrumentation import registry_for, write_prometheus
+
+logger = logging.getLogger(__name__)
+
+
+class EndpointState(object):
+    # what the controller knows about one downloader slot (one endpoint)
+
+    def __init__(self, concurrency, delay, threshold, now):
+        self.concurrency = concurrency
+        self.delay = delay
+        # concurrency up to which it doubles instead of growing by one (lowered by every backoff)
+        self.threshold = threshold
+        self.latency = None
+        self.responses = 0
+        self.errors = 0
+        self.throttled = 0
+        self.retry_after = 0.0
+        self.last_decision = now
+        self.backoff_until = now
+        # the slot sends nothing until then (the Retry-After of the last backoff)
+        self.pause_until = now
+        # concurrency and delay of the last throttling: until limit_until, concurrency stays below limit and the delay
+        # above limit_delay, so the controller doesn't keep climbing back into the server's rate limit
+        self.limit = None
+        self.limit_delay = None
+        self.limit_until = now
+
+
+class AdaptiveController(object):
+    # Additive-increase / multiplicative-decrease controller for per-endpoint concurrency and delay.
+    #
+    # An endpoint gets one decision every `interval` seconds, from the responses seen since the last one:
+    #     throttled (429 / 503) - cut concurrency by backoff_factor; taken right away, at most once per interval (or
+    #         per Retry-After), and the endpoint sends nothing until the Retry-After has passed (pause_until)
+    #     error rate or smoothed latency above target - step concurrency down by one
+    #     otherwise - grow concurrency: doubling until the first backoff, by one after that, and never back up to the
+    #         concurrency (or down to the delay) at which the last 429 / 503 came, until limit_hold seconds after it
+    # A download delay makes scrapy send a slot's requests one at a time, so the delay is only used below the minimum
+    # concurrency: it is raised once concurrency can't go any lower, and driven back to the minimum delay before
+    # concurrency grows again. Concurrency and delay always stay within the configured bounds. It has no scrapy
+    # dependencies, so it can be driven directly with made-up observations (pass `now`).
+
+    def __init__(self, min_concurrency=1, max_concurrency=16, start_concurrency=2, min_delay=0.0, max_delay=30.0,
+                 start_delay=0.0, target_latency=1.0, max_error_rate=0.05, interval=1.0, smoothing=0.2,
+                 backoff_factor=0.75, limit_hold=60.0):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.start_concurrency = min(max(start_concurrency, min_concurrency), max_concurrency)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.start_delay = min(max(start_delay, min_delay), max_delay)
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.interval = interval
+        self.smoothing = smoothing
+        self.backoff_factor = backoff_factor
+        self.limit_hold = limit_hold
+        self.endpoints = {}
+
+    def endpoint(self, key, now=None):
+        state = self.endpoints.get(key)
+        if state is None:
+            state = self.endpoints[key] = EndpointState(self.start_concurrency, self.start_delay, self.max_concurrency,
+                                                        time.time() if now is None else now)
+        return state
+
+    # record one response (latency in seconds) or one failed download (latency None, error True)
+    # returns the decision taken ('backoff', 'decrease', 'increase', 'hold') or None if it isn't time for one yet
+    def observe(self, key, latency=None, status=None, error=False, retry_after=None, now=None):
+        now = time.time() if now is None else now
+        state = self.endpoint(key, now)
+        if status in (429, 503):
+            # don't wait for the interval to back off - but the throttling that follows within an interval (or the
+            # Retry-After the server sent) of a backoff is the same overload, and would just cut concurrency again
+            if now < state.backoff_until:
+                return None
+            state.responses += 1
+            state.throttled += 1
+            if retry_after:
+                state.retry_after = max(state.retry_after, retry_after)
+            return self.decide(state, now)
+        state.responses += 1
+        if latency is not None:
+            state.latency = latency if state.latency is None else (1 - self.smoothing) * state.latency + self.smoothing * latency
+        if error or (status is not None and status >= 500):
+            state.errors += 1
+        if now - state.last_decision >= self.interval:
+            return self.decide(state, now)
+        return None
+
+    def decide(self, state, now):
+        if state.throttled:
+            decision = 'backoff'
+            state.backoff_until = now + max(self.interval, state.retry_after)
+            state.pause_until = now + state.retry_after
+            state.limit = state.concurrency
+            state.limit_delay = state.delay
+            state.limit_until = now + self.limit_hold
+            if state.concurrency > self.min_concurrency:
+                state.concurrency = max(self.min_concurrency, int(state.concurrency * self.backoff_factor))
+            else:
+                state.delay = max(state.delay * 2, 0.05)
+            state.threshold = max(state.concurrency, self.min_concurrency + 1)
+        elif state.errors > self.max_error_rate * state.responses or \
+                (state.latency is not None and state.latency > self.target_latency):
+            decision = 'decrease'
+            if state.concurrency > self.min_concurrency:
+                state.concurrency -= 1
+            else:
+                state.delay = max(state.delay * 1.5, 0.05)
+        elif state.delay > self.min_delay:
+            delay = state.delay / 2 if state.delay / 2 >= 0.01 else self.min_delay
+            if now < state.limit_until:
+                # close in on the delay of the last throttling from above, without reaching it
+                delay = max(delay, (state.delay + state.limit_delay) / 2)
+            if delay < state.delay * 0.95:
+                decision = 'increase'
+                state.delay = delay
+            else:
+                decision = 'hold'
+        else:
+            if state.concurrency < state.threshold:
+                concurrency = min(state.concurrency * 2, state.threshold, self.max_concurrency)
+            else:
+                concurrency = min(state.concurrency + 1, self.max_concurrency)
+            if now < state.limit_until:
+                concurrency = min(concurrency, state.limit - 1)
+            if concurrency > state.concurrency:
+                decision = 'increase'
+                state.concurrency = concurrency
+            else:
+                decision = 'hold'
+        state.delay = min(max(state.delay, self.min_delay), self.max_delay)
+        state.responses = state.errors = state.throttled = 0
+        state.retry_after = 0.0
+        state.last_decision = now
+        return decision
+
+
+class AdaptiveConcurrency(object):
+    # Extension that owns the AdaptiveController and applies its decisions to the downloader slots
+    # (enable with ADAPTIVE_CONCURRENCY_ENABLED = True, together with AdaptiveConcurrencyMiddleware).
+    #
+    # Observations come in from charity_scraper.middlewares.AdaptiveConcurrencyMiddleware. A slot gets the start
+    # concurrency and delay as soon as it is created (request_reached_downloader). Every decision is counted in
+    # the crawl stats under adaptive_concurrency/decisions/<decision>, and the current concurrency / delay of each
+    # endpoint is written to the stats every ADAPTIVE_STATS_INTERVAL seconds and when the spider closes.
+
+    def __init__(self, crawler, controller, stats_interval=30.0):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.controller = controller
+        self.stats_interval = stats_interval
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        controller = AdaptiveController(
+            min_concurrency=settings.getint('ADAPTIVE_MIN_CONCURRENCY', 1),
+            max_concurrency=settings.getint('ADAPTIVE_MAX_CONCURRENCY', settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')),
+            start_concurrency=settings.getint('ADAPTIVE_START_CONCURRENCY', 2),
+            min_delay=settings.getfloat('ADAPTIVE_MIN_DELAY', 0.0),
+            max_delay=settings.getfloat('ADAPTIVE_MAX_DELAY', 30.0),
+            start_delay=settings.getfloat('ADAPTIVE_START_DELAY', 0.0),
+            target_latency=settings.getfloat('ADAPTIVE_TARGET_LATENCY', 1.0),
+            max_error_rate=settings.getfloat('ADAPTIVE_MAX_ERROR_RATE', 0.05),
+            interval=settings.getfloat('ADAPTIVE_INTERVAL', 1.0),
+            backoff_factor=settings.getfloat('ADAPTIVE_BACKOFF_FACTOR', 0.75),
+            limit_hold=settings.getfloat('ADAPTIVE_LIMIT_HOLD', 60.0))
+        ext = cls(crawler, controller, settings.getfloat('ADAPTIVE_STATS_INTERVAL', 30.0))
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.request_reached_downloader, signal=signals.request_reached_downloader)
+        return ext
+
+    def spider_opened(self, spider):
+        self.task = task.LoopingCall(self.log_endpoints)
+        self.task.start(self.stats_interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.log_endpoints()
+
+    # the slot of the request exists by now - a new one starts at the controller's start concurrency and delay
+    def request_reached_downloader(self, request, spider):
+        key = request.meta.get('download_slot')
+        if key is None or key in self.controller.endpoints:
+            return
+        self.apply(key, self.controller.endpoint(key))
+
+    def apply(self, key, state):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.concurrency = state.concurrency
+            # a Retry-After holds the whole slot back until it has passed, the next decision restores the delay
+            slot.delay = max(state.delay, state.pause_until - time.time())
+
+    # called by the middleware for every response / failed download, with the downloader slot key of the request
+    def observe(self, key, latency=None, status=None, error=False, retry_after=None):
+        if key is None:
+            return
+        decision = self.controller.observe(key, latency=latency, status=status, error=error, retry_after=retry_after)
+        if decision is None:
+            return
+        state = self.controller.endpoint(key)
+        self.apply(key, state)
+        self.stats.inc_value('adaptive_concurrency/decisions/%s' % decision)
+        logger.debug('adaptive concurrency %s for %s: concurrency=%d delay=%.2fs latency=%s', decision, key,
+                     state.concurrency, state.delay, '%.3fs' % state.latency if state.latency is not None else 'n/a')
+
+    # seconds a throttled request of the slot should wait before it is sent again: the Retry-After, the slot's delay,
+    # and what is left of its backoff window, whichever is longest
+    def throttle_wait(self, key, retry_after=None):
+        state = self.controller.endpoint(key)
+        return max(retry_after or 0.0, state.delay, state.backoff_until - time.time())
+
+    def log_endpoints(self):
+        for key, state in self.controller.endpoints.items():
+            self.stats.set_value('adaptive_concurrency/%s/concurrency' % key, state.concurrency)
+            self.stats.set_value('adaptive_concurrency/%s/delay' % key, round(state.delay, 3))
+            if state.latency is not None:
+                self.stats.set_value('adaptive_concurrency/%s/latency' % key, round(state.latency, 3))
+
+
+class CrawlMetrics(object):
+    # Extension that records download latency, queue depth, in-flight downloads and items/sec, and every
+    # METRICS_INTERVAL seconds copies these plus the callback (CallbackTimingMiddleware) and pipeline (@timed_stage)
+    # histograms into the crawl stats and, if METRICS_FILE is set, a Prometheus text file
+    # (enable with METRICS_ENABLED = True).
+
+    def __init__(self, crawler, path=None, interval=15.0):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.path = path
+        self.interval = interval
+        self.registry = registry_for(crawler)
+        self.task = None
+        self.items = 0
+        self.last_items = 0
+        self.last_sample = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        ext = cls(crawler, crawler.settings.get('METRICS_FILE'), crawler.settings.getfloat('METRICS_INTERVAL', 15.0))
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        return ext
+
+    def spider_opened(self, spider):
+        self.registry.clear()
+        # switch on the @timed_stage timing of the item pipelines
+        for pipeline in self.crawler.engine.scraper.itemproc.middlewares:
+            pipeline.metrics_registry = self.registry
+        self.last_sample = time.time()
+        self.task = task.LoopingCall(self.sample)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.sample()
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.registry.histogram('charity_download_seconds', slot=request.meta.get('download_slot', '')).observe(latency)
+        self.registry.inc('charity_responses_total', status=response.status)
+
+    def item_scraped(self, item, response, spider):
+        self.items += 1
+
+    def sample(self):
+        now = time.time()
+        elapsed = now - self.last_sample if self.last_sample is not None else 0
+        items_per_sec = (self.items - self.last_items) / elapsed if elapsed > 0 else 0.0
+        self.last_items = self.items
+        self.last_sample = now
+
+        engine = self.crawler.engine
+        scheduler = _scheduler(engine)
+        queue_depth = len(scheduler) if scheduler is not None and hasattr(scheduler, '__len__') else None
+        in_flight = len(engine.downloader.active) if engine is not None else None
+
+        self.registry.set('charity_items_per_second', round(items_per_sec, 3))
+        self.registry.set('charity_items_total', self.items)
+        self.stats.set_value('metrics/items_per_sec', round(items_per_sec, 3))
+        if queue_depth is not None:
+            self.registry.set('charity_scheduler_queue_depth', queue_depth)
+            self.stats.set_value('metrics/queue_depth', queue_depth)
+            self.stats.max_value('metrics/queue_depth_max', queue_depth)
+        if in_flight is not None:
+            self.registry.set('charity_downloads_in_flight', in_flight)
+            self.stats.set_value('metrics/in_flight', in_flight)
+
+        for (name, labels), h in list(self.registry.histograms.items()):
+            if h.count == 0:
+                continue
+            key = 'metrics/%s/%s' % (name, '/'.join(str(v) for _, v in labels)) if labels else 'metrics/%s' % name
+            self.stats.set_value(key + '/count', h.count)
+            self.stats.set_value(key + '/mean_ms', round(h.sum / h.count * 1000, 3))
+            self.stats.set_value(key + '/p50_ms', _ms(h.quantile(0.5)))
+            self.stats.set_value(key + '/p95_ms', _ms(h.quantile(0.95)))
+            self.stats.set_value(key + '/p99_ms', _ms(h.quantile(0.99)))
+
+        if self.path:
+            write_prometheus(self.registry, self.path)
+
+
+def _ms(seconds):
+    return seconds * 1000 if seconds is not None else None
+
+
+def _scheduler(engine):
+    if engine is None:
+        return None
+    slot = getattr(engine, 'slot', None) or getattr(engine, '_slot', None)
+    return getattr(slot, 'scheduler', None)
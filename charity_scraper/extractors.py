@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Precompiled selectors and single-pass table extraction for the charity pages.
+#
+# parse_charity_page used to evaluate a fresh xpath string for every table cell it needed (up to three times per
+# income row). The expressions below are compiled once at import and run directly against the lxml tree behind the
+# response, and each table is walked a single time into a row-indexed structure that the spider reads from.
+
+from lxml import etree
+
+
+def _compile(path):
+    # smart_strings=False returns plain str objects instead of lxml's _ElementUnicodeResult, which also keeps a
+    # reference back to the tree for every extracted string
+    return etree.XPath(path, smart_strings=False)
+
+
+# general information, found on every charity page
+NAME = _compile('//h1[@class="charityname"]/text()')
+TAGLINE = _compile('//h2[@class="tagline"]/text()')
+CRUMBS = _compile('//p[@class="crumbs"]/text()')
+LOCATION_LINES = _compile('//div[@id="leftnavcontent"]/div/p[1]/text()')
+
+# rated charities only - everything below is evaluated relative to the rating wrapper container
+RATING_WRAPPER = _compile('//div[@class="rating-wrapper"]')
+SCORING_TABLE = _compile('.//div[@class="summaryBox"]//div[@class="shadedtable"]/table')
+METRICS_TABLE = _compile('.//div[@class="summaryBox"]//div[@class="shadedtable cn-accordion-rating"][2]/div/table')
+INCOME_TABLE = _compile('.//div[@class="summaryBox income-table"]/div/div/table')
+MISSION = _compile('.//div[@class="summaryBox"]//div[@class="summaryBox cn-table"]//p/text()')
+LEADER_COMP = _compile('.//div[@class="summaryBox cn-accordion-rating"][2]/div/table/tr[2]/td[1]/span/text()')
+
+# directory pages
+DIRECTORY_URLS = _compile('//*[@class="letters"][1]/a/@href')
+CHARITY_URLS = _compile('//div[@class="mobile-padding charities"]/a/@href')
+
+# table walking - rows, their cells, and the few things we read out of a cell
+ROWS = _compile('./tr')
+CELLS = _compile('./td')
+CELL_TEXT = _compile('./text()')
+CELL_IMG_SRC = _compile('./img/@src')
+CELL_RATING_TITLE = _compile('./strong/svg/title/text()')
+
+
+# return the first result of a compiled xpath, or None (the equivalent of parsel's extract_first)
+def first(xpath, node):
+    if node is None:
+        return None
+    result = xpath(node)
+    return result[0] if result else None
+
+
+class TableRows(object):
+    # A table walked once into a list of rows, each row being the list of its <td> elements.
+    # Rows and columns are 1-based so they line up with the tr[row]/td[col] positions used in the xpaths.
+
+    def __init__(self, table):
+        self.rows = [] if table is None else [CELLS(tr) for tr in ROWS(table)]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def cell(self, row, col):
+        if row < 1 or row > len(self.rows):
+            return None
+        cells = self.rows[row - 1]
+        if col < 1 or col > len(cells):
+            return None
+        return cells[col - 1]
+
+    def text(self, row, col):
+        return first(CELL_TEXT, self.cell(row, col))
+
+    def img_src(self, row, col):
+        return first(CELL_IMG_SRC, self.cell(row, col))
+
+    def rating_title(self, row, col):
+        return first(CELL_RATING_TITLE, self.cell(row, col))
+
+
+class CharityTables(object):
+    # The score, metrics (form 990 / website attributes) and income tables of a rated charity page
+
+    def __init__(self, container):
+        self.score = TableRows(first(SCORING_TABLE, container))
+        self.metrics = TableRows(first(METRICS_TABLE, container))
+        self.income = TableRows(first(INCOME_TABLE, container))
+
+
+# the lxml root element behind a scrapy response
+def response_root(response):
+    return response.selector.root
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+# On-disk store of page fingerprints for incremental re-crawls.
+#
+# For every charity url we keep the ETag and Last-Modified headers the server sent, a hash of the page body, and the
+# item that was exported from the page. The next crawl sends these back as conditional request headers, and when the
+# page has not changed the stored item is carried forward instead of parsing the page again.
+
+import hashlib
+import json
+import sqlite3
+
+
+# hash used to detect unchanged pages when the server doesn't honour the conditional request headers
+def content_hash(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+class FingerprintStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fingerprints ('
+                          'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT, item TEXT)')
+        self.conn.commit()
+
+    def get(self, url):
+        # returns a dict with the stored fingerprint and item for the url, or None if the url hasn't been seen
+        row = self.conn.execute('SELECT etag, last_modified, content_hash, item FROM fingerprints WHERE url = ?',
+                                (url,)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'content_hash': row[2],
+                'item': json.loads(row[3]) if row[3] is not None else None}
+
+    def put(self, url, etag, last_modified, content_hash, item):
+        self.conn.execute('INSERT OR REPLACE INTO fingerprints (url, etag, last_modified, content_hash, item) '
+                          'VALUES (?, ?, ?, ?, ?)', (url, etag, last_modified, content_hash, json.dumps(dict(item))))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Disk-backed crawl frontier, used by FrontierMiddleware to make a crawl resumable.
+#
+# Every request the spider emits is recorded under an 8-byte hash of its canonical url, in a WITHOUT ROWID table so
+# the seen set is stored as a single B-tree sorted by hash. A request stays pending until the response for it has been
+# fully processed by the spider; changes are committed at each checkpoint, so after a crash the pending rows are
+# exactly what still has to be fetched (minus anything done since the last checkpoint).
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+from w3lib.url import canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+
+def url_key(url):
+    return hashlib.sha1(canonicalize_url(url).encode('utf-8')).digest()[:8]
+
+
+# the frontier file of a spider under FRONTIER_DIR
+def frontier_path(frontier_dir, spider_name):
+    return os.path.join(frontier_dir, '%s.frontier.db' % spider_name)
+
+
+# True if the frontier file holds requests of an earlier run that didn't finish, i.e. the crawl will resume
+def has_pending(path):
+    if not os.path.exists(path):
+        return False
+    conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    try:
+        return conn.execute('SELECT 1 FROM frontier WHERE done = 0 LIMIT 1').fetchone() is not None
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+
+class Frontier(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS frontier ('
+                          'key BLOB PRIMARY KEY, url TEXT, callback TEXT, meta TEXT, done INTEGER) WITHOUT ROWID')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS frontier_pending ON frontier (done)')
+        self.conn.commit()
+        self.unserializable = set()
+
+    # record a request, returns False if its url has already been seen
+    def add(self, url, callback=None, meta=None):
+        meta_json = self.meta_json(url, meta or {})
+        cursor = self.conn.execute('INSERT OR IGNORE INTO frontier (key, url, callback, meta, done) VALUES (?, ?, ?, ?, 0)',
+                                   (url_key(url), url, callback, meta_json))
+        return cursor.rowcount == 1
+
+    # the request meta as json; keys whose values can't be serialized are left out (a resumed request won't have
+    # them) and logged, once per key
+    def meta_json(self, url, meta):
+        try:
+            return json.dumps(meta)
+        except (TypeError, ValueError):
+            pass
+        kept = {}
+        for key, value in meta.items():
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                if key not in self.unserializable:
+                    self.unserializable.add(key)
+                    logger.warning('request meta %r of %s (%s) is not json serializable and is not kept in the '
+                                   'frontier - a resumed request will not have it', key, url, type(value).__name__)
+                continue
+            kept[key] = value
+        return json.dumps(kept)
+
+    def seen(self, url):
+        return self.conn.execute('SELECT 1 FROM frontier WHERE key = ?', (url_key(url),)).fetchone() is not None
+
+    def mark_done(self, url):
+        self.conn.execute('UPDATE frontier SET done = 1 WHERE key = ?', (url_key(url),))
+
+    # (url, callback name, meta) for every request that hasn't been processed yet
+    def pending(self):
+        rows = self.conn.execute('SELECT url, callback, meta FROM frontier WHERE done = 0').fetchall()
+        return [(url, callback, json.loads(meta)) for url, callback, meta in rows]
+
+    def count(self, done=None):
+        if done is None:
+            return self.conn.execute('SELECT COUNT(*) FROM frontier').fetchone()[0]
+        return self.conn.execute('SELECT COUNT(*) FROM frontier WHERE done = ?', (int(done),)).fetchone()[0]
+
+    def checkpoint(self):
+        self.conn.commit()
+
+    def clear(self):
+        self.conn.execute('DELETE FROM frontier')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class SharedSeenSet(object):
+    # Seen-url set shared by the worker processes of a sharded crawl (see charity_scraper.sharding).
+    #
+    # A SQLite file that every shard opens. Claiming a url is a single INSERT OR IGNORE recording the shard, so exactly
+    # one shard wins a url even when it is listed on directory pages that belong to different shards. A claim only
+    # becomes final once the shard has exported the item (mark_done): until then it is a lease held by that shard, so
+    # rerunning a shard that crashed wins its own leases again instead of losing those urls.
+
+    def __init__(self, path, shard=0, timeout=60.0, flush_every=100):
+        self.path = path
+        self.shard = shard
+        self.done = []
+        self.flush_every = flush_every
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY, shard INTEGER, done INTEGER) '
+                          'WITHOUT ROWID')
+        self.conn.commit()
+
+    # claim a batch of urls in one transaction, returns the set of urls this shard holds (newly claimed, or claimed by
+    # this shard in an earlier run)
+    def claim(self, urls):
+        won = set()
+        with self.conn:
+            self.flush()
+            for url in urls:
+                key = url_key(url)
+                if self.conn.execute('INSERT OR IGNORE INTO seen (key, shard, done) VALUES (?, ?, 0)',
+                                     (key, self.shard)).rowcount == 1:
+                    won.add(url)
+                elif self.conn.execute('SELECT shard FROM seen WHERE key = ?', (key,)).fetchone()[0] == self.shard:
+                    won.add(url)
+        return won
+
+    # the item of the url has been exported, the claim is final - buffered and written in one short transaction, so
+    # the other shards' claims aren't kept waiting on the lock
+    def mark_done(self, url):
+        self.done.append(url_key(url))
+        if len(self.done) >= self.flush_every:
+            with self.conn:
+                self.flush()
+
+    def flush(self):
+        self.conn.executemany('UPDATE seen SET done = 1 WHERE key = ?', ((key,) for key in self.done))
+        self.done = []
+
+    # shard -> number of urls it claimed but never exported
+    def unfinished(self):
+        return dict(self.conn.execute('SELECT shard, COUNT(*) FROM seen WHERE done = 0 GROUP BY shard'))
+
+    def close(self):
+        with self.conn:
+            self.flush()
+        self.conn.close()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# In-process metrics for the crawl hot path: latency histograms, counters and gauges, plus the Prometheus text format.
+#
+# The spider callbacks are timed by CallbackTimingMiddleware, the item pipelines by the @timed_stage decorator and the
+# downloads by the CrawlMetrics extension, which also samples queue depth and items/sec and periodically copies
+# everything into the crawl stats and a Prometheus text file. Every crawler records into its own registry
+# (registry_for), and nothing is timed unless METRICS_ENABLED is set.
+
+import bisect
+import functools
+import os
+import time
+import weakref
+
+# histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # upper bound of the bucket holding the q-th quantile (None when nothing has been observed)
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class MetricsRegistry(object):
+    # metrics are keyed by (name, labels) where labels is a tuple of (label, value) pairs
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram()
+        return h
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def clear(self):
+        self.histograms.clear()
+        self.counters.clear()
+        self.gauges.clear()
+
+
+# one registry per crawler, shared by its middleware, pipelines and extension (several crawlers can run in a process)
+_registries = weakref.WeakKeyDictionary()
+
+
+def registry_for(crawler):
+    registry = _registries.get(crawler)
+    if registry is None:
+        registry = _registries[crawler] = MetricsRegistry()
+    return registry
+
+
+# decorator for pipeline process_item methods, records the time spent in the stage into the pipeline's
+# `metrics_registry`, which the CrawlMetrics extension sets; without one (METRICS_ENABLED off) the stage is called
+# untimed
+def timed_stage(stage):
+    def decorator(process_item):
+        @functools.wraps(process_item)
+        def wrapper(self, *args, **kwargs):
+            registry = getattr(self, 'metrics_registry', None)
+            if registry is None:
+                return process_item(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return process_item(self, *args, **kwargs)
+            finally:
+                registry.histogram('charity_pipeline_seconds', stage=stage).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+
+def prometheus_text(registry):
+    lines = []
+    for name in sorted(set(key[0] for key in registry.counters)):
+        lines.append('# TYPE %s counter' % name)
+        for (metric, labels), value in sorted(registry.counters.items()):
+            if metric == name:
+                lines.append('%s%s %s' % (name, _labels(labels), value))
+    for name in sorted(set(key[0] for key in registry.gauges)):
+        lines.append('# TYPE %s gauge' % name)
+        for (metric, labels), value in sorted(registry.gauges.items()):
+            if metric == name:
+                lines.append('%s%s %s' % (name, _labels(labels), value))
+    for name in sorted(set(key[0] for key in registry.histograms)):
+        lines.append('# TYPE %s histogram' % name)
+        for (metric, labels), h in sorted(registry.histograms.items(), key=lambda kv: kv[0]):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, n in zip(list(h.buckets) + ['+Inf'], h.counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, [('le', bound)]), cumulative))
+            lines.append('%s_sum%s %.6f' % (name, _labels(labels), h.sum))
+            lines.append('%s_count%s %d' % (name, _labels(labels), h.count))
+    return '\n'.join(lines) + '\n'
+
+
+# write the registry to a Prometheus text file (e.g. for node_exporter's textfile collector), atomically
+def write_prometheus(registry, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(prometheus_text(registry))
+    os.replace(tmp_path, path)
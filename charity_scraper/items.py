@@ -5,10 +5,50 @@
 # See documentation in:
 # https://doc.scrapy.org/en/latest/topics/items.html
 
+import math
+import operator
+from array import array
+from collections.abc import KeysView
+
 import scrapy
 
+# integer financial fields from the income table - stored together in one int64 array per item instead of one boxed
+# int per dict entry (see CharityItem)
+FINANCIAL_FIELDS = ['contributions_tot', 'contributions_gifts_grants', 'contributions_federated_campaigns',
+                    'contributions_membership_dues', 'contributions_fundraising_events',
+                    'contributions_related_organizations', 'contributions_government_grants', 'revenue_program_service',
+                    'primary_revenue_total', 'revenue_other', 'revenue_total', 'expenses_program', 'expenses_admin',
+                    'expenses_fundraising', 'expenses_total', 'affiliate_payments', 'excess', 'net_assets']
+_ZEROS = array('q', [0] * len(FINANCIAL_FIELDS))
+_UNSET = object()
+
+
+# the value a financial field stores - ints, or floats / strings with a whole value ('12', 12.0); anything else would
+# be silently truncated by int(), so it is rejected
+def _financial_value(key, value):
+    try:
+        return operator.index(value)
+    except TypeError:
+        pass
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = None
+    if number is None or not number.is_integer():
+        raise ValueError('%s must be a whole number, got %r' % (key, value))
+    return int(number)
+
 
 class CharityItem(scrapy.Item):
+    # Field values are not kept in the usual per-item dict: the financial fields live in a fixed-layout int64 array
+    # (plus a bitmask of which ones are set) and the other fields in a fixed-size list indexed by field position.
+    # It still behaves as a mapping of the populated fields, so the exporters and pipelines see a normal item.
+
     # general information
     name = scrapy.Field()
     tagline = scrapy.Field()
@@ -52,4 +92,95 @@ class CharityItem(scrapy.Item):
     # attributes - website
     attributes_website = scrapy.Field()
     # leader compensation info
-    leader_comp = scrapy.Field()
\ No newline at end of file
+    leader_comp = scrapy.Field()
+    # charity page the item was scraped from (its orgid is the charity's key, see charity_scraper.store.charity_key)
+    url = scrapy.Field()
+
+    def __init__(self, *args, **kwargs):
+        self._fixed = [_UNSET] * len(FIXED_FIELDS)
+        self._financials = array('q', _ZEROS)
+        self._financial_set = 0
+        if args or kwargs:
+            for k, v in dict(*args, **kwargs).items():
+                self[k] = v
+
+    def __getitem__(self, key):
+        slot = _SLOTS.get(key)
+        if slot is not None:
+            financial, i = slot
+            if financial:
+                if self._financial_set >> i & 1:
+                    return self._financials[i]
+            else:
+                value = self._fixed[i]
+                if value is not _UNSET:
+                    return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        slot = _SLOTS.get(key)
+        if slot is None:
+            raise KeyError('%s does not support field: %s' % (self.__class__.__name__, key))
+        financial, i = slot
+        if financial:
+            # None (or NaN from a frame) leaves the field unset, the same as never assigning it
+            if value is None or isinstance(value, float) and math.isnan(value):
+                self._financials[i] = 0
+                self._financial_set &= ~(1 << i)
+                return
+            self._financials[i] = _financial_value(key, value)
+            self._financial_set |= 1 << i
+        else:
+            self._fixed[i] = value
+
+    def __delitem__(self, key):
+        slot = _SLOTS.get(key)
+        if slot is None or key not in self:
+            raise KeyError(key)
+        financial, i = slot
+        if financial:
+            self._financials[i] = 0
+            self._financial_set &= ~(1 << i)
+        else:
+            self._fixed[i] = _UNSET
+
+    def __contains__(self, key):
+        slot = _SLOTS.get(key)
+        if slot is None:
+            return False
+        financial, i = slot
+        if financial:
+            return bool(self._financial_set >> i & 1)
+        return self._fixed[i] is not _UNSET
+
+    def __len__(self):
+        return len(self._fixed) - self._fixed.count(_UNSET) + bin(self._financial_set).count('1')
+
+    def __iter__(self):
+        # populated fields, in declaration order
+        for key in FIELD_ORDER:
+            if key in self:
+                yield key
+
+    def keys(self):
+        return KeysView(self)
+
+    def __reduce__(self):
+        # the _UNSET sentinel can't survive pickling, so rebuild from the populated fields
+        return self.__class__, (dict(self),)
+
+    # named access to the financial block: the int64 array in FINANCIAL_FIELDS order (unset fields are 0) and the
+    # bitmask of the fields that are set
+    def financial_block(self):
+        return self._financials, self._financial_set
+
+    def financial(self, name, default=None):
+        i = _SLOTS[name][1]
+        return self._financials[i] if self._financial_set >> i & 1 else default
+
+
+FIELD_ORDER = list(CharityItem.fields)
+FIXED_FIELDS = [field for field in FIELD_ORDER if field not in FINANCIAL_FIELDS]
+# field name -> (is financial, index into the financial array or the fixed list)
+_SLOTS = dict([(field, (True, i)) for i, field in enumerate(FINANCIAL_FIELDS)] +
+              [(field, (False, i)) for i, field in enumerate(FIXED_FIELDS)])
@@ -5,7 +5,18 @@
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
-from scrapy import signals
+import os
+import time
+
+from scrapy import Request, signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import sleep
+
+from charity_scraper.archive import ResponseArchive
+from charity_scraper.extensions import AdaptiveConcurrency
+from charity_scraper.fingerprints import FingerprintStore, content_hash
+from charity_scraper.frontier import Frontier, SharedSeenSet, frontier_path
+from charity_scraper.instrumentation import registry_for
 
 
 class CharitySpiderMiddleware(object):
@@ -54,3 +65,437 @@ class CharitySpiderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class IncrementalCrawlMiddleware(object):
+    # Downloader middleware for incremental re-crawls (enable with INCREMENTAL_ENABLED = True).
+    #
+    # Requests flagged with meta['incremental'] are sent with If-None-Match / If-Modified-Since headers taken from the
+    # fingerprint store. If the server answers 304, or the body hashes to what we stored last time, the previously
+    # exported item is attached to the response as meta['previous_item'] and the spider yields it without parsing the
+    # page. Otherwise the new fingerprint is saved together with the item once it has been scraped.
+
+    def __init__(self, store_path, commit_every=100):
+        self.store = FingerprintStore(store_path)
+        self.commit_every = commit_every
+        self.pending_commits = 0
+        self.stats = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('INCREMENTAL_ENABLED'):
+            raise NotConfigured
+        m = cls(crawler.settings.get('INCREMENTAL_STORE', 'fingerprints.db'))
+        m.stats = crawler.stats
+        crawler.signals.connect(m.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(m.spider_closed, signal=signals.spider_closed)
+        return m
+
+    def process_request(self, request, spider):
+        if not request.meta.get('incremental'):
+            return None
+        # key on the original url so the fingerprint still lines up if the page redirects
+        url = request.meta.setdefault('fingerprint_url', request.url)
+        record = self.store.get(url)
+        if record is None or record['item'] is None:
+            return None
+        request.meta['fingerprint_record'] = record
+        if record['etag']:
+            request.headers.setdefault('If-None-Match', record['etag'])
+        if record['last_modified']:
+            request.headers.setdefault('If-Modified-Since', record['last_modified'])
+        # let the 304 through HttpErrorMiddleware so the spider can carry the item forward
+        handle_statuses = list(request.meta.get('handle_httpstatus_list', []))
+        if 304 not in handle_statuses:
+            request.meta['handle_httpstatus_list'] = handle_statuses + [304]
+        return None
+
+    def process_response(self, request, response, spider):
+        if not request.meta.get('incremental'):
+            return response
+        record = request.meta.get('fingerprint_record')
+        if response.status == 304 and record is not None:
+            request.meta['previous_item'] = record['item']
+            self.stats.inc_value('incremental/not_modified')
+            return response
+        body_hash = content_hash(response.body)
+        if record is not None and record['content_hash'] == body_hash:
+            request.meta['previous_item'] = record['item']
+            self.stats.inc_value('incremental/unchanged_content')
+            return response
+        request.meta['fingerprint'] = (_header(response, 'ETag'), _header(response, 'Last-Modified'), body_hash)
+        self.stats.inc_value('incremental/changed')
+        return response
+
+    def item_scraped(self, item, response, spider):
+        fingerprint = response.meta.get('fingerprint')
+        if fingerprint is None:
+            return
+        etag, last_modified, body_hash = fingerprint
+        self.store.put(response.meta.get('fingerprint_url', response.url), etag, last_modified, body_hash, item)
+        self.pending_commits += 1
+        if self.pending_commits >= self.commit_every:
+            self.store.commit()
+            self.pending_commits = 0
+
+    def spider_closed(self, spider):
+        self.store.close()
+
+
+def _header(response, name):
+    value = response.headers.get(name)
+    return value.decode('latin-1') if value is not None else None
+
+
+class AdaptiveConcurrencyMiddleware(object):
+    # Downloader middleware that feeds response latency, status codes and download errors of every request to the
+    # AdaptiveConcurrency extension, which adjusts the concurrency and delay of the request's downloader slot.
+    # It sits above RetryMiddleware (DOWNLOADER_MIDDLEWARES order > 550) so it sees 429s before they are retried.
+    #
+    # A throttled request (429 / 503) is sent again once the server asks for it (Retry-After), the slot's delay has
+    # passed and its backoff is over, without going through RetryMiddleware: being throttled says nothing about the
+    # page, so it shouldn't use up the RETRY_TIMES meant for failing ones. After ADAPTIVE_MAX_RESCHEDULES of these the
+    # response is handed on to RetryMiddleware like any other.
+
+    def __init__(self, controller, max_reschedules=10, stats=None):
+        self.controller = controller
+        self.max_reschedules = max_reschedules
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        for extension in crawler.extensions.middlewares:
+            if isinstance(extension, AdaptiveConcurrency):
+                return cls(extension, crawler.settings.getint('ADAPTIVE_MAX_RESCHEDULES', 10), crawler.stats)
+        raise NotConfigured('AdaptiveConcurrencyMiddleware needs the AdaptiveConcurrency extension in EXTENSIONS')
+
+    async def process_response(self, request, response, spider):
+        key = request.meta.get('download_slot')
+        retry_after = _retry_after(response)
+        self.controller.observe(key, latency=request.meta.get('download_latency'), status=response.status,
+                                retry_after=retry_after)
+        reschedules = request.meta.get('adaptive_reschedules', 0)
+        if response.status not in (429, 503) or key is None or reschedules >= self.max_reschedules:
+            return response
+        await sleep(self.controller.throttle_wait(key, retry_after))
+        if self.stats is not None:
+            self.stats.inc_value('adaptive_concurrency/rescheduled')
+        rescheduled = request.replace(dont_filter=True)
+        rescheduled.meta['adaptive_reschedules'] = reschedules + 1
+        return rescheduled
+
+    def process_exception(self, request, exception, spider):
+        self.controller.observe(request.meta.get('download_slot'), error=True)
+        return None
+
+
+# Retry-After in seconds (the HTTP-date form is ignored)
+def _retry_after(response):
+    value = _header(response, 'Retry-After')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class FrontierMiddleware(object):
+    # Spider middleware that makes a crawl resumable and never lets the same url be requested twice in a run
+    # (enable by setting FRONTIER_DIR).
+    #
+    # Every request coming out of the spider is recorded in the disk-backed Frontier; requests whose url was already
+    # seen are dropped. A request is marked done once its response has been fully processed and every item it produced
+    # has made it through the item pipelines (item_scraped), and the frontier is checkpointed every
+    # FRONTIER_CHECKPOINT_INTERVAL seconds. When a crawl that died is restarted with the same
+    # FRONTIER_DIR, the pending requests are issued instead of start_urls. A crawl that finishes clears the frontier.
+
+    def __init__(self, crawler, path, checkpoint_interval=30.0):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.frontier = Frontier(path)
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.time()
+        # frontier url -> [items not through the pipelines yet, whether the spider output is fully consumed]
+        self.outstanding = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        frontier_dir = crawler.settings.get('FRONTIER_DIR')
+        if not frontier_dir:
+            raise NotConfigured
+        if not os.path.exists(frontier_dir):
+            os.makedirs(frontier_dir)
+        m = cls(crawler, frontier_path(frontier_dir, crawler.spidercls.name),
+                crawler.settings.getfloat('FRONTIER_CHECKPOINT_INTERVAL', 30.0))
+        crawler.signals.connect(m.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(m.item_scraped, signal=signals.item_dropped)
+        crawler.signals.connect(m.spider_closed, signal=signals.spider_closed)
+        return m
+
+    def process_start_requests(self, start_requests, spider):
+        pending = self.resume_requests(spider)
+        if pending:
+            for r in pending:
+                yield r
+            return
+        for r in start_requests:
+            if self.record(r):
+                yield r
+        self.frontier.checkpoint()
+
+    # same as process_start_requests, for scrapy versions with asynchronous start requests
+    async def process_start(self, start):
+        pending = self.resume_requests(self.crawler.spider)
+        if pending:
+            for r in pending:
+                yield r
+            return
+        async for r in start:
+            if not isinstance(r, Request) or self.record(r):
+                yield r
+        self.frontier.checkpoint()
+
+    def process_spider_output(self, response, result, spider):
+        for x in result:
+            if self.keep(x, response):
+                yield x
+        self.processed(response)
+
+    # same as process_spider_output, for scrapy versions with asynchronous spider output
+    async def process_spider_output_async(self, response, result, spider):
+        async for x in result:
+            if self.keep(x, response):
+                yield x
+        self.processed(response)
+
+    def resume_requests(self, spider):
+        pending = self.frontier.pending()
+        if not pending:
+            return []
+        spider.logger.info('Resuming crawl from %s: %d pending requests (%d already done)',
+                           self.frontier.path, len(pending), self.frontier.count(done=True))
+        self.stats.set_value('frontier/resumed', len(pending))
+        requests = []
+        for url, callback, meta in pending:
+            meta['frontier_url'] = url
+            requests.append(Request(url=url, callback=getattr(spider, callback) if callback else None, meta=meta,
+                                    dont_filter=True))
+        return requests
+
+    def keep(self, x, response):
+        if isinstance(x, Request):
+            if not self.record(x):
+                self.stats.inc_value('frontier/duplicates')
+                return False
+            return True
+        # an item - the response isn't done until the pipelines have handled it
+        self.outstanding.setdefault(_frontier_url(response), [0, False])[0] += 1
+        return True
+
+    def processed(self, response):
+        # every request the response produced is in the frontier now; it doesn't need fetching again once its items
+        # are through the pipelines as well
+        url = _frontier_url(response)
+        entry = self.outstanding.get(url)
+        if entry is None:
+            self.mark_done(url)
+        else:
+            entry[1] = True
+            if entry[0] <= 0:
+                del self.outstanding[url]
+                self.mark_done(url)
+
+    # item_scraped and item_dropped - items that fail in a pipeline (item_error) leave their response pending
+    def item_scraped(self, item, response, spider, **kwargs):
+        url = _frontier_url(response)
+        entry = self.outstanding.get(url)
+        if entry is None:
+            return
+        entry[0] -= 1
+        if entry[0] <= 0 and entry[1]:
+            del self.outstanding[url]
+            self.mark_done(url)
+
+    def mark_done(self, url):
+        self.frontier.mark_done(url)
+        self.maybe_checkpoint()
+
+    def record(self, request):
+        callback = getattr(request.callback, '__name__', None)
+        if not self.frontier.add(request.url, callback, request.meta):
+            return False
+        # keep the key even if the request gets redirected
+        request.meta['frontier_url'] = request.url
+        return True
+
+    def maybe_checkpoint(self):
+        now = time.time()
+        if now - self.last_checkpoint >= self.checkpoint_interval:
+            self.frontier.checkpoint()
+            self.last_checkpoint = now
+            self.stats.inc_value('frontier/checkpoints')
+
+    def spider_closed(self, spider, reason):
+        if reason == 'finished':
+            pending = self.frontier.count(done=False)
+            if pending:
+                spider.logger.info('Crawl finished with %d requests that never completed', pending)
+            self.frontier.clear()
+        self.frontier.close()
+
+
+def _frontier_url(response):
+    return response.meta.get('frontier_url', response.url)
+
+
+class ShardDedupMiddleware(object):
+    # Spider middleware for sharded crawls: requests flagged with meta['dedup'] (the charity pages) are claimed in the
+    # SHARD_DEDUP_DB shared by all shards, and dropped if another shard holds the url. The claim is made final once the
+    # item of the page has gone through the item pipelines.
+
+    def __init__(self, path, stats):
+        self.path = path
+        self.seen = None
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('SHARD_DEDUP_DB')
+        if not path:
+            raise NotConfigured
+        m = cls(path, crawler.stats)
+        crawler.signals.connect(m.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(m.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(m.item_scraped, signal=signals.item_dropped)
+        crawler.signals.connect(m.spider_closed, signal=signals.spider_closed)
+        return m
+
+    def spider_opened(self, spider):
+        self.seen = SharedSeenSet(self.path, getattr(spider, 'shard', 0))
+
+    def process_spider_output(self, response, result, spider):
+        # a directory page yields a few hundred charity requests - claim them all in one transaction
+        result = list(result)
+        for x in self.filter(result):
+            yield x
+
+    async def process_spider_output_async(self, response, result, spider):
+        buffered = [x async for x in result]
+        for x in self.filter(buffered):
+            yield x
+
+    def filter(self, result):
+        urls = [x.url for x in result if isinstance(x, Request) and x.meta.get('dedup')]
+        if not urls:
+            return result
+        won = self.seen.claim(urls)
+        kept = []
+        for x in result:
+            if isinstance(x, Request) and x.meta.get('dedup'):
+                if x.url not in won:
+                    self.stats.inc_value('shard/duplicates')
+                    continue
+                # keep the claimed url even if the request gets redirected
+                x.meta['dedup_url'] = x.url
+            kept.append(x)
+        return kept
+
+    def item_scraped(self, item, response, spider, **kwargs):
+        url = response.meta.get('dedup_url')
+        if url is not None:
+            self.seen.mark_done(url)
+
+    def spider_closed(self, spider):
+        self.seen.close()
+
+
+class ResponseArchiveMiddleware(object):
+    # Downloader middleware that keeps every successful response in the compressed, content-addressed
+    # ResponseArchive under ARCHIVE_DIR, together with the name of the callback that will parse it, so the crawl can
+    # be re-parsed offline with `python -m charity_scraper.reparse`. It sits below HttpCompressionMiddleware so the
+    # archived bodies are the decoded pages.
+
+    def __init__(self, root, commit_every=200):
+        self.archive = ResponseArchive(root)
+        self.commit_every = commit_every
+        self.pending_commits = 0
+        self.stats = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        root = crawler.settings.get('ARCHIVE_DIR')
+        if not root:
+            raise NotConfigured
+        m = cls(root)
+        m.stats = crawler.stats
+        crawler.signals.connect(m.spider_closed, signal=signals.spider_closed)
+        return m
+
+    def process_response(self, request, response, spider):
+        if response.status != 200 or not response.body:
+            return response
+        callback = getattr(request.callback, '__name__', None) or 'parse'
+        self.archive.put(request.meta.get('fingerprint_url', request.url), response.body, response.status,
+                         _header(response, 'Content-Type'), callback)
+        self.stats.inc_value('archive/responses')
+        self.pending_commits += 1
+        if self.pending_commits >= self.commit_every:
+            self.archive.commit()
+            self.pending_commits = 0
+        return response
+
+    def spider_closed(self, spider):
+        self.archive.close()
+
+
+class CallbackTimingMiddleware(object):
+    # Spider middleware recording how long each spider callback spends producing its output, per callback, in the
+    # charity_callback_seconds histogram (reported by the CrawlMetrics extension). It has to be the middleware closest
+    # to the spider (highest SPIDER_MIDDLEWARES order) so that only the callback itself runs inside the timed next().
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        return cls(registry_for(crawler))
+
+    def process_spider_output(self, response, result, spider):
+        histogram = self.registry.histogram('charity_callback_seconds', callback=_callback_name(response))
+        elapsed = 0.0
+        iterator = iter(result)
+        while True:
+            start = time.perf_counter()
+            try:
+                x = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - start
+                break
+            elapsed += time.perf_counter() - start
+            yield x
+        histogram.observe(elapsed)
+
+    async def process_spider_output_async(self, response, result, spider):
+        histogram = self.registry.histogram('charity_callback_seconds', callback=_callback_name(response))
+        elapsed = 0.0
+        iterator = result.__aiter__()
+        while True:
+            start = time.perf_counter()
+            try:
+                x = await iterator.__anext__()
+            except StopAsyncIteration:
+                elapsed += time.perf_counter() - start
+                break
+            elapsed += time.perf_counter() - start
+            yield x
+        histogram.observe(elapsed)
+
+
+def _callback_name(response):
+    request = getattr(response, 'request', None)
+    return getattr(getattr(request, 'callback', None), '__name__', None) or 'parse'
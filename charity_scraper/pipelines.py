@@ -5,10 +5,25 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
+import os
 
 # from scrapy.exceptions import DropItem
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
 from scrapy.exporters import CsvItemExporter
 
+from charity_scraper.delta import DeltaWriter, Snapshot
+from charity_scraper.frontier import frontier_path, has_pending
+from charity_scraper.instrumentation import timed_stage
+from charity_scraper.items import FIELD_ORDER, CharityItem
+from charity_scraper.store import CharityStore
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
 
 # class ValidateItemPipeline(object):
 
@@ -20,21 +35,247 @@ from scrapy.exporters import CsvItemExporter
 
 
 class WriteItemPipeline(object):
+    # When the crawl resumes from FRONTIER_DIR (see FrontierMiddleware) the rows of the earlier run are kept and the
+    # new ones are appended; otherwise the file is rewritten.
+
+    def __init__(self, filename='charities.csv', append=False):
+        self.filename = filename
+        self.append = append
 
-    def __init__(self):
-        self.filename = 'charities.csv'
+    @classmethod
+    def from_crawler(cls, crawler):
+        frontier_dir = crawler.settings.get('FRONTIER_DIR')
+        resuming = bool(frontier_dir) and has_pending(frontier_path(frontier_dir, crawler.spidercls.name))
+        return cls(crawler.settings.get('CSV_EXPORT_PATH', 'charities.csv'), append=resuming)
 
     def open_spider(self, spider):
-        self.csvfile = open(self.filename, 'wb')
-        self.exporter = CsvItemExporter(self.csvfile)
+        append = self.append and os.path.exists(self.filename) and os.path.getsize(self.filename) > 0
+        if append:
+            spider.logger.info('Resumed crawl: appending to %s', self.filename)
+        self.csvfile = open(self.filename, 'ab' if append else 'wb')
+        self.exporter = CsvItemExporter(self.csvfile, include_headers_line=not append, fields_to_export=FIELD_ORDER)
         self.exporter.start_exporting()
 
     def close_spider(self, spider):
         self.exporter.finish_exporting()
         self.csvfile.close()
 
+    @timed_stage('WriteItemPipeline')
     def process_item(self, item, spider):
         self.exporter.export_item(item)
         return item
 
 
+# column types for the columnar export - ints stay int64, scores are floats, and the low-cardinality text columns are
+# dictionary encoded; anything not listed is written as a plain string column
+FLOAT_FIELDS = ['score_overall', 'score_financial', 'score_acc_trans']
+DICTIONARY_FIELDS = ['category_l1', 'category_l2', 'location_state']
+STRING_FIELDS = ['name', 'tagline', 'location_city', 'location_zip', 'mission', 'leader_comp', 'url']
+
+
+def charity_schema():
+    columns = []
+    for field in CharityItem.fields:
+        if field in FLOAT_FIELDS:
+            columns.append(pa.field(field, pa.float64()))
+        elif field in DICTIONARY_FIELDS:
+            columns.append(pa.field(field, pa.dictionary(pa.int32(), pa.string())))
+        elif field in STRING_FIELDS:
+            columns.append(pa.field(field, pa.string()))
+        else:
+            columns.append(pa.field(field, pa.int64()))
+    return pa.schema(columns)
+
+
+class ColumnarItemPipeline(object):
+    # Buffers items into typed column batches and writes them as Parquet row groups or Arrow IPC record batches.
+    #
+    # settings:
+    #     COLUMNAR_EXPORT_FORMAT - 'parquet' (default) or 'arrow'
+    #     COLUMNAR_EXPORT_PATH - output file, defaults to charities.parquet / charities.arrow
+    #     COLUMNAR_BATCH_SIZE - items per row group / record batch (default 5000)
+
+    def __init__(self, export_format='parquet', path=None, batch_size=5000):
+        if export_format not in ('parquet', 'arrow'):
+            raise NotConfigured('COLUMNAR_EXPORT_FORMAT must be parquet or arrow, not %r' % export_format)
+        self.export_format = export_format
+        self.filename = path or 'charities.' + export_format
+        self.batch_size = batch_size
+        self.schema = charity_schema()
+        self.writer = None
+        self.sink = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if pa is None:
+            raise NotConfigured('pyarrow is required for ColumnarItemPipeline')
+        settings = crawler.settings
+        return cls(settings.get('COLUMNAR_EXPORT_FORMAT', 'parquet'), settings.get('COLUMNAR_EXPORT_PATH'),
+                   settings.getint('COLUMNAR_BATCH_SIZE', 5000))
+
+    def open_spider(self, spider):
+        self.columns = {field: [] for field in self.schema.names}
+        # the dictionaries grow over the crawl and are shared by every batch, so the arrow file only needs deltas
+        self.dictionaries = {field: {} for field in DICTIONARY_FIELDS}
+        self.buffered = 0
+        if self.export_format == 'parquet':
+            self.writer = pq.ParquetWriter(self.filename, self.schema)
+        else:
+            self.sink = pa.OSFile(self.filename, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, self.schema,
+                                          options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def close_spider(self, spider):
+        self.write_batch()
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+    @timed_stage('ColumnarItemPipeline')
+    def process_item(self, item, spider):
+        for field, values in self.columns.items():
+            values.append(item.get(field))
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            self.write_batch()
+        return item
+
+    def write_batch(self):
+        if self.buffered == 0:
+            return
+        arrays = []
+        for field in self.schema:
+            values = self.columns[field.name]
+            if field.name in self.dictionaries:
+                arrays.append(self.dictionary_array(field.name, values))
+            else:
+                arrays.append(pa.array(values, type=field.type))
+            self.columns[field.name] = []
+        batch = pa.record_batch(arrays, schema=self.schema)
+        if self.export_format == 'parquet':
+            self.writer.write_table(pa.Table.from_batches([batch]), row_group_size=self.buffered)
+        else:
+            self.writer.write_batch(batch)
+        self.buffered = 0
+
+    def dictionary_array(self, field_name, values):
+        dictionary = self.dictionaries[field_name]
+        indices = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+            else:
+                indices.append(dictionary.setdefault(value, len(dictionary)))
+        return pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32()), pa.array(list(dictionary), type=pa.string()))
+
+
+class SqliteItemPipeline(object):
+    # Upserts the items into the SQLite store of charity_scraper.store, keyed on the charity's orgid, so a re-crawl
+    # updates the existing rows. Items are written in batches, one transaction each.
+    #
+    # settings:
+    #     SQLITE_EXPORT_PATH - database file (default charities.db)
+    #     SQLITE_BATCH_SIZE - items per transaction (default 1000)
+
+    def __init__(self, path='charities.db', batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.store = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(settings.get('SQLITE_EXPORT_PATH', 'charities.db'), settings.getint('SQLITE_BATCH_SIZE', 1000))
+
+    def open_spider(self, spider):
+        self.store = CharityStore(self.path)
+        self.buffer = []
+
+    def close_spider(self, spider):
+        self.write_batch()
+        self.store.close()
+
+    @timed_stage('SqliteItemPipeline')
+    def process_item(self, item, spider):
+        self.buffer.append(item)
+        if len(self.buffer) >= self.batch_size:
+            self.write_batch()
+        return item
+
+    def write_batch(self):
+        if not self.buffer:
+            return
+        self.store.upsert(self.buffer)
+        self.store.commit()
+        self.buffer = []
+
+
+# crawl stats of requests whose page never made it through the spider: given up after the retries, failed downloads,
+# callback errors and final responses outside 2xx
+LOST_REQUEST_STATS = ['retry/max_reached', 'downloader/exception_count', 'httperror/response_ignored_count']
+
+
+def lost_requests(stats):
+    return dict((key, value) for key, value in stats.get_stats().items()
+                if value and (key in LOST_REQUEST_STATS or key.startswith('spider_exceptions/')))
+
+
+class DeltaExportPipeline(object):
+    # Writes what changed since the previous crawl - added, changed (with the changed fields) and removed charities -
+    # under DELTA_DIR/<crawl id>/, so incremental consumers only process the delta (see charity_scraper.delta).
+    #
+    # A charity the crawl didn't produce is only reported removed when the crawl finished normally and lost no
+    # requests (LOST_REQUEST_STATS): a page that 429'd out, or a directory page whose charities were never requested,
+    # is missing from the crawl without being gone from the site.
+    #
+    # settings:
+    #     DELTA_DIR - directory of the delta exports (default deltas)
+    #     DELTA_SNAPSHOT - SQLite file with the content hashes and items of the previous crawl (default
+    #         charities.snapshot.db)
+
+    def __init__(self, root='deltas', snapshot_path='charities.snapshot.db', stats=None):
+        self.root = root
+        self.snapshot_path = snapshot_path
+        self.stats = stats
+        self.writer = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        pipeline = cls(settings.get('DELTA_DIR', 'deltas'), settings.get('DELTA_SNAPSHOT', 'charities.snapshot.db'),
+                       crawler.stats)
+        # the delta is finished from spider_closed rather than close_spider, since only the signal has the reason
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.snapshot = Snapshot(self.snapshot_path)
+        self.writer = DeltaWriter(self.snapshot, self.root)
+
+    def spider_closed(self, spider, reason):
+        self.finish(spider, reason)
+
+    def close_spider(self, spider):
+        # without from_crawler there is no spider_closed, so assume the crawl finished
+        if self.stats is None:
+            self.finish(spider, 'finished')
+
+    def finish(self, spider, reason):
+        if self.writer is None:
+            return
+        lost = lost_requests(self.stats) if self.stats is not None else {}
+        if lost:
+            spider.logger.warning('not checking for removed charities, the crawl lost requests: %s',
+                                  ', '.join('%s=%s' % (key, value) for key, value in sorted(lost.items())))
+        path = self.writer.finish(check_removed=reason == 'finished' and not lost, reason=reason, lost=lost)
+        if self.stats is not None:
+            for name, n in self.writer.counts.items():
+                self.stats.set_value('delta/%s' % name, n)
+        spider.logger.info('delta export of %s written to %s', self.writer.crawl_id, path)
+        self.snapshot.close()
+        self.writer = None
+
+    @timed_stage('DeltaExportPipeline')
+    def process_item(self, item, spider):
+        self.writer.add(item)
+        return item
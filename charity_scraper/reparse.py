@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# Offline re-parse: replays the raw response archive (see ResponseArchiveMiddleware) through the spider callbacks on
+# all CPU cores, without any network access, and writes the items like WriteItemPipeline does.
+#
+# After fixing a field in parse_charity_page, regenerate the dataset from the last archived crawl with:
+#     python -m charity_scraper.reparse --archive archive --output charities.csv [--processes 8]
+
+import argparse
+import multiprocessing
+import sys
+import time
+
+from scrapy.exporters import CsvItemExporter
+from scrapy.http import HtmlResponse, Request
+
+from charity_scraper.archive import ResponseArchive
+from charity_scraper.items import CharityItem
+from charity_scraper.spiders.charity_spider import CharitySpider
+
+# per worker process state, set up by init_worker
+_worker = {}
+
+
+def init_worker(archive_root, callback):
+    _worker['archive'] = ResponseArchive(archive_root, readonly=True)
+    _worker['callback'] = getattr(CharitySpider(), callback)
+
+
+# parse a chunk of archived responses, returns the scraped items as dicts and the urls that failed to parse
+def parse_chunk(entries):
+    items = []
+    errors = []
+    for url, digest, status, content_type in entries:
+        headers = {'Content-Type': content_type} if content_type else None
+        response = HtmlResponse(url=url, status=status, headers=headers, body=_worker['archive'].load(digest),
+                                request=Request(url))
+        try:
+            for result in _worker['callback'](response):
+                if not isinstance(result, Request):
+                    items.append(dict(result))
+        except Exception as e:
+            errors.append((url, repr(e)))
+    return items, errors
+
+
+def chunks(entries, size):
+    for i in range(0, len(entries), size):
+        yield entries[i:i + size]
+
+
+def reparse(archive_root, output, callback='parse_charity_page', processes=None, chunk_size=200):
+    archive = ResponseArchive(archive_root, readonly=True)
+    entries = archive.entries(callback)
+    archive.close()
+
+    count = 0
+    errors = []
+    with open(output, 'wb') as f:
+        exporter = CsvItemExporter(f)
+        exporter.start_exporting()
+        with multiprocessing.Pool(processes, initializer=init_worker, initargs=(archive_root, callback)) as pool:
+            for items, chunk_errors in pool.imap(parse_chunk, chunks(entries, chunk_size)):
+                for item in items:
+                    exporter.export_item(CharityItem(item))
+                count += len(items)
+                errors.extend(chunk_errors)
+        exporter.finish_exporting()
+    return len(entries), count, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-parse an archived crawl through the spider callbacks, offline')
+    parser.add_argument('--archive', default='archive', help='ARCHIVE_DIR of the crawl to replay')
+    parser.add_argument('--output', default='charities.csv')
+    parser.add_argument('--callback', default='parse_charity_page', help='spider callback to replay the responses through')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--chunk-size', type=int, default=200, help='responses per task sent to a worker')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    pages, items, errors = reparse(args.archive, args.output, args.callback, args.processes, args.chunk_size)
+    print('re-parsed %d pages into %d items in %.1fs -> %s' % (pages, items, time.time() - start, args.output))
+    for url, error in errors[:20]:
+        print('  failed: %s %s' % (url, error))
+    if len(errors) > 20:
+        print('  ... and %d more' % (len(errors) - 20))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,6 +16,87 @@ NEWSPIDER_MODULE = 'charity_scraper.spiders'
 
 ITEM_PIPELINES = {'charity_scraper.pipelines.WriteItemPipeline': 200}
 
+DOWNLOADER_MIDDLEWARES = {
+    'charity_scraper.middlewares.IncrementalCrawlMiddleware': 560,
+    'charity_scraper.middlewares.ResponseArchiveMiddleware': 580,
+    'charity_scraper.middlewares.AdaptiveConcurrencyMiddleware': 800,
+}
+
+SPIDER_MIDDLEWARES = {
+    'charity_scraper.middlewares.FrontierMiddleware': 10,
+    'charity_scraper.middlewares.ShardDedupMiddleware': 20,
+    'charity_scraper.middlewares.CallbackTimingMiddleware': 990,
+}
+
+EXTENSIONS = {
+    'charity_scraper.extensions.AdaptiveConcurrency': 500,
+    'charity_scraper.extensions.CrawlMetrics': 510,
+}
+
+# Incremental re-crawl: send conditional requests for charity pages and carry forward the previously exported item
+# when a page hasn't changed (run with -s INCREMENTAL_ENABLED=1)
+INCREMENTAL_ENABLED = False
+INCREMENTAL_STORE = 'fingerprints.db'
+
+# Columnar export - add 'charity_scraper.pipelines.ColumnarItemPipeline' to ITEM_PIPELINES to also write the items as
+# Parquet row groups or Arrow IPC record batches (needs pyarrow)
+COLUMNAR_EXPORT_FORMAT = 'parquet'
+COLUMNAR_EXPORT_PATH = None
+COLUMNAR_BATCH_SIZE = 5000
+
+# SQLite export - add 'charity_scraper.pipelines.SqliteItemPipeline' to ITEM_PIPELINES to also upsert the items into
+# an indexed database keyed on the charity (query it with charity_reader.read_sqlite)
+SQLITE_EXPORT_PATH = 'charities.db'
+SQLITE_BATCH_SIZE = 1000
+
+# Delta export - add 'charity_scraper.pipelines.DeltaExportPipeline' to ITEM_PIPELINES to write the charities that
+# were added, changed or removed since the previous crawl under DELTA_DIR/<crawl id>/ (load with charity_reader.read_delta)
+DELTA_DIR = 'deltas'
+DELTA_SNAPSHOT = 'charities.snapshot.db'
+
+# Adaptive concurrency: adjust per-endpoint concurrency and download delay from the measured latency, error rate and
+# 429s, within the bounds below (run with -s ADAPTIVE_CONCURRENCY_ENABLED=1). CONCURRENT_REQUESTS still caps the total.
+ADAPTIVE_CONCURRENCY_ENABLED = False
+ADAPTIVE_MIN_CONCURRENCY = 1
+ADAPTIVE_MAX_CONCURRENCY = 16
+ADAPTIVE_START_CONCURRENCY = 2
+ADAPTIVE_MIN_DELAY = 0.0
+ADAPTIVE_MAX_DELAY = 30.0
+# a delay makes scrapy send one request at a time per endpoint, so it is only used once concurrency is at the minimum
+ADAPTIVE_START_DELAY = 0.0
+# smoothed response latency (seconds) above which concurrency is stepped down
+ADAPTIVE_TARGET_LATENCY = 1.0
+ADAPTIVE_MAX_ERROR_RATE = 0.05
+# seconds between two decisions for an endpoint (429s trigger a backoff right away)
+ADAPTIVE_INTERVAL = 1.0
+# share of the concurrency kept on a backoff
+ADAPTIVE_BACKOFF_FACTOR = 0.75
+# seconds after a 429 during which concurrency stays below (and the delay above) what it was when the 429 came
+ADAPTIVE_LIMIT_HOLD = 60.0
+# times a throttled request is sent again after its Retry-After before RetryMiddleware (RETRY_TIMES) takes over
+ADAPTIVE_MAX_RESCHEDULES = 10
+ADAPTIVE_STATS_INTERVAL = 30.0
+
+# Crash-safe checkpoint / resume: the pending requests and seen urls of the crawl are kept in FRONTIER_DIR, so a crawl
+# that dies can be restarted with the same directory and picks up where it stopped (e.g. -s FRONTIER_DIR=crawl_state)
+FRONTIER_DIR = None
+FRONTIER_CHECKPOINT_INTERVAL = 30.0
+
+# Sharded crawls (see charity_scraper/sharding.py): the SQLite file the shards use to claim charity urls
+SHARD_DEDUP_DB = None
+
+# Raw response archive for offline re-parsing with `python -m charity_scraper.reparse` (e.g. -s ARCHIVE_DIR=archive)
+ARCHIVE_DIR = None
+
+# Hot-path instrumentation: callback, pipeline and download latency histograms, queue depth and items/sec in the crawl
+# stats, and every METRICS_INTERVAL seconds in the Prometheus text file METRICS_FILE (run with -s METRICS_ENABLED=1)
+METRICS_ENABLED = False
+METRICS_FILE = 'crawl_metrics.prom'
+METRICS_INTERVAL = 15.0
+
+# Output file of WriteItemPipeline
+CSV_EXPORT_PATH = 'charities.csv'
+
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'kobzajj (+http://www.yourdomain.com)'
 
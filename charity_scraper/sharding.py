@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Sharded crawl runner: splits the crawl over N worker processes (or machines) and merges their exports.
+#
+# Each shard is a separate `scrapy crawl charity_spider` process with -a shard=i -a shards=N, crawling its share of
+# the directory letters (--by letter) or of the charity urls by hash (--by url). The shards claim charity urls in a
+# shared SQLite dedup file, so a charity listed under several letters is only fetched once, and each shard writes its
+# own CSV export which the merge step combines into one dataset.
+#
+# The dedup file belongs to one crawl id (<shard dir>/seen.<crawl id>.db): every run without --crawl-id is a new crawl
+# with an empty store. A claim stays with its shard until the shard has exported the item, so a shard that failed is
+# rerun with the same crawl id and --only <shard> and picks up the urls it had claimed.
+#
+# one machine, 4 processes:
+#     python -m charity_scraper.sharding --shards 4 --output charities.csv
+# several machines sharing a directory (e.g. an NFS mount), 8 shards in total, all with the same crawl id:
+#     node 1: python -m charity_scraper.sharding --shards 8 --only 0,1,2,3 --crawl-id jan --shard-dir /mnt/crawl --no-merge
+#     node 2: python -m charity_scraper.sharding --shards 8 --only 4,5,6,7 --crawl-id jan --shard-dir /mnt/crawl --no-merge
+#     then:   python -m charity_scraper.sharding --shards 8 --shard-dir /mnt/crawl --merge-only --output charities.csv
+
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import time
+
+from charity_scraper.frontier import SharedSeenSet
+
+
+def dedup_path(shard_dir, crawl_id):
+    return os.path.join(shard_dir, 'seen.%s.db' % crawl_id)
+
+
+def shard_export_path(shard_dir, shard):
+    return os.path.join(shard_dir, 'charities.shard%d.csv' % shard)
+
+
+def shard_command(shard, shards, shard_by, shard_dir, dedup_db, extra_settings, start_url=None):
+    command = [sys.executable, '-m', 'scrapy', 'crawl', 'charity_spider',
+               '-a', 'shard=%d' % shard, '-a', 'shards=%d' % shards, '-a', 'shard_by=%s' % shard_by,
+               '-s', 'CSV_EXPORT_PATH=%s' % shard_export_path(shard_dir, shard),
+               '-s', 'SHARD_DEDUP_DB=%s' % dedup_db,
+               '-s', 'LOG_FILE=%s' % os.path.join(shard_dir, 'shard%d.log' % shard)]
+    if start_url is not None:
+        command += ['-a', 'start_url=%s' % start_url]
+    for setting in extra_settings:
+        command += ['-s', setting]
+    return command
+
+
+# run the given shards as parallel processes, returns the shards that failed
+def run_shards(shard_ids, shards, shard_by, shard_dir, dedup_db, extra_settings, start_url=None):
+    processes = {}
+    for shard in shard_ids:
+        processes[shard] = subprocess.Popen(shard_command(shard, shards, shard_by, shard_dir, dedup_db, extra_settings,
+                                                          start_url))
+    failed = []
+    for shard, process in processes.items():
+        if process.wait() != 0:
+            failed.append(shard)
+    return failed
+
+
+# combine the per-shard CSV exports into one file (the header is written once, and a charity exported by more than
+# one shard - e.g. by a shard that was rerun - only once)
+def merge_exports(paths, output):
+    header = None
+    rows = 0
+    seen_urls = set()
+    with open(output, 'w', newline='') as out:
+        writer = csv.writer(out)
+        for path in paths:
+            with open(path, newline='') as f:
+                reader = csv.reader(f)
+                shard_header = next(reader, None)
+                if shard_header is None:
+                    continue
+                if header is None:
+                    header = shard_header
+                    writer.writerow(header)
+                # the exporter follows CharityItem's field order, but don't rely on it
+                order = [shard_header.index(field) for field in header]
+                url_index = header.index('url') if 'url' in header else None
+                for row in reader:
+                    row = [row[i] for i in order]
+                    if url_index is not None and row[url_index]:
+                        if row[url_index] in seen_urls:
+                            continue
+                        seen_urls.add(row[url_index])
+                    writer.writerow(row)
+                    rows += 1
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a sharded charity crawl and merge the shard exports')
+    parser.add_argument('--shards', type=int, required=True, help='total number of shards')
+    parser.add_argument('--only', help='comma separated shard ids to run on this machine (default: all)')
+    parser.add_argument('--by', choices=['letter', 'url'], default='letter', help='partition by directory letter or url hash')
+    parser.add_argument('--shard-dir', default='shards', help='directory for shard exports, logs and the dedup store')
+    parser.add_argument('--crawl-id', help='crawl the dedup store belongs to - reuse it to rerun shards of a crawl, or '
+                                           'to split one crawl over machines (required with --only; default: a new id)')
+    parser.add_argument('--reset', action='store_true', help='start the dedup store of the crawl id from scratch')
+    parser.add_argument('--output', default='charities.csv', help='merged export')
+    parser.add_argument('--no-merge', action='store_true', help="don't merge after the shards finish")
+    parser.add_argument('--merge-only', action='store_true', help='only merge existing shard exports')
+    parser.add_argument('--start-url', help='crawl another copy of the site (passed to the spider as start_url)')
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra scrapy setting passed to every shard')
+    args = parser.parse_args(argv)
+
+    if args.only and not args.crawl_id and not args.merge_only:
+        parser.error('--only needs --crawl-id, so the shards of one crawl share a dedup store')
+    if not os.path.exists(args.shard_dir):
+        os.makedirs(args.shard_dir)
+
+    if not args.merge_only:
+        crawl_id = args.crawl_id or time.strftime('%Y%m%dT%H%M%S')
+        dedup_db = dedup_path(args.shard_dir, crawl_id)
+        if args.reset:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(dedup_db + suffix):
+                    os.remove(dedup_db + suffix)
+        print('crawl %s, dedup store %s' % (crawl_id, dedup_db))
+        shard_ids = [int(i) for i in args.only.split(',')] if args.only else list(range(args.shards))
+        failed = run_shards(shard_ids, args.shards, args.by, args.shard_dir, dedup_db, args.set, args.start_url)
+        if os.path.exists(dedup_db):
+            seen = SharedSeenSet(dedup_db)
+            unfinished = seen.unfinished()
+            seen.close()
+            for shard in sorted(set(unfinished) & set(shard_ids)):
+                print('shard %d claimed %d charities it never exported - rerun it with --only %d --crawl-id %s'
+                      % (shard, unfinished[shard], shard, crawl_id))
+        if failed:
+            print('shards failed: %s (see %s)' % (', '.join(map(str, failed)), args.shard_dir))
+            return 1
+
+    if args.no_merge:
+        return 0
+    paths = [shard_export_path(args.shard_dir, shard) for shard in range(args.shards)]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        print('missing shard exports: %s' % ', '.join(missing))
+        return 1
+    rows = merge_exports(paths, args.output)
+    print('merged %d charities from %d shards into %s' % (rows, args.shards, args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
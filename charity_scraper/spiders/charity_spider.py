@@ -1,31 +1,90 @@
 # -*- coding: utf-8 -*-
 from scrapy import Spider, Request
 from charity_scraper.items import CharityItem
+from charity_scraper import extractors as ex
+from charity_scraper.frontier import url_key
 import re
 
 
+LOCATION_RE = re.compile(r'([a-zA-Z]+)(\s?)[,][\s][A-Z]{2}[\s]([\d]{5})')
+RATING_LIST = ['one', 'two', 'three', 'four']
+# item field for each row of the income table (blank for the subtotal / header rows that aren't scraped)
+FINANCIAL_TABLE_KEYS = ['', '', 'contributions_gifts_grants', 'contributions_federated_campaigns', 'contributions_membership_dues',
+                        'contributions_fundraising_events', 'contributions_related_organizations', 'contributions_government_grants',
+                        'contributions_tot', 'revenue_program_service', 'primary_revenue_total', 'revenue_other', '',
+                        '', '', 'expenses_program', 'expenses_admin', 'expenses_fundraising', '', '', 'affiliate_payments',
+                        'excess', '', 'net_assets']
+
+
+# convert the star rating title of the scoring table (e.g. 'four stars') to a number, 0 if the charity has no stars
+def parse_rating(title):
+    if title is None:
+        return 0
+    return RATING_LIST.index(title.strip().split(" ")[0]) + 1
+
+
+# convert a dollar amount cell of the income table to an int, empty cells are 0
+def parse_amount(text):
+    if text is None or text == '\xa0':
+        return 0
+    return int(text.replace(',', '').replace('$', ''))
+
+
+# shard a charity url belongs to when the crawl is sharded by url hash - stable across processes and machines
+def url_shard(url, shards):
+    return int.from_bytes(url_key(url)[:4], 'big') % shards
+
+
 class CharitySpider(Spider):
     name = 'charity_spider'
     allowed_urls = ['https://charitynavigator.org']
     start_urls = ['https://charitynavigator.org/index.cfm?bay=search.alpha']
 
+    def __init__(self, start_url=None, shard=0, shards=1, shard_by='letter', *args, **kwargs):
+        super(CharitySpider, self).__init__(*args, **kwargs)
+        # -a start_url=... points the crawl at another copy of the site (e.g. benchmarks/standin_server.py)
+        if start_url is not None:
+            self.start_urls = [start_url]
+        # sharded crawls (see charity_scraper/sharding.py) - this process only crawls its share of the directory
+        # letters (shard_by=letter) or of the charity urls, by hash (shard_by=url)
+        self.shard = int(shard)
+        self.shards = int(shards)
+        if shard_by not in ('letter', 'url'):
+            raise ValueError('shard_by must be letter or url, not %r' % shard_by)
+        self.shard_by = shard_by
+
     def parse(self, response):
         # Find all the urls for the directory pages that make up the full set of charities
-        directory_urls = response.xpath('//*[@class="letters"][1]/a/@href').extract()
+        directory_urls = ex.DIRECTORY_URLS(ex.response_root(response))
+        if self.shard_by == 'letter':
+            directory_urls = [url for i, url in enumerate(directory_urls) if i % self.shards == self.shard]
         for url in directory_urls:
             yield Request(url=url, callback=self.parse_directory_page)
 
     def parse_directory_page(self, response):
         # Find all the urls for the charity pages within the directory page
-        charity_urls = response.xpath('//div[@class="mobile-padding charities"]/a/@href').extract()
+        charity_urls = ex.CHARITY_URLS(ex.response_root(response))
+        if self.shard_by == 'url':
+            charity_urls = [url for url in charity_urls if url_shard(url, self.shards) == self.shard]
         for url in charity_urls:
-            yield Request(url=url, callback=self.parse_charity_page)
+            yield Request(url=url, callback=self.parse_charity_page, meta={'incremental': True, 'dedup': True})
 
     def parse_charity_page(self, response):
+        # the page hasn't changed since the last crawl (see IncrementalCrawlMiddleware), so carry the exported item forward
+        previous_item = response.meta.get('previous_item')
+        if previous_item is not None:
+            item = CharityItem(previous_item)
+            item['url'] = response.url
+            yield item
+            return
+
+        # all the selectors are precompiled in charity_scraper.extractors and run against the lxml tree directly
+        root = ex.response_root(response)
+
         # first scrape the information that's on all the charity pages, regardless of whether it is rated or not
-        name = response.xpath('//h1[@class="charityname"]/text()').extract_first().strip()
-        tagline = response.xpath('//h2[@class="tagline"]/text()').extract_first().strip()
-        [category_l1, category_l2] = response.xpath('//p[@class="crumbs"]/text()').extract_first().strip().split(" : ")
+        name = ex.first(ex.NAME, root).strip()
+        tagline = ex.first(ex.TAGLINE, root).strip()
+        [category_l1, category_l2] = ex.first(ex.CRUMBS, root).strip().split(" : ")
 
         # Initialize a new CharityItem instance for each charity.
         item = CharityItem()
@@ -33,9 +92,11 @@ class CharitySpider(Spider):
         item['tagline'] = tagline
         item['category_l1'] = category_l1
         item['category_l2'] = category_l2
+        item['url'] = response.url
 
-        location_line_flag = 1 * (re.search('([a-zA-Z]+)(\s?)[,][\s][A-Z]{2}[\s]([\d]{5})', re.sub('[\r\n\t\xa0]+', ' ', response.xpath('//div[@id="leftnavcontent"]/div/p[1]/text()').extract()[1]).strip()) is None)
-        location = re.split('[\r\n\t\xa0,]+', response.xpath('//div[@id="leftnavcontent"]/div/p[1]/text()').extract()[1 + location_line_flag])
+        location_lines = ex.LOCATION_LINES(root)
+        location_line_flag = 1 * (LOCATION_RE.search(re.sub('[\r\n\t\xa0]+', ' ', location_lines[1]).strip()) is None)
+        location = re.split('[\r\n\t\xa0,]+', location_lines[1 + location_line_flag])
         if '' in location:
             location.remove('')
         if len(location) == 3:
@@ -48,37 +109,19 @@ class CharitySpider(Spider):
 
         # the rest of the fields can only be filled in if the charity has a rating, so can check if the container object is found in the xpath
         # get the part of the page with the information we want using the xpath
-        container = response.xpath('//div[@class="rating-wrapper"]')
-        if container:
-            # split the page into three sections that have the items we are looking to scrape
-            summary_section = container.xpath('.//div[@class="summaryBox"]')
-            income_section = container.xpath('.//div[@class="summaryBox income-table"]')
-
-            # get all the information from each section
-            # general information outside the container
+        container = ex.first(ex.RATING_WRAPPER, root)
+        if container is not None:
+            # walk the score, metrics and income tables once each - every field below is read from these rows
+            tables = ex.CharityTables(container)
 
             # scoring, mission, and attributes information within the rating wrapper container
-            scoring_table = summary_section.xpath('.//div[@class="shadedtable"]')[0]
-            score_overall = float(scoring_table.xpath('./table/tr[2]/td[2]/text()').extract_first().strip())
-            score_financial = float(scoring_table.xpath('./table/tr[3]/td[2]/text()').extract_first().strip())
-            score_acc_trans = float(scoring_table.xpath('./table/tr[4]/td[2]/text()').extract_first().strip())
-            rating_list = ['one', 'two', 'three', 'four']
-            rating_overall_xpath = scoring_table.xpath('./table/tr[2]/td[3]/strong/svg/title/text()').extract_first()
-            if rating_overall_xpath is not None:
-                rating_overall = rating_list.index(rating_overall_xpath.strip().split(" ")[0]) + 1
-            else:
-                rating_overall = 0
-            rating_financial_xpath = scoring_table.xpath('./table/tr[3]/td[3]/strong/svg/title/text()').extract_first()
-            if rating_financial_xpath is not None:
-                rating_financial = rating_list.index(rating_financial_xpath.strip().split(" ")[0]) + 1
-            else:
-                rating_financial = 0
-            rating_acc_trans_xpath = scoring_table.xpath('./table/tr[3]/td[3]/strong/svg/title/text()').extract_first()
-            if rating_acc_trans_xpath is not None:
-                rating_acc_trans = rating_list.index(rating_acc_trans_xpath.strip().split(" ")[0]) + 1
-            else:
-                rating_acc_trans = 0
-            mission = summary_section.xpath('.//div[@class="summaryBox cn-table"]//p/text()').extract_first().strip()
+            score_overall = float(tables.score.text(2, 2).strip())
+            score_financial = float(tables.score.text(3, 2).strip())
+            score_acc_trans = float(tables.score.text(4, 2).strip())
+            rating_overall = parse_rating(tables.score.rating_title(2, 3))
+            rating_financial = parse_rating(tables.score.rating_title(3, 3))
+            rating_acc_trans = parse_rating(tables.score.rating_title(3, 3))
+            mission = ex.first(ex.MISSION, container).strip()
             # information provided on form 990 - attribute legend: (binary encoded - each bit corresponds to an attribute)
             # 0x1 - independent voting board members
             # 0x2 - no material diversion of assets
@@ -98,29 +141,23 @@ class CharitySpider(Spider):
             # 0x4 - audited financials
             # 0x8 - form 990
             # 0x10 - key staff listed
-            metrics_table = summary_section.xpath('.//div[@class="shadedtable cn-accordion-rating"][2]/div/table')
             attributes_990 = 0
             attributes_website = 0
             for i in range(12):
-                if metrics_table.xpath('./tr[' + str(i+2) + ']/td[3]/img/@src').extract_first() is None:
+                src = tables.metrics.img_src(i + 2, 3)
+                if src is None:
                     continue
-                attributes_990 += 2**i * (re.search('/checked.gif', metrics_table.xpath('./tr[' + str(i+2) + ']/td[3]/img/@src').extract_first()) is not None)
+                attributes_990 += 2**i * ('/checked.gif' in src)
             for j in range(5):
-                if metrics_table.xpath('./tr[' + str(j+15) + ']/td[3]/img/@src').extract_first() is None:
+                src = tables.metrics.img_src(j + 15, 3)
+                if src is None:
                     continue
-                attributes_website += 2**j * (re.search('/checked.gif', metrics_table.xpath('./tr[' + str(j+15) + ']/td[3]/img/@src').extract_first()) is not None)
-            financial_table_keys = ['', '', 'contributions_gifts_grants', 'contributions_federated_campaigns', 'contributions_membership_dues',
-                                     'contributions_fundraising_events', 'contributions_related_organizations', 'contributions_government_grants',
-                                     'contributions_tot', 'revenue_program_service', 'primary_revenue_total', 'revenue_other', '',
-                                     '', '', 'expenses_program', 'expenses_admin', 'expenses_fundraising', '', '', 'affiliate_payments',
-                                     'excess', '', 'net_assets']
-            financial_table_vals = [0 if ((income_section.xpath('./div/div/table/tr[' + str(i+1) + ']/td[2]/text()').extract_first() == '\xa0') or (income_section.xpath('./div/div/table/tr[' + str(i+1) + ']/td[2]/text()').extract_first() is None))
-                                    else int(income_section.xpath('./div/div/table/tr[' + str(i+1) + ']/td[2]/text()').extract_first().replace(',', '').replace('$', ''))
-                                    for i in range(0, 24)]
-            revenue_total = financial_table_vals[financial_table_keys.index('primary_revenue_total')] + financial_table_vals[financial_table_keys.index('revenue_other')]
-            expenses_total = financial_table_vals[financial_table_keys.index('expenses_program')] + financial_table_vals[financial_table_keys.index('expenses_admin')] + financial_table_vals[financial_table_keys.index('expenses_fundraising')]
-
-            leader_comp = container.xpath('.//div[@class="summaryBox cn-accordion-rating"][2]/div/table/tr[2]/td[1]/span/text()').extract_first().strip().replace(',', '').replace('$', '')
+                attributes_website += 2**j * ('/checked.gif' in src)
+            financial_table_vals = [parse_amount(tables.income.text(i + 1, 2)) for i in range(0, 24)]
+            revenue_total = financial_table_vals[FINANCIAL_TABLE_KEYS.index('primary_revenue_total')] + financial_table_vals[FINANCIAL_TABLE_KEYS.index('revenue_other')]
+            expenses_total = financial_table_vals[FINANCIAL_TABLE_KEYS.index('expenses_program')] + financial_table_vals[FINANCIAL_TABLE_KEYS.index('expenses_admin')] + financial_table_vals[FINANCIAL_TABLE_KEYS.index('expenses_fundraising')]
+
+            leader_comp = ex.first(ex.LEADER_COMP, container).strip().replace(',', '').replace('$', '')
 
             item['score_overall'] = score_overall
             item['score_financial'] = score_financial
@@ -132,8 +169,8 @@ class CharitySpider(Spider):
             item['attributes_990'] = attributes_990
             item['attributes_website'] = attributes_website
             for i in range(24):
-                if financial_table_keys[i] != '':
-                    item[financial_table_keys[i]] = financial_table_vals[i]
+                if FINANCIAL_TABLE_KEYS[i] != '':
+                    item[FINANCIAL_TABLE_KEYS[i]] = financial_table_vals[i]
             item['expenses_total'] = expenses_total
             item['revenue_total'] = revenue_total
             item['leader_comp'] = leader_comp
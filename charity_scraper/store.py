@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# SQLite store of the scraped charities, written by SqliteItemPipeline and queried by charity_reader.read_sqlite.
+#
+# One row per charity under a stable key, so a re-crawl updates the existing records instead of producing a new file.
+# The columns most analyses filter on are indexed, so a question like "4-star charities in TX in Animals" reads only
+# the matching rows.
+
+import hashlib
+import sqlite3
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from charity_scraper.items import CharityItem
+
+TABLE = 'charities'
+FLOAT_FIELDS = ['score_overall', 'score_financial', 'score_acc_trans']
+TEXT_FIELDS = ['name', 'tagline', 'category_l1', 'category_l2', 'location_city', 'location_state', 'location_zip',
+               'mission', 'leader_comp', 'url']
+INDEXED_FIELDS = ['location_state', 'category_l1', 'rating_overall', 'revenue_total']
+FIELDS = list(CharityItem.fields)
+
+
+# the charity navigator organisation id in the page url (...?bay=search.summary&orgid=3000 -> 'orgid:3000'), or a
+# hash of the url for pages that don't have one
+def charity_key(url):
+    orgid = parse_qs(urlsplit(url).query).get('orgid')
+    if orgid and orgid[0].strip():
+        return 'orgid:' + orgid[0].strip()
+    return 'url:' + hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def column_type(field):
+    if field in FLOAT_FIELDS:
+        return 'REAL'
+    if field in TEXT_FIELDS:
+        return 'TEXT'
+    return 'INTEGER'
+
+
+class CharityStore(object):
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        if read_only:
+            self.conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+            return
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS %s (charity_key TEXT PRIMARY KEY, %s, updated_at REAL)'
+                          % (TABLE, ', '.join('%s %s' % (field, column_type(field)) for field in FIELDS)))
+        # stores created before a field was added to CharityItem get the new column
+        existing = set(row[1] for row in self.conn.execute('PRAGMA table_info(%s)' % TABLE))
+        for field in FIELDS:
+            if field not in existing:
+                self.conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (TABLE, field, column_type(field)))
+        for field in INDEXED_FIELDS:
+            self.conn.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' % (TABLE, field, TABLE, field))
+        # the usual filter combination (state, category and rating together) as one index
+        self.conn.execute('CREATE INDEX IF NOT EXISTS %s_state_category_rating ON %s '
+                          '(location_state, category_l1, rating_overall)' % (TABLE, TABLE))
+        self.conn.commit()
+        self.upsert_sql = ('INSERT INTO %s (charity_key, %s, updated_at) VALUES (?, %s, ?) '
+                           'ON CONFLICT (charity_key) DO UPDATE SET %s, updated_at = excluded.updated_at'
+                           % (TABLE, ', '.join(FIELDS), ', '.join('?' * len(FIELDS)),
+                              ', '.join('%s = excluded.%s' % (field, field) for field in FIELDS)))
+
+    # insert or update the charities of the given items (all fields are replaced, unset fields become NULL)
+    def upsert(self, items):
+        now = time.time()
+        self.conn.executemany(self.upsert_sql, [
+            [charity_key(item['url'])] + [item.get(field) for field in FIELDS] + [now] for item in items])
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM %s' % TABLE).fetchone()[0]
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
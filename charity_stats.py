@@ -0,0 +1,277 @@
+import multiprocessing
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import stats
+import charity_metrics
+
+
+# key operations in this file:
+#     pairwise-complete correlation matrix of the numeric fields
+#     linear (OLS) fits of many (x, y) pairs at once, overall and per group (rating, category), with bootstrap
+#     confidence intervals for the slope and the correlation
+#     permutation and ANOVA tests of whether some states / categories have higher average ratings, with the false
+#     discovery rate controlled over all the groups tested
+#
+# everything is computed from the per pair sums n, sum x, sum y, sum x^2, sum y^2 and sum xy, which are matrix
+# products of the NaN-masked columns - every pair only uses the rows where both of its fields are present, as
+# stats.linregress would after dropping the missing rows
+
+# fields compared against score_overall in the charts
+RELATIONSHIP_FIELDS = ['net_assets', 'excess', 'revenue_total', 'prog_expense_ratio', 'fund_efficiency',
+                       'working_capital_ratio', 'leader_comp', 'num_990_attributes', 'num_website_attributes']
+
+FIT_COLUMNS = ['x', 'y', 'n', 'slope', 'intercept', 'r', 'r2', 'p_value', 'stderr', 'slope_low', 'slope_high',
+               'r_low', 'r_high']
+
+
+# the fields can be columns of the frame or derived metrics (charity_metrics)
+def _matrix(df, fields):
+    metrics = charity_metrics.metrics_for(df)
+    return np.column_stack([metrics.values(field) for field in fields])
+
+
+# per pair sums of the (n x k) matrix X against the (n x m) matrix Y, with rows weighted by w (a vector, or a
+# (b x n) matrix of b weightings at once) - every returned array is (k x m), or (b x k x m)
+def _sums(X, Y, w=None):
+    mx = ~np.isnan(X)
+    my = ~np.isnan(Y)
+    X0 = np.where(mx, X, 0.0)
+    Y0 = np.where(my, Y, 0.0)
+    Mx = mx.astype('float64')
+    My = my.astype('float64')
+    if w is None:
+        def product(a, b):
+            return a.T @ b
+    else:
+        def product(a, b):
+            return np.einsum('...n,nk,nm->...km', w, a, b, optimize=True)
+    return (product(Mx, My), product(X0, My), product(Mx, Y0), product(X0 * X0, My), product(Mx, Y0 * Y0),
+            product(X0, Y0))
+
+
+# slope, intercept (of the shifted data), r and the sums of squares from the per pair sums
+def _fit(n, sx, sy, sxx, syy, sxy):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ssx = sxx - sx * sx / n
+        ssy = syy - sy * sy / n
+        sxy_c = sxy - sx * sy / n
+        slope = sxy_c / ssx
+        intercept = sy / n - slope * sx / n
+        r = np.clip(sxy_c / np.sqrt(ssx * ssy), -1.0, 1.0)
+    return slope, intercept, r, ssx, ssy
+
+
+# pairwise-complete Pearson correlation of the fields, like DataFrame.corr()
+def correlation_matrix(df, fields):
+    X = _matrix(df, fields)
+    X = X - np.nanmean(X, axis=0)
+    r = _fit(*_sums(X, X))[2]
+    return pd.DataFrame(r, index=fields, columns=fields)
+
+
+def _fit_table(X, Y, x_fields, y_fields, n_boot, ci, rng, batch_size):
+    # shift every column by its mean so the sums of squares don't lose precision on large amounts
+    x_shift = np.nanmean(X, axis=0) if len(X) else np.zeros(X.shape[1])
+    y_shift = np.nanmean(Y, axis=0) if len(Y) else np.zeros(Y.shape[1])
+    X = X - x_shift
+    Y = Y - y_shift
+    n, sx, sy, sxx, syy, sxy = _sums(X, Y)
+    slope, intercept, r, ssx, ssy = _fit(n, sx, sy, sxx, syy, sxy)
+    df = n - 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # back to the original scale: y - uy = slope * (x - ux) + b
+        intercept = intercept + y_shift[np.newaxis, :] - slope * x_shift[:, np.newaxis]
+        stderr = np.sqrt((1 - r * r) * ssy / ssx / df)
+        t = r * np.sqrt(df / ((1.0 - r) * (1.0 + r)))
+    p_value = np.where(df > 0, 2 * stats.t.sf(np.abs(t), np.maximum(df, 1)), np.nan)
+
+    shape = slope.shape
+    slope_low = slope_high = r_low = r_high = np.full(shape, np.nan)
+    if n_boot and len(X):
+        # resample the rows n_boot times: each bootstrap sample is a vector of row counts (multinomial), and the sums
+        # of a whole batch of samples are one weighted matrix product
+        boot_slope = []
+        boot_r = []
+        rows = len(X)
+        for start in range(0, n_boot, batch_size):
+            w = rng.multinomial(rows, np.full(rows, 1.0 / rows), size=min(batch_size, n_boot - start)).astype('float64')
+            b_slope, _, b_r, _, _ = _fit(*_sums(X, Y, w))
+            boot_slope.append(b_slope)
+            boot_r.append(b_r)
+        boot_slope = np.concatenate(boot_slope)
+        boot_r = np.concatenate(boot_r)
+        tail = (1 - ci) / 2 * 100
+        # pairs without any usable sample (constant x, too few rows) just get NaN intervals
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            slope_low, slope_high = np.nanpercentile(boot_slope, [tail, 100 - tail], axis=0)
+            r_low, r_high = np.nanpercentile(boot_r, [tail, 100 - tail], axis=0)
+
+    xi, yi = np.meshgrid(np.arange(len(x_fields)), np.arange(len(y_fields)), indexing='ij')
+    xi = xi.ravel()
+    yi = yi.ravel()
+    return pd.DataFrame({
+        'x': [x_fields[i] for i in xi], 'y': [y_fields[j] for j in yi], 'n': n.ravel().astype('int64'),
+        'slope': slope.ravel(), 'intercept': intercept.ravel(), 'r': r.ravel(), 'r2': (r * r).ravel(),
+        'p_value': p_value.ravel(), 'stderr': stderr.ravel(), 'slope_low': slope_low.ravel(),
+        'slope_high': slope_high.ravel(), 'r_low': r_low.ravel(), 'r_high': r_high.ravel()}, columns=FIT_COLUMNS)
+
+
+# OLS fit of every y field against every x field, one row per (x, y) pair - and with group_field, also per value of
+# group_field (e.g. rating_overall or category_l1), in the group column; the overall fits have group 'All'
+# n_boot bootstrap resamples give the ci confidence intervals of the slope and r (n_boot=0 skips them)
+def fit_pairs(df, x_fields, y_fields, group_field=None, n_boot=1000, ci=0.95, seed=0, batch_size=100):
+    rng = np.random.default_rng(seed)
+    groups = [('All', df)]
+    if group_field is not None:
+        groups += list(df.groupby(group_field, observed=True, sort=True))
+    tables = []
+    for group, group_df in groups:
+        table = _fit_table(_matrix(group_df, x_fields), _matrix(group_df, y_fields), list(x_fields), list(y_fields),
+                           n_boot, ci, rng, batch_size)
+        table.insert(0, 'group', group)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+# the row of a fit_pairs table for one pair (and group), as a Series
+def lookup_fit(fits, x, y, group='All'):
+    rows = fits[(fits['x'] == x) & (fits['y'] == y) & (fits['group'] == group)]
+    if rows.empty:
+        raise KeyError('no fit of %s against %s for group %s' % (y, x, group))
+    return rows.iloc[0]
+
+
+GROUP_TEST_COLUMNS = ['factor', 'group', 'n', 'mean', 'mean_rest', 'difference', 'p_value', 'p_higher', 'q_value',
+                      'significant']
+ANOVA_COLUMNS = ['factor', 'groups', 'n', 'f', 'p_anova', 'p_permutation']
+
+
+# between-group sum of squares of every row of sums (b x k), for groups of the given sizes and a grand total
+def _between_ss(sums, sizes, total, n):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums * sums / sizes).sum(axis=-1) - total * total / n
+
+
+# group means minus the mean of the rest of the rows, for every row of sums (b x k)
+def _differences(sums, sizes, total, n):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / sizes - (total - sums) / (n - sizes)
+
+
+# one task of the permutation test: n_perm shuffles of the values over the fixed group codes, in batches of
+# batch_size - the group sums of a whole batch come out of a single bincount
+# returns how often each group's shuffled difference reached the observed one (in absolute value, and upwards), and
+# how often the shuffled between-group sum of squares reached the observed one
+def _permutation_task(args):
+    values, codes, groups, observed_diff, observed_ss, n_perm, batch_size, seed = args
+    rng = np.random.default_rng(seed)
+    n = len(values)
+    sizes = np.bincount(codes, minlength=groups).astype('float64')
+    total = values.sum()
+    extreme = np.zeros(groups, dtype=np.int64)
+    higher = np.zeros(groups, dtype=np.int64)
+    ss_extreme = 0
+    # a tiny tolerance so ties with the observed statistic count as reaching it despite rounding
+    tolerance = 1e-12 * max(1.0, np.abs(observed_diff).max())
+    for start in range(0, n_perm, batch_size):
+        b = min(batch_size, n_perm - start)
+        shuffled = rng.permuted(np.broadcast_to(values, (b, n)), axis=1)
+        index = (np.arange(b)[:, np.newaxis] * groups + codes).ravel()
+        sums = np.bincount(index, weights=shuffled.ravel(), minlength=b * groups).reshape(b, groups)
+        diff = _differences(sums, sizes, total, n)
+        extreme += (np.abs(diff) >= np.abs(observed_diff) - tolerance).sum(axis=0)
+        higher += (diff >= observed_diff - tolerance).sum(axis=0)
+        ss_extreme += int((_between_ss(sums, sizes, total, n) >= observed_ss * (1 - 1e-12)).sum())
+    return extreme, higher, ss_extreme
+
+
+# Benjamini-Hochberg adjusted p-values (q-values); NaN p-values are left out and stay NaN
+def fdr_bh(p_values):
+    p = np.asarray(p_values, dtype='float64')
+    q = np.full(p.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p))
+    if len(valid) == 0:
+        return q
+    order = valid[np.argsort(p[valid])]
+    ranked = p[order] * len(order) / np.arange(1, len(order) + 1)
+    q[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1.0)
+    return q
+
+
+# Test whether the groups of each factor (location_state, category_l1) differ in value_field:
+#     per group - permutation test of the group mean against the mean of all the other charities (two-sided p_value,
+#                 and p_higher for the group being higher), n_perm shuffles of the values over the group labels
+#     per factor - one-way ANOVA F test, with both its parametric p-value and the permutation p-value of the same
+#                  shuffles
+# The shuffles are split into tasks over a process pool (processes=None uses all cores, 1 stays in this process).
+# The group q-values control the false discovery rate at alpha over all the groups of all the factors.
+# Returns the per group table and the per factor table.
+def group_tests(df, value_field='rating_overall', factors=('location_state', 'category_l1'), n_perm=10000, alpha=0.05,
+                processes=None, seed=0, batch_size=200, min_size=2):
+    seeds = np.random.SeedSequence(seed)
+    tasks = []
+    prepared = []
+    for factor in factors:
+        data = df[[value_field, factor]].dropna()
+        codes, labels = pd.factorize(data[factor], sort=True)
+        sizes = np.bincount(codes, minlength=len(labels))
+        # groups too small to say anything about are left out of the test
+        keep = sizes >= min_size
+        remap = np.cumsum(keep) - 1
+        rows = keep[codes]
+        codes = remap[codes[rows]].astype(np.intp)
+        labels = [label for label, k in zip(labels, keep) if k]
+        values = data[value_field].to_numpy(dtype='float64')[rows]
+        groups = len(labels)
+        n = len(values)
+        sizes = np.bincount(codes, minlength=groups).astype('float64')
+        total = values.sum()
+        sums = np.bincount(codes, weights=values, minlength=groups)
+        observed_diff = _differences(sums, sizes, total, n)
+        observed_ss = float(_between_ss(sums, sizes, total, n))
+        prepared.append((factor, labels, values, codes, sizes, sums, total, observed_diff, observed_ss))
+        # split the shuffles of this factor into one task per batch_size * 5 shuffles
+        per_task = batch_size * 5
+        for start in range(0, n_perm, per_task):
+            tasks.append((len(prepared) - 1, (values, codes, groups, observed_diff, observed_ss,
+                                              min(per_task, n_perm - start), batch_size, seeds.spawn(1)[0])))
+
+    if processes == 1 or len(tasks) <= 1:
+        results = [_permutation_task(args) for _, args in tasks]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_permutation_task, [args for _, args in tasks])
+
+    group_rows = []
+    anova_rows = []
+    for i, (factor, labels, values, codes, sizes, sums, total, observed_diff, observed_ss) in enumerate(prepared):
+        groups = len(labels)
+        extreme = np.zeros(groups, dtype=np.int64)
+        higher = np.zeros(groups, dtype=np.int64)
+        ss_extreme = 0
+        for (task_factor, _), (e, h, s) in zip(tasks, results):
+            if task_factor == i:
+                extreme += e
+                higher += h
+                ss_extreme += s
+        n = len(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / sizes
+            mean_rest = (total - sums) / (n - sizes)
+        for j, label in enumerate(labels):
+            group_rows.append({'factor': factor, 'group': label, 'n': int(sizes[j]), 'mean': means[j],
+                               'mean_rest': mean_rest[j], 'difference': observed_diff[j],
+                               'p_value': (extreme[j] + 1) / (n_perm + 1), 'p_higher': (higher[j] + 1) / (n_perm + 1)})
+        within_ss = ((values - means[codes]) ** 2).sum()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            f = (observed_ss / (groups - 1)) / (within_ss / (n - groups))
+        anova_rows.append({'factor': factor, 'groups': groups, 'n': n, 'f': f,
+                           'p_anova': stats.f.sf(f, groups - 1, n - groups) if groups > 1 and n > groups else np.nan,
+                           'p_permutation': (ss_extreme + 1) / (n_perm + 1)})
+
+    group_table = pd.DataFrame(group_rows, columns=GROUP_TEST_COLUMNS)
+    group_table['q_value'] = fdr_bh(group_table['p_value'])
+    group_table['significant'] = group_table['q_value'] <= alpha
+    return group_table, pd.DataFrame(anova_rows, columns=ANOVA_COLUMNS)